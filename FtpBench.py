@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import sys        # Using for retrive and parse command arguments
+import socket     # Socket package, using for handle TCP connections
+import time       # Measure elapsed time
+import re         # Parse PASV reply
+import threading  # Parallel sessions
+import FtpProxy   # Simulated WAN link between benchmark and server
+###############################################################
+CRLF = '\r\n'     # End of line separator using in FTP protocol
+DEFAULT_COMMANDS = 10000  # Number of commands sent in each benchmark
+DEFAULT_DEPTH    = 32     # Number of commands in flight in pipelined benchmark
+DEFAULT_TRANSFERS = 200   # Number of downloads in transfers benchmark
+DEFAULT_SESSIONS = 4      # Number of sessions in parallel benchmark
+DEFAULT_IDLE = 1000       # Number of idle sessions in memory benchmark
+# Client socket options presets (same names as "socket_profile" of the server)
+PROFILES = {
+    "DEFAULT" : {"tcp_nodelay" : False, "data_rcvbuf" : 0},
+    "LAN" : {"tcp_nodelay" : True, "data_rcvbuf" : 0},
+    "WAN" : {"tcp_nodelay" : True, "data_rcvbuf" : 4 * 1024 * 1024}}
+###############################################################
+# Show usage format. If we run script without apropriate arguments then script will show up usage info
+def print_usage():
+    print("commands <host/ip> <remote port> <login> <password> [commands=%d] [depth=%d]" % (DEFAULT_COMMANDS, DEFAULT_DEPTH))
+    print("transfers <host/ip> <remote port> <login> <password> <remote file> [transfers=%d] [profile=LAN]" % DEFAULT_TRANSFERS)
+    print("parallel <host/ip> <remote port> <login> <password> <remote file> [sessions=%d] [transfers=%d] [profile=LAN]" % (DEFAULT_SESSIONS, 10))
+    print("memory <host/ip> <remote port> <server pid> [sessions=%d] [login] [password]" % DEFAULT_IDLE)
+    print("    opens idle sessions (logged in when login given) and reports server memory per session (Linux)")
+    print("wan <latency=ms,jitter=ms,bandwidth=bytes/s,burst=bytes,window=bytes> <benchmark> <benchmark arguments>")
+    print("    runs benchmark through FtpProxy simulating given link, for example: wan latency=40,bandwidth=10M commands 127.0.0.1 21 user pass")
+###############################################################
+# Base benchmark exception class
+class FtpBenchException(Exception):
+    # Constructor: accept error message
+    def __init__(self, message):
+        super(FtpBenchException, self).__init__(message)
+###############################################################
+# Minimal control connection used by benchmarks (no logging, no parsing except status codes)
+class BenchConnection:
+    def __init__(self, host, port, profile=PROFILES["DEFAULT"]):
+        self.profile = profile
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if profile["tcp_nodelay"]: self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(15)
+        self.sock.connect((host, int(port)))
+        self.rbuf = ''
+        self.line = ''
+        # Server should greet us with 220
+        if self.readReply() != 220: raise FtpBenchException("Received bad \"Hello Header\"")
+    ###############################################################
+    # Read one (possibly multiline) reply and return its status code
+    def readReply(self):
+        while True:
+            pos = self.rbuf.find("\n")
+            while pos == -1:
+                chunk = self.sock.recv(65536)
+                if not chunk: raise FtpBenchException("Connection closed by server")
+                self.rbuf += chunk
+                pos = self.rbuf.find("\n")
+            line, self.rbuf = self.rbuf[:pos], self.rbuf[pos + 1:]
+            # Last line of the reply: 3 digits and space
+            if len(line) > 3 and line[3] == " " and line[:3].isdigit():
+                self.line = line
+                return int(line[:3])
+    ###############################################################
+    # Send one command and wait for reply
+    def command(self, cmd):
+        self.sock.sendall(cmd + CRLF)
+        return self.readReply()
+    ###############################################################
+    def login(self, user_login, user_pass):
+        self.command("USER " + user_login)
+        if self.command("PASS " + user_pass) != 230: raise FtpBenchException("Login failed")
+    ###############################################################
+    # Send PASV and connect data connection to the address from reply
+    def passive(self):
+        if self.command("PASV") != 227: raise FtpBenchException("Server rejected passive mode")
+        numbers = re.search(r"(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)", self.line)
+        if numbers is None: raise FtpBenchException("Bad PASV reply: " + self.line)
+        numbers = [int(n) for n in numbers.groups()]
+        data = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Receive buffer has to be set before connect so window scale is negotiated for it
+        if self.profile["data_rcvbuf"]: data.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.profile["data_rcvbuf"])
+        data.settimeout(15)
+        data.connect(("%d.%d.%d.%d" % tuple(numbers[:4]), numbers[4] * 256 + numbers[5]))
+        return data
+    ###############################################################
+    # Download [filename] over passive connection. Return number of received bytes
+    def retrieve(self, filename):
+        data = self.passive()
+        received = 0
+        try:
+            self.sock.sendall("RETR " + filename + CRLF)
+            while True:
+                chunk = data.recv(262144)
+                if not chunk: break
+                received += len(chunk)
+        finally:
+            data.close()
+        # Skip preliminary replies
+        code = self.readReply()
+        while code < 200: code = self.readReply()
+        if code != 226: raise FtpBenchException("Transfer failed: " + self.line)
+        return received
+    ###############################################################
+    def close(self):
+        try:
+            self.sock.sendall("QUIT" + CRLF)
+            self.sock.close()
+        except socket.error:
+            pass
+###############################################################
+# Send [count] commands keeping [depth] of them in flight. Return commands per second
+def bench_commands(conn, cmd, count, depth):
+    line = cmd + CRLF
+    start = time.time()
+    sent, received = 0, 0
+    while received < count:
+        # Fill pipeline with one write
+        n = min(depth - (sent - received), count - sent)
+        if n > 0:
+            conn.sock.sendall(line * n)
+            sent += n
+        # Wait at least one reply
+        conn.readReply()
+        received += 1
+    return count / (time.time() - start)
+###############################################################
+# Control channel benchmark: lockstep (depth 1) and pipelined commands
+def run_commands(args):
+    if len(args) < 4:
+        print_usage()
+        return None
+    host, port, user_login, user_pass = args[:4]
+    count = int(args[4]) if len(args) > 4 else DEFAULT_COMMANDS
+    depth = int(args[5]) if len(args) > 5 else DEFAULT_DEPTH
+    conn = BenchConnection(host, port)
+    try:
+        conn.login(user_login, user_pass)
+        for d in (1, depth):
+            rate = bench_commands(conn, "PWD", count, d)
+            print("PWD x %d, depth %3d: %10.1f commands/sec" % (count, d, rate))
+    finally:
+        conn.close()
+###############################################################
+# Data channel benchmark: sequential PASV + RETR of one file, measures per-transfer setup cost
+def run_transfers(args):
+    if len(args) < 5:
+        print_usage()
+        return None
+    host, port, user_login, user_pass, filename = args[:5]
+    count = int(args[5]) if len(args) > 5 else DEFAULT_TRANSFERS
+    name = args[6].upper() if len(args) > 6 else "LAN"
+    if name not in PROFILES: raise FtpBenchException("Unknown profile " + name)
+    conn = BenchConnection(host, port, PROFILES[name])
+    try:
+        conn.login(user_login, user_pass)
+        # Binary mode, so sizes are not changed by line ends conversion
+        conn.command("TYPE I")
+        total = 0
+        start = time.time()
+        for i in range(count):
+            total += conn.retrieve(filename)
+        elapsed = time.time() - start
+        print("RETR x %d, profile %s: %10.1f transfers/sec, %8.2f ms/transfer, %8.2f MB/s" %
+              (count, name, count / elapsed, elapsed * 1000 / count, total / elapsed / 1048576))
+    finally:
+        conn.close()
+###############################################################
+# Data channel benchmark: [sessions] sessions download file at the same time, measures aggregate throughput
+def run_parallel(args):
+    if len(args) < 5:
+        print_usage()
+        return None
+    host, port, user_login, user_pass, filename = args[:5]
+    sessions = int(args[5]) if len(args) > 5 else DEFAULT_SESSIONS
+    count = int(args[6]) if len(args) > 6 else 10
+    name = args[7].upper() if len(args) > 7 else "LAN"
+    if name not in PROFILES: raise FtpBenchException("Unknown profile " + name)
+    conns = [BenchConnection(host, port, PROFILES[name]) for i in range(sessions)]
+    totals, errors = [0] * sessions, []
+    def download(i):
+        try:
+            for j in range(count):
+                totals[i] += conns[i].retrieve(filename)
+        except (FtpBenchException, socket.error) as e:
+            errors.append(str(e))
+    try:
+        for conn in conns:
+            conn.login(user_login, user_pass)
+            conn.command("TYPE I")
+        threads = [threading.Thread(target=download, args=(i,)) for i in range(sessions)]
+        start = time.time()
+        for th in threads: th.start()
+        for th in threads: th.join()
+        elapsed = time.time() - start
+        if errors: raise FtpBenchException(errors[0])
+        print("RETR x %d in %d sessions, profile %s: %10.1f transfers/sec, %8.2f MB/s" %
+              (count * sessions, sessions, name, count * sessions / elapsed, sum(totals) / elapsed / 1048576))
+    finally:
+        for conn in conns: conn.close()
+###############################################################
+# Return (resident, virtual) memory of process [pid] in bytes
+def process_memory(pid):
+    values = {}
+    try:
+        with open("/proc/%s/status" % pid) as status:
+            for line in status:
+                key, sep, value = line.partition(":")
+                if key in ("VmRSS", "VmSize"): values[key] = int(value.split()[0]) * 1024
+    except IOError as e:
+        raise FtpBenchException("Can not read memory of process %s: %s" % (pid, e))
+    return values.get("VmRSS", 0), values.get("VmSize", 0)
+###############################################################
+# Memory benchmark: server memory per idle session
+def run_memory(args):
+    if len(args) < 3:
+        print_usage()
+        return None
+    host, port, pid = args[:3]
+    sessions = int(args[3]) if len(args) > 3 else DEFAULT_IDLE
+    user_login, user_pass = (args[4], args[5]) if len(args) > 5 else (None, None)
+    rss, vsize = process_memory(pid)
+    conns = []
+    try:
+        for i in range(sessions):
+            conn = BenchConnection(host, port)
+            conns.append(conn)
+            if user_login: conn.login(user_login, user_pass)
+            # Session did some work before going idle
+            conn.command("PWD")
+        # Let server threads settle
+        time.sleep(2)
+        rss2, vsize2 = process_memory(pid)
+        print("%d idle sessions%s: %10.0f bytes RSS/session, %10.0f bytes virtual/session" %
+              (sessions, " (logged in)" if user_login else "", float(rss2 - rss) / sessions, float(vsize2 - vsize) / sessions))
+    finally:
+        for conn in conns: conn.close()
+###############################################################
+# Run benchmark through simulated WAN link: proxy is started in this process, benchmark connects to it
+def run_wan(args):
+    if len(args) < 4 or args[1] not in ("commands", "transfers", "parallel"):
+        print_usage()
+        return None
+    try:
+        conditions = FtpProxy.parse_conditions([c for c in args[0].split(",") if c])
+    except FtpProxy.FtpProxyException as e:
+        raise FtpBenchException(str(e))
+    proxy = FtpProxy.FtpProxy(0, args[2], args[3], conditions).start()
+    print("Link: " + ", ".join("%s=%s" % item for item in sorted(conditions.items())))
+    try:
+        BENCHMARKS[args[1]](["127.0.0.1", str(proxy.listen_port)] + args[4:])
+    finally:
+        proxy.stop()
+###############################################################
+BENCHMARKS = {"commands" : run_commands, "transfers" : run_transfers, "parallel" : run_parallel, "memory" : run_memory, "wan" : run_wan}
+###############################################################
+# Main function
+def main():
+    # Receive command line arguments
+    args = sys.argv[1:]
+    if len(args) == 0 or args[0] not in BENCHMARKS:
+        print_usage()
+        return None
+    try:
+        BENCHMARKS[args[0]](args[1:])
+    except (FtpBenchException, socket.error) as e:
+        print("ERROR: " + str(e))
+###############################################################
+# if we use this not as module -> just run main function
+if __name__ == "__main__":
+    main()
+###############################################################
@@ -4,9 +4,22 @@ import sys        # Using for retrive and parse command arguments
 import socket     # Socket package, using for handle TCP connections
 import time       # Get current timestamp
 import datetime   # Get current datetime combined with timestamp (using both for gettimestamp() method)
+import os         # Local files info
+import hashlib, zlib # Local file digests (verify command)
+import calendar   # Convert MDTM time (UTC) to timestamp
+import struct     # Delta transfer records
+import tarfile    # Archives received with SITE ARCHIVE
+import select     # Wait for prepared data connection
 ###############################################################
 CRLF = '\r\n'     # End of line separator using in FTP protocol
 DEFAULT_PORT = 21 # Default ftp server port
+MANIFEST_FILE = ".ftpmanifest" # Manifest of last sync stored in synced local folder
+# Socket options presets (same names as "socket_profile" of the server): DEFAULT (system defaults),
+# LAN (no Nagle delay on control connection, keepalive), WAN (LAN plus big data buffers)
+SOCKET_PROFILES = {
+    "DEFAULT" : {"tcp_nodelay" : False, "tcp_keepalive" : False, "data_sndbuf" : 0, "data_rcvbuf" : 0},
+    "LAN" : {"tcp_nodelay" : True, "tcp_keepalive" : True, "data_sndbuf" : 0, "data_rcvbuf" : 0},
+    "WAN" : {"tcp_nodelay" : True, "tcp_keepalive" : True, "data_sndbuf" : 4 * 1024 * 1024, "data_rcvbuf" : 4 * 1024 * 1024}}
 ###############################################################
 # Show usage format. If we run script without apropriate arguments then script will show up usage info
 def print_usage():
@@ -21,6 +34,27 @@ class FtpClientException(Exception):
     def __str__(self):
         return self.message 
 ###############################################################
+# File object over blocks received from data connection (tarfile reads archive from it)
+class ChunkReader:
+    # Ctor accepted iterator of data blocks
+    def __init__(self, chunks):
+        self.chunks = chunks
+        # Received data not read yet starts at [pos] of buffer
+        self.buffer, self.pos = "", 0
+        # Bytes read from data connection
+        self.received = 0
+    ###############################################################
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            chunk = next(self.chunks, None)
+            if chunk == None: break
+            self.received += len(chunk)
+            self.buffer, self.pos = self.buffer[self.pos:] + chunk, 0
+        if size < 0: size = len(self.buffer) - self.pos
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+###############################################################
 # FTP client class. With allow us to connect to the server, send and receive messages
 class FtpClient:
     """
@@ -46,6 +80,18 @@ class FtpClient:
         self.actv = None
         # Initialy no pasive, no active mode
         self.pasive_mode, self.active_mode = False, False
+        # Transfer mode: S (stream) or Z (data is deflate compressed), changed with MODE command
+        self.transfer_mode = "S"
+        # Representation type: A (ASCII, server default) or I (binary), changed with TYPE command
+        self.transfer_type = "A"
+        # Digests of local files: (filename, algorithm) -> ((size, mtime), digest)
+        self.digests = {}
+        # Next passive data connection is negotiated and connected while current transfer ends
+        self.speculative = True
+        # Prepared data connection (connect in progress or done) for next transfer
+        self.prepared = None
+        # Socket options of new connections (can be changed with setProfile)
+        self.profile = dict(SOCKET_PROFILES["LAN"])
         # Validate argumens, remote_host should be valid value so we can obtain ip address,
         # log_file_name should be valid filename, 
         # port should be a positive integer
@@ -89,6 +135,7 @@ class FtpClient:
     ###############################################################
     # Close data connection and release resources
     def closeDataConnection(self):
+        self.dropPrepared()
         # If we close data connection in ACTIVE mode
         if self.active_mode:
             if self.data_socket != None:
@@ -105,6 +152,23 @@ class FtpClient:
         # Assign variables None
         self.actv, self.pasv, self.data_socket = None, None, None
     ###############################################################
+    # Use socket options preset [name] (DEFAULT, LAN, WAN) for new connections. Options of preset
+    # can be changed by [options] (tcp_nodelay, tcp_keepalive, data_sndbuf, data_rcvbuf)
+    def setProfile(self, name, **options):
+        if name.upper() not in SOCKET_PROFILES: raise FtpClientException("Unknown socket profile " + name)
+        self.profile = dict(SOCKET_PROFILES[name.upper()])
+        self.profile.update(options)
+    ###############################################################
+    # Set options of control connection [sock] (before it is connected)
+    def tuneControl(self, sock):
+        if self.profile["tcp_nodelay"]: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.profile["tcp_keepalive"]: sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    ###############################################################
+    # Set buffers of data connection [sock] (before connect or listen, so window scale is negotiated for them)
+    def tuneData(self, sock):
+        if self.profile["data_sndbuf"]: sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.profile["data_sndbuf"])
+        if self.profile["data_rcvbuf"]: sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.profile["data_rcvbuf"])
+    ###############################################################
     # Return string of current time stamp
     def get_timestamp(self):
         # Get current date/time and convert to string using specified format
@@ -128,6 +192,7 @@ class FtpClient:
         try:
             # Create control socket
             self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tuneControl(self.control_socket)
             # Set timeout to 15 sec ( we dont want to wait forever )
             self.control_socket.settimeout(15)
             # Make log record about connection
@@ -202,6 +267,7 @@ class FtpClient:
             ip = socket.gethostbyname(socket.gethostname())
             # Create listen socket for incoming connections
             self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tuneData(self.data_socket)
             self.data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.data_socket.settimeout(15)
             # Bind to the current ip and random free port
@@ -224,6 +290,7 @@ class FtpClient:
             ip = socket.gethostbyname(socket.gethostname())
             # Create listen socket for incoming connections
             self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tuneData(self.data_socket)
             self.data_socket.settimeout(15)
             # Bind to the current ip and random free port
             self.data_socket.bind((ip, 0))
@@ -234,6 +301,9 @@ class FtpClient:
             self.data_socket.listen(0)
             # Result port arguments separated with "|"
             args = "|1|" + ip + "|" + str(port) + "|"
+        # Server replaces its passive listen socket: prepared data connection becomes useless
+        elif command == "pasv" or command == "epsv":
+            self.dropPrepared()
         # Send command to remove server
         self.log("Sent: " + command + " " + args)
         self.control_socket.send(command + " " + args + CRLF)
@@ -249,6 +319,7 @@ class FtpClient:
                 # Try to make data connection to remote server
                 try:
                     self.data_socket = socket.socket()
+                    self.tuneData(self.data_socket)
                     self.data_socket.settimeout(10)
                     self.data_socket.connect(self.pasv)
                     self.log("Data connection to %s %s established succefuly." % self.pasv)
@@ -260,6 +331,7 @@ class FtpClient:
             if self.pasive_mode and self.pasv != None:
                 try:
                     self.data_socket = socket.socket()
+                    self.tuneData(self.data_socket)
                     self.data_socket.settimeout(10)
                     self.data_socket.connect(self.pasv)
                     self.log("Data connection to %s %s established succefuly." % self.pasv)
@@ -283,8 +355,45 @@ class FtpClient:
         # Return obtained responce
         return response
     ###############################################################
+    # Read data connection [sock] until it is closed. Yield received data by blocks,
+    # in MODE Z data is decompressed (each block is limited, so memory use is bounded)
+    def readChunks(self, sock):
+        inflater = zlib.decompressobj() if self.transfer_mode == "Z" else None
+        chunk = sock.recv(65536)
+        while chunk:
+            if inflater == None:
+                yield chunk
+            else:
+                while chunk:
+                    data = inflater.decompress(chunk, 1024 * 1024)
+                    if data: yield data
+                    chunk = inflater.unconsumed_tail
+            chunk = sock.recv(65536)
+        if inflater != None:
+            data = inflater.flush()
+            if data: yield data
+    ###############################################################
+    # Read file data from data connection [sock] by blocks. In ASCII mode (TYPE A)
+    # network line endings (CRLF) are converted to local ones, CR and LF may come in different blocks
+    def readFileChunks(self, sock):
+        if self.transfer_type != "A" or os.linesep == CRLF:
+            for chunk in self.readChunks(sock): yield chunk
+            return
+        cr = False
+        for chunk in self.readChunks(sock):
+            # Complete CRLF started in previous block
+            if cr:
+                chunk = "\r" + chunk
+            cr = chunk.endswith("\r")
+            if cr: chunk = chunk[:-1]
+            yield chunk.replace(CRLF, os.linesep)
+        if cr: yield "\r"
+    ###############################################################
     # Method for read answer after command LIST, using [sock] as "data socket"
     def readLIST(self, sock):
+        # Compressed listing can not be read by lines
+        if self.transfer_mode == "Z":
+            return "".join(self.readChunks(sock)).strip(CRLF).replace(CRLF, "\n")
         line, lines = ' ', []
         # Read all lines
         while line != '':
@@ -295,27 +404,24 @@ class FtpClient:
     # Method for read answer on RETR command, using [sock] as "data socket"
     def readRETR(self, sock):
         # buffer - result received data
-        # chunk - current received character
         # line, i - used for print out received bytes by 8 elements in each line
-        buffer, chunk, line, i =  '', ' ', '', 0
-        # Read data from socket until we reach no data (empty chunk)
-        while chunk != '':
-            chunk = sock.recv(1)
-            # If we reach empty data - stop read
-            if chunk == '': break
-            # Append new byte to line
-            line += "0x{:02x} ".format( ord(chunk) )
-            # Time to show line of bytes ? (8 element in each line) -> then print line
-            if (i + 1) % 9 == 0:
-                print("\t" + line)
-                # Empty line, zero byte counter
-                line, i = '', 0
-            # Next byte
-            i += 1
-            # Append character to result buffer
-            buffer += chunk
+        buffer, line, i =  [], '', 0
+        # Read data from socket until we reach no data (connection closed)
+        for chunk in self.readFileChunks(sock):
+            for char in chunk:
+                # Append new byte to line
+                line += "0x{:02x} ".format( ord(char) )
+                # Time to show line of bytes ? (8 element in each line) -> then print line
+                if (i + 1) % 9 == 0:
+                    print("\t" + line)
+                    # Empty line, zero byte counter
+                    line, i = '', 0
+                # Next byte
+                i += 1
+            # Append block to result buffer
+            buffer.append(chunk)
         # Return received data
-        return buffer
+        return "".join(buffer)
     ###############################################################
     # Parse response obtained from the server
     def parseResponse(self, response, command):
@@ -369,6 +475,12 @@ class FtpClient:
                 #self.sendCommand("226 Closing data connection.")
                 self.data_socket.close()
                 self.data_socket = None
+        # TYPE: remember representation type accepted by server
+        elif command.startswith("type "):
+            if response["code"] == 200: self.transfer_type = "A" if command[5:].strip().startswith("a") else "I"
+        # MODE: remember transfer mode accepted by server
+        elif command.startswith("mode "):
+            if response["code"] == 200: self.transfer_mode = command[5:].strip().upper()
         # Status file OK. Prepare data connection
         elif (response["code"] == 150 or response["code"] == 125) and (command.startswith("list") or command.startswith("retr")):
             if self.data_socket == None:
@@ -441,6 +553,409 @@ class FtpClient:
             # Read post message
             buffer = self.readFrom(self.control_socket)
             self.log("Received: " + buffer)
+    ###############################################################
+    # Return digest of local file [filename] computed with [algo] (HASH algorithm name).
+    # Digests are cached while file size and modification time are not changed
+    def localDigest(self, filename, algo):
+        st = os.stat(filename)
+        entry = self.digests.get((filename, algo))
+        if entry != None and entry[0] == (st.st_size, st.st_mtime): return entry[1]
+        constructors = {"SHA-1" : hashlib.sha1, "SHA-256" : hashlib.sha256, "SHA-512" : hashlib.sha512, "MD5" : hashlib.md5}
+        h, crc = constructors[algo]() if algo in constructors else None, 0
+        with open(filename, "rb") as f:
+            block = f.read(1024 * 1024)
+            while block:
+                if h != None: h.update(block)
+                else: crc = zlib.crc32(block, crc)
+                block = f.read(1024 * 1024)
+        digest = h.hexdigest() if h != None else "%08x" % (crc & 0xffffffff)
+        self.digests[(filename, algo)] = ((st.st_size, st.st_mtime), digest)
+        return digest
+    ###############################################################
+    # Compare local file [filename] with remote file with the same name using one HASH command.
+    # Return True if files are equal
+    def verify(self, filename):
+        if not os.path.isfile(filename):
+            self.log("Verify: local file \"" + filename + "\" not found")
+            return False
+        self.sendCommand("hash " + filename)
+        response = self.receiveAnswer("hash")
+        # Expected: 213 <algorithm> <start>-<end> <digest> <filename>
+        if response["code"] != 213:
+            self.log("Verify: server can't compute digest of \"" + filename + "\"")
+            return False
+        fields = response["message"].split(" ", 4)
+        algo, digest = fields[1].upper(), fields[3].lower()
+        equal = self.localDigest(filename, algo) == digest
+        self.log("Verify \"%s\" (%s): %s" % (filename, algo, "OK" if equal else "FAILED, files differ"))
+        return equal
+    ###############################################################
+    # Read replies until final one (skip preliminary 1xx replies)
+    def receiveFinalAnswer(self):
+        response = self.receiveAnswer("")
+        while 100 <= response["code"] < 200:
+            response = self.receiveAnswer("")
+        return response
+    ###############################################################
+    # Enter passive mode and connect to the server. Return data socket.
+    # Data connection prepared during previous transfer is used if server did not close it
+    def openPassive(self):
+        sock, self.prepared = self.prepared, None
+        if sock != None:
+            try:
+                # Wait for connect started in prepareData()
+                if not select.select([], [sock], [], 10)[1]: raise socket.error("connect timed out")
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err != 0: raise socket.error(err, os.strerror(err))
+                # Server never sends before transfer command: readable socket is closed one
+                if select.select([sock], [], [], 0)[0] and not sock.recv(1, socket.MSG_PEEK): raise socket.error("closed by server")
+                sock.setblocking(1)
+                sock.settimeout(10)
+                self.log("Using prepared data connection")
+                return sock
+            except socket.error as e:
+                self.log("Prepared data connection failed (" + str(e) + "), entering passive mode again")
+                sock.close()
+        self.sendCommand("pasv")
+        response = self.receiveAnswer("pasv")
+        self.parseResponse(response, "pasv")
+        if not self.pasive_mode: raise FtpClientException("Server rejected passive mode")
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tuneData(sock)
+            sock.settimeout(10)
+            sock.connect(self.pasv)
+        except socket.error:
+            raise FtpClientException("Unable open data connection")
+        finally:
+            self.pasv, self.pasive_mode = None, False
+        return sock
+    ###############################################################
+    # Open data connection and send transfer [command]. Return (data socket, preliminary reply).
+    # If prepared data connection is refused by server, command is sent again with new connection
+    def openTransfer(self, command):
+        prepared = self.prepared != None
+        sock = self.openPassive()
+        self.sendCommand(command)
+        response = self.receiveAnswer("")
+        if prepared and response["code"] in (421, 425, 426):
+            sock.close()
+            self.log("Prepared data connection refused, entering passive mode again")
+            sock = self.openPassive()
+            self.sendCommand(command)
+            response = self.receiveAnswer("")
+        return sock, response
+    ###############################################################
+    # Read final reply of transfer. Next data connection is negotiated (PASV is sent before the reply
+    # is read, server answers it after the transfer) and connected in background
+    def finishTransfer(self):
+        if not self.speculative: return self.receiveFinalAnswer()
+        self.dropPrepared()
+        self.sendCommand("pasv")
+        response = self.receiveFinalAnswer()
+        self.prepareData()
+        return response
+    ###############################################################
+    # Read reply on PASV sent by finishTransfer() and start connecting (non-blocking) to the server
+    def prepareData(self):
+        response = self.receiveAnswer("pasv")
+        self.parseResponse(response, "pasv")
+        if not self.pasive_mode: return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tuneData(sock)
+        sock.setblocking(0)
+        sock.connect_ex(self.pasv)
+        self.prepared = sock
+        self.pasv, self.pasive_mode = None, False
+    ###############################################################
+    # Close prepared data connection (user enters passive/active mode himself or session ends)
+    def dropPrepared(self):
+        if self.prepared != None: self.prepared.close()
+        self.prepared = None
+    ###############################################################
+    # Return size of remote file [filename] (SIZE command) or None if unknown
+    def size(self, filename):
+        self.sendCommand("size " + filename)
+        response = self.receiveAnswer("size")
+        if response["code"] != 213: return None
+        return int(response["message"][4:].strip())
+    ###############################################################
+    # Return modification time (timestamp) of remote file [filename] (MDTM command) or None if unknown
+    def mdtm(self, filename):
+        self.sendCommand("mdtm " + filename)
+        response = self.receiveAnswer("mdtm")
+        if response["code"] != 213: return None
+        # Reply format: 213 YYYYMMDDHHMMSS[.sss] (UTC)
+        return calendar.timegm(time.strptime(response["message"][4:18], "%Y%m%d%H%M%S"))
+    ###############################################################
+    # Return listing (LIST) of remote folder [path] (current folder by default)
+    def listing(self, path=""):
+        sock, response = self.openTransfer(("list " + path).strip())
+        try:
+            if response["code"] != 150 and response["code"] != 125:
+                raise FtpClientException("Server rejected LIST " + path)
+            data = "".join(self.readChunks(sock)).strip(CRLF).replace(CRLF, "\n")
+        finally:
+            sock.close()
+        response = self.finishTransfer()
+        if response["code"] != 226: raise FtpClientException("Transfer of listing failed")
+        self.log("Received: " + str(len(data)) + " bytes \n")
+        self.log("\n" + data)
+        return data
+    ###############################################################
+    # Switch to binary representation type (TYPE I) if other type is used. Server default is ASCII,
+    # where line endings are converted (binary files with CRLF would be changed)
+    def binary(self):
+        if self.transfer_type == "I": return
+        self.sendCommand("type i")
+        self.parseResponse(self.receiveAnswer("type"), "type i")
+    ###############################################################
+    # Download remote file [filename] into local file [local] (same name by default) in binary mode.
+    # Local file gets modification time of remote file, so later fetch() can skip it
+    def retrieve(self, filename, local=None, mtime=None):
+        local = local or os.path.basename(filename)
+        self.binary()
+        sock, response = self.openTransfer("retr " + filename)
+        try:
+            if response["code"] != 150 and response["code"] != 125:
+                raise FtpClientException("Server rejected RETR " + filename)
+            size = 0
+            with open(local, "wb") as f:
+                for chunk in self.readChunks(sock):
+                    f.write(chunk)
+                    size += len(chunk)
+        finally:
+            sock.close()
+        response = self.finishTransfer()
+        if response["code"] != 226: raise FtpClientException("Transfer of " + filename + " failed")
+        if mtime != None: os.utime(local, (mtime, mtime))
+        self.log("Received: file: \"" + local + "\" " + str(size) + " bytes")
+    ###############################################################
+    # Update local copy [local] of remote file [filename] with delta transfer (SITE DELTA): signatures
+    # of blocks of local copy are sent to the server, server sends only data missing in local copy.
+    # Local file gets modification time [mtime]. Return False if server does not support delta
+    def delta(self, filename, local=None, mtime=None):
+        local = local or os.path.basename(filename)
+        if not os.path.isfile(local):
+            self.retrieve(filename, local, mtime)
+            return True
+        # Block size grows with file size (about square root of it), so number of signatures stays moderate
+        block_size = max(2048, min(65536, int(os.path.getsize(local) ** 0.5) // 512 * 512))
+        signatures = []
+        with open(local, "rb") as f:
+            block = f.read(block_size)
+            while block:
+                signatures.append(struct.pack("!I16s", zlib.adler32(block) & 0xffffffff, hashlib.md5(block).digest()))
+                block = f.read(block_size)
+        self.binary()
+        sock, response = self.openTransfer("site delta %d %s" % (block_size, filename))
+        received, copied = 0, 0
+        try:
+            if response["code"] == 504 or response["code"] == 500 or response["code"] == 502: return False
+            if response["code"] != 150 and response["code"] != 125:
+                raise FtpClientException("Server rejected SITE DELTA " + filename)
+            sock.sendall("".join(signatures))
+            sock.shutdown(socket.SHUT_WR)
+            # Server reads whole file before it sends anything for unchanged parts
+            sock.settimeout(None)
+            # New file is built next to local copy, then replaces it
+            with open(local, "rb") as old, open(local + ".delta", "wb") as new:
+                buf = ""
+                for chunk in self.readChunks(sock):
+                    received += len(chunk)
+                    buf += chunk
+                    pos = 0
+                    while True:
+                        if buf[pos:pos + 1] == "B" and len(buf) - pos >= 9:
+                            first, count = struct.unpack("!II", buf[pos + 1:pos + 9])
+                            old.seek(first * block_size)
+                            data = old.read(count * block_size)
+                            new.write(data)
+                            copied += len(data)
+                            pos += 9
+                        elif buf[pos:pos + 1] == "L" and len(buf) - pos >= 5:
+                            length = struct.unpack("!I", buf[pos + 1:pos + 5])[0]
+                            if len(buf) - pos < 5 + length: break
+                            new.write(buf[pos + 5:pos + 5 + length])
+                            pos += 5 + length
+                        elif buf[pos:pos + 1] in ("", "B", "L"):
+                            break
+                        else:
+                            raise FtpClientException("Bad delta record")
+                    buf = buf[pos:]
+                if buf: raise FtpClientException("Delta of " + filename + " is truncated")
+        finally:
+            sock.close()
+        response = self.finishTransfer()
+        if response["code"] != 226:
+            if os.path.isfile(local + ".delta"): os.remove(local + ".delta")
+            raise FtpClientException("Delta transfer of " + filename + " failed")
+        # Windows can not rename over existing file
+        if os.name == "nt": os.remove(local)
+        os.rename(local + ".delta", local)
+        if mtime != None: os.utime(local, (mtime, mtime))
+        self.log("Received: delta of \"%s\": %d bytes received, %d bytes reused from local copy" % (local, received, copied))
+        return True
+    ###############################################################
+    # Download remote folder [remote_dir] as one archive (SITE ARCHIVE) and extract it into
+    # local folder [local_dir] while it is received. Only files and folders located inside
+    # [local_dir] are extracted (links, devices and paths leaving the folder are skipped).
+    # Return number of extracted files
+    def archive(self, remote_dir, local_dir):
+        if not os.path.isdir(local_dir): os.makedirs(local_dir)
+        root = os.path.realpath(local_dir)
+        sock, response = self.openTransfer("site archive " + remote_dir)
+        files, skipped = 0, 0
+        try:
+            if response["code"] != 150 and response["code"] != 125:
+                raise FtpClientException("Server rejected SITE ARCHIVE " + remote_dir)
+            reader = ChunkReader(self.readChunks(sock))
+            tar = tarfile.open(fileobj=reader, mode="r|")
+            for member in tar:
+                target = os.path.realpath(os.path.join(root, member.name))
+                if not (member.isfile() or member.isdir()) or os.path.isabs(member.name) or not target.startswith(root + os.sep):
+                    self.log("Archive: skip unsafe entry \"" + member.name + "\"")
+                    skipped += 1
+                    continue
+                tar.extract(member, root)
+                if member.isfile(): files += 1
+            tar.close()
+        except tarfile.TarError as e:
+            raise FtpClientException("Bad archive of " + remote_dir + ": " + str(e))
+        finally:
+            sock.close()
+        response = self.finishTransfer()
+        if response["code"] != 226: raise FtpClientException("Transfer of archive of " + remote_dir + " failed")
+        self.log("Received: archive of \"%s\": %d files extracted into \"%s\", %d entries skipped, %d bytes" % (remote_dir, files, local_dir, skipped, reader.received))
+        return files
+    ###############################################################
+    # Upload local file [local] as remote file [filename] (same name by default) in binary mode.
+    # File is appended to remote one if [append]. In MODE Z data is compressed while it is sent
+    def store(self, local, filename=None, append=False):
+        filename = filename or os.path.basename(local)
+        self.binary()
+        sock, response = self.openTransfer(("appe " if append else "stor ") + filename)
+        size = 0
+        try:
+            if response["code"] != 150 and response["code"] != 125:
+                raise FtpClientException("Server rejected upload of " + filename)
+            compressor = zlib.compressobj() if self.transfer_mode == "Z" else None
+            with open(local, "rb") as f:
+                chunk = f.read(65536)
+                while chunk:
+                    size += len(chunk)
+                    sock.sendall(compressor.compress(chunk) if compressor != None else chunk)
+                    chunk = f.read(65536)
+            if compressor != None: sock.sendall(compressor.flush())
+        finally:
+            sock.close()
+        response = self.finishTransfer()
+        if response["code"] != 226: raise FtpClientException("Upload of " + local + " failed")
+        self.log("Sent: file: \"" + local + "\" " + str(size) + " bytes")
+    ###############################################################
+    # Return True if local file [local] is the same as remote [filename] (same size, not older)
+    def isUnchanged(self, filename, local, remote_size, remote_mtime):
+        if remote_size == None or remote_mtime == None or not os.path.isfile(local): return False
+        st = os.stat(local)
+        return st.st_size == remote_size and int(st.st_mtime) >= remote_mtime
+    ###############################################################
+    # Download remote file [filename] only if it differs from local copy (checked with SIZE and MDTM).
+    # Return True if file was downloaded
+    def fetch(self, filename, local=None):
+        local = local or os.path.basename(filename)
+        remote_size, remote_mtime = self.size(filename), self.mdtm(filename)
+        if self.isUnchanged(filename, local, remote_size, remote_mtime):
+            self.log("Skip: \"" + filename + "\" is not changed")
+            return False
+        self.retrieve(filename, local, remote_mtime)
+        return True
+    ###############################################################
+    # Download manifest of remote tree [remote_dir] (SITE MANIFEST). Return (algorithm, root, entries),
+    # root: server path of the tree, entries: server path of file -> (size, mtime, digest)
+    def manifest(self, remote_dir):
+        sock, response = self.openTransfer("site manifest " + remote_dir)
+        try:
+            if response["code"] != 150 and response["code"] != 125:
+                raise FtpClientException("Server rejected SITE MANIFEST " + remote_dir)
+            data = "".join(self.readChunks(sock))
+        finally:
+            sock.close()
+        response = self.finishTransfer()
+        if response["code"] != 226: raise FtpClientException("Transfer of manifest failed")
+        self.log("Received: manifest of \"" + remote_dir + "\" " + str(len(data)) + " bytes")
+        return self.parseManifest(data)
+    ###############################################################
+    # Parse manifest text [data]. Return (algorithm, root, entries)
+    def parseManifest(self, data):
+        algo, root, entries = None, "/", {}
+        for line in data.splitlines():
+            if line.startswith("# manifest "):
+                algo, root = line.split(" ", 3)[2:]
+                continue
+            fields = line.split(" ", 3)
+            if len(fields) != 4 or not fields[0].isdigit(): continue
+            entries[fields[3]] = (int(fields[0]), int(fields[1]), fields[2])
+        return algo, root, entries
+    ###############################################################
+    # Return local path of manifest entry [vpath] of remote tree [root] mirrored into folder [local_dir]
+    # or None if entry is not inside the tree or its path leaves the folder
+    def localPath(self, local_dir, root, vpath):
+        if root != "/" and not vpath.startswith(root.rstrip("/") + "/"): return None
+        base = os.path.realpath(local_dir)
+        local = os.path.realpath(os.path.join(base, *vpath[len(root):].lstrip("/").split("/")))
+        return local if local.startswith(base + os.sep) else None
+    ###############################################################
+    # Check if manifest entries [old] and [new] (size, mtime, digest) describe the same file.
+    # Digests are compared only when both are known ("-" means digest was not computed yet)
+    def sameEntry(self, old, new):
+        if old == None or old[:2] != new[:2]: return False
+        return old[2] == "-" or new[2] == "-" or old[2] == new[2]
+    ###############################################################
+    # Mirror remote tree [remote_dir] into local folder [local_dir]. Manifest of the tree is compared
+    # with manifest of previous sync (stored in local folder), so only changed files are downloaded
+    # and files removed on server are removed locally. Entries with paths leaving the folder are skipped.
+    # Return (downloaded, removed) numbers
+    def sync(self, remote_dir, local_dir):
+        algo, root, entries = self.manifest(remote_dir)
+        stored = os.path.join(local_dir, MANIFEST_FILE)
+        previous = {}
+        if os.path.isfile(stored):
+            with open(stored, "rb") as f:
+                previous = self.parseManifest(f.read())[2]
+        # State of local folder: manifest entries that are synced
+        synced = dict(previous)
+        downloaded, removed = 0, 0
+        try:
+            for vpath in sorted(entries):
+                local = self.localPath(local_dir, root, vpath)
+                if local == None:
+                    self.log("Sync: skip unsafe entry \"" + vpath + "\"")
+                    continue
+                size, mtime, digest = entries[vpath]
+                # Not changed since last sync and local copy is in place
+                if self.sameEntry(previous.get(vpath), entries[vpath]) and os.path.isfile(local) and os.path.getsize(local) == size: continue
+                if not os.path.isdir(os.path.dirname(local)): os.makedirs(os.path.dirname(local))
+                # Changed file that exists locally: only changed parts are downloaded
+                if not os.path.isfile(local) or not self.delta(vpath, local, mtime): self.retrieve(vpath, local, mtime)
+                synced[vpath] = entries[vpath]
+                downloaded += 1
+            for vpath in [p for p in previous if p not in entries]:
+                local = self.localPath(local_dir, root, vpath)
+                del synced[vpath]
+                if local == None:
+                    self.log("Sync: skip unsafe entry \"" + vpath + "\"")
+                    continue
+                if os.path.isfile(local): os.remove(local)
+                removed += 1
+        finally:
+            # Files synced so far are not downloaded again by next sync
+            if not os.path.isdir(local_dir): os.makedirs(local_dir)
+            with open(stored, "wb") as f:
+                f.write("# manifest %s %s\n" % (algo, root))
+                for vpath in sorted(synced):
+                    f.write("%d %d %s %s\n" % (synced[vpath] + (vpath, )))
+        self.log("Sync \"%s\" -> \"%s\": %d files, %d downloaded, %d removed" % (remote_dir, local_dir, len(entries), downloaded, removed))
+        return downloaded, removed
 ###############################################################        
 # Main function
 def main():
@@ -465,11 +980,58 @@ def main():
             ftp.login(user_login, user_pass)
             # String for user command
             command = ""
+            # User asked for ASCII type (TYPE A): files are not switched to binary type
+            ascii_type = False
             while not command.startswith("quit"):
                 # Get command from user
-                command = str(raw_input(">")).strip().lower()
+                line = str(raw_input(">")).strip()
+                command = line.lower()
                 # Check if command not empty
                 if len(command) == 0: continue
+                # Local command: compare downloaded file with remote one
+                if command.startswith("verify "):
+                    ftp.verify(line[7:].strip())
+                    continue
+                # Local command: upload file
+                if command.startswith("put "):
+                    ftp.store(line[4:].strip())
+                    continue
+                # Local command: download file if it was changed
+                if command.startswith("fetch "):
+                    ftp.fetch(line[6:].strip())
+                    continue
+                # Local command: update local copy of file with delta transfer
+                if command.startswith("delta "):
+                    ftp.delta(line[6:].strip())
+                    continue
+                # Local command: download folder as one archive (archive <remote folder> [local folder])
+                if command.startswith("archive "):
+                    params = line[8:].split()
+                    ftp.archive(params[0], params[1] if len(params) > 1 else os.path.basename(params[0].rstrip("/")) or ".")
+                    continue
+                # LIST and RETR without PASV/PORT: data connection is opened (or prepared one is used) automatically
+                if (command == "list" or command.startswith("list ") or command.startswith("retr ")) and not ftp.pasive_mode and not ftp.active_mode:
+                    if command.startswith("retr "): ftp.retrieve(line[5:].strip())
+                    else: ftp.listing(line[4:].strip())
+                    continue
+                # STOR/APPE of local file: data connection is opened (or prepared one is used) and file is sent by client.
+                # Data connection of PASV/PORT is not used: client sends nothing over it
+                if command.startswith("stor ") or command.startswith("appe "):
+                    if ftp.pasive_mode or ftp.active_mode: ftp.log("ERROR: STOR/APPE open data connection themselves, use \"put <file>\" without PASV/PORT")
+                    else: ftp.store(line[5:].strip(), append=command.startswith("appe "))
+                    continue
+                # Local command: socket options preset of new connections (profile DEFAULT|LAN|WAN)
+                if command.startswith("profile "):
+                    ftp.setProfile(line[8:].strip())
+                    continue
+                # Local command: mirror remote folder (sync <remote folder> [local folder])
+                if command.startswith("sync "):
+                    params = line[5:].split()
+                    ftp.sync(params[0], params[1] if len(params) > 1 else os.path.basename(params[0].rstrip("/")) or ".")
+                    continue
+                if command.startswith("type "): ascii_type = command[5:].strip().startswith("a")
+                # RETR over data connection opened with PASV/PORT: file is sent in binary type
+                if command.startswith("retr ") and not ascii_type: ftp.binary()
                 # Send command to ftp server
                 ftp.sendCommand(command)
                 # Receive answer from the server
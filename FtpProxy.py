@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+import sys        # Using for retrive and parse command arguments
+import socket     # Socket package, using for handle TCP connections
+import threading  # Every direction of every proxied connection has own reader and writer threads
+import collections # Queue of data in flight
+import random     # Jitter
+import time       # Delivery times
+import re         # Rewrite PASV/EPSV/PORT/EPRT
+###############################################################
+CRLF = '\r\n'     # End of line separator using in FTP protocol
+SEGMENT = 16384   # Max bytes read at once (bigger reads would make timing coarse)
+# Link conditions used when not given on command line
+DEFAULT_CONDITIONS = {"latency" : 0.0, "jitter" : 0.0, "bandwidth" : 0, "burst" : 65536, "window" : 4 * 1024 * 1024}
+###############################################################
+# Show usage format. If we run script without apropriate arguments then script will show up usage info
+def print_usage():
+    print("<listen port> <server host/ip> <server port> [latency=ms] [jitter=ms] [bandwidth=bytes/s] [burst=bytes] [window=bytes]")
+    print("sizes accept K/M/G suffix, for example: 2121 127.0.0.1 21 latency=40 jitter=5 bandwidth=10M burst=256K")
+###############################################################
+# Base proxy exception class
+class FtpProxyException(Exception):
+    # Constructor: accept error message
+    def __init__(self, message):
+        super(FtpProxyException, self).__init__(message)
+###############################################################
+# Parse "key=value" arguments into link conditions. Latency and jitter are given in milliseconds (one way),
+# bandwidth in bytes per second (0 = not limited), burst and window in bytes
+def parse_conditions(args):
+    conditions = dict(DEFAULT_CONDITIONS)
+    units = {"K" : 1024, "M" : 1024 * 1024, "G" : 1024 * 1024 * 1024}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or key not in conditions: raise FtpProxyException("Unknown link condition " + arg)
+        try:
+            if key in ("latency", "jitter"):
+                conditions[key] = float(value) / 1000
+            else:
+                value = value.upper()
+                conditions[key] = int(float(value[:-1]) * units[value[-1]]) if value[-1:] in units else int(value)
+        except (ValueError, KeyError):
+            raise FtpProxyException("Bad value of link condition " + arg)
+    return conditions
+###############################################################
+# Bandwidth of one direction of the link, shared by all connections. Token bucket: up to [burst] bytes
+# leave at once, then data flows at [bandwidth] bytes per second (0 = not limited)
+###############################################################
+class Shaper:
+    def __init__(self, bandwidth, burst):
+        self.bandwidth = bandwidth
+        self.burst = max(burst, SEGMENT)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+    ###############################################################
+    # Time when [size] bytes read now leave
+    def depart(self, size):
+        now = time.time()
+        if not self.bandwidth: return now
+        with self.lock:
+            # Refill tokens for time since last departure
+            base = max(now, self.stamp)
+            self.tokens = min(self.burst, self.tokens + (base - self.stamp) * self.bandwidth)
+            self.stamp = base
+            if self.tokens >= size:
+                self.tokens -= size
+                return base
+            # Wait for missing tokens
+            self.stamp = base + (size - self.tokens) / float(self.bandwidth)
+            self.tokens = 0
+            return self.stamp
+###############################################################
+# One direction of a proxied connection. Bytes read from [src] leave when [shaper] allows and are
+# delivered to [dst] after latency (plus random jitter). At most [window] bytes are unacknowledged,
+# like TCP window of the far end (bytes are acknowledged one latency after delivery, so window limits
+# throughput of one connection to window / RTT).
+# [rewrite] (optional) is called with every complete line before it is sent (control connection)
+###############################################################
+class Pipe:
+    def __init__(self, src, dst, conditions, shaper, rewrite=None, done=None):
+        self.src, self.dst = src, dst
+        self.latency = conditions["latency"]
+        self.jitter = conditions["jitter"]
+        self.shaper = shaper
+        self.window = max(conditions["window"], SEGMENT)
+        self.rewrite = rewrite
+        self.done = done
+        # Data in flight: (delivery time, data), None marks end of stream
+        self.queue = collections.deque()
+        # Delivered data not acknowledged yet: (acknowledge time, size)
+        self.acks = collections.deque()
+        self.inflight = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        # Time of last delivery (deliveries are never reordered)
+        self.last = 0
+    ###############################################################
+    def start(self):
+        self.threads = [threading.Thread(target=target) for target in (self.readLoop, self.writeLoop)]
+        for th in self.threads:
+            th.daemon = True
+            th.start()
+    ###############################################################
+    # Time when [size] bytes read now arrive at the other end
+    def deliveryTime(self, size):
+        arrive = self.shaper.depart(size) + self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        self.last = max(self.last, arrive)
+        return self.last
+    ###############################################################
+    # Put [data] in flight (blocks while window is full)
+    def push(self, data):
+        with self.cond:
+            while data and not self.closed:
+                # Release acknowledged data
+                now = time.time()
+                while self.acks and self.acks[0][0] <= now:
+                    self.inflight -= self.acks.popleft()[1]
+                if self.inflight < self.window: break
+                self.cond.wait(self.acks[0][0] - now if self.acks else None)
+            if self.closed: return
+            self.queue.append((self.deliveryTime(len(data)) if data else self.last, data or None))
+            self.inflight += len(data)
+            self.cond.notify_all()
+    ###############################################################
+    def readLoop(self):
+        pending = ''
+        try:
+            while True:
+                data = self.src.recv(SEGMENT)
+                if not data: break
+                if self.rewrite:
+                    # Only complete lines are rewritten and sent
+                    pending += data
+                    lines = pending.split("\n")
+                    pending = lines.pop()
+                    data = "".join(self.rewrite(line + "\n") for line in lines)
+                    if not data: continue
+                self.push(data)
+        except socket.error:
+            pass
+        if pending: self.push(pending)
+        # End of stream is delivered after data in flight
+        self.push('')
+    ###############################################################
+    def writeLoop(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.closed:
+                        self.cond.wait()
+                    # Connection aborted
+                    if not self.queue: break
+                    at, data = self.queue[0]
+                delay = at - time.time()
+                if delay > 0: time.sleep(delay)
+                if data == None: break
+                self.dst.sendall(data)
+                with self.cond:
+                    self.queue.popleft()
+                    self.acks.append((at + self.latency, len(data)))
+                    self.cond.notify_all()
+        except socket.error:
+            # Peer is gone: stop reading the other side as well
+            try:
+                self.src.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+        # Reader waiting for window must not wait for writer any more
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        try:
+            self.dst.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        if self.done: self.done()
+###############################################################
+# Proxied connection: two pipes between client socket and server socket (upload and download
+# direction of [proxy] link). Sockets are closed when both directions are finished
+###############################################################
+class Link:
+    def __init__(self, proxy, client, server, up=None, down=None):
+        self.proxy = proxy
+        self.sockets = (client, server)
+        self.left = 2
+        self.lock = threading.Lock()
+        self.pipes = (Pipe(client, server, proxy.conditions, proxy.shapers[0], up, self.finished),
+                      Pipe(server, client, proxy.conditions, proxy.shapers[1], down, self.finished))
+    ###############################################################
+    def start(self):
+        # Registered and started together, so stop() never sees link without threads
+        with self.proxy.lock:
+            self.proxy.links.add(self)
+            for pipe in self.pipes: pipe.start()
+    ###############################################################
+    def finished(self):
+        with self.lock:
+            self.left -= 1
+            if self.left: return
+        for sock in self.sockets: sock.close()
+        with self.proxy.lock:
+            self.proxy.links.discard(self)
+    ###############################################################
+    # Drop connection at once (data in flight is lost) and wait for its threads
+    def abort(self, timeout):
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for pipe in self.pipes:
+            with pipe.cond:
+                pipe.closed = True
+                pipe.cond.notify_all()
+        for pipe in self.pipes:
+            for th in pipe.threads: th.join(timeout)
+###############################################################
+# Control connection proxy. Data connection addresses in PASV/EPSV replies and PORT/EPRT commands are
+# replaced by addresses of proxy listeners, so data connections pass through the simulated link too
+###############################################################
+class Session:
+    PASV = re.compile(r"(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)")
+    EPSV = re.compile(r"\(\|\|\|(\d+)\|\)")
+    def __init__(self, proxy, client):
+        self.proxy = proxy
+        self.client = client
+        self.server = socket.create_connection((proxy.host, proxy.port), 15)
+        self.server.settimeout(None)
+        self.client.settimeout(None)
+        # Proxy addresses seen by client and server
+        self.client_side = client.getsockname()[0]
+        self.server_side = self.server.getsockname()[0]
+        Link(proxy, client, self.server, self.rewriteCommand, self.rewriteReply).start()
+    ###############################################################
+    # Listen on [ip] for one data connection and connect it to [target]. [passive] is True when client
+    # connects to listener (PASV/EPSV) and False when server does (PORT/EPRT)
+    def dataListener(self, ip, target, passive):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((ip, 0))
+        sock.listen(1)
+        sock.settimeout(30)
+        th = threading.Thread(target=self.acceptData, args=(sock, target, passive))
+        th.daemon = True
+        th.start()
+        return sock.getsockname()[1]
+    ###############################################################
+    def acceptData(self, sock, target, passive):
+        try:
+            conn, addr = sock.accept()
+            other = socket.create_connection(target, 15)
+        except socket.error:
+            return
+        finally:
+            sock.close()
+        conn.settimeout(None)
+        other.settimeout(None)
+        self.proxy.stats["data_connections"] += 1
+        if passive: Link(self.proxy, conn, other).start()
+        else: Link(self.proxy, other, conn).start()
+    ###############################################################
+    # Reply line from server: PASV/EPSV addresses of server are replaced by proxy listeners
+    def rewriteReply(self, line):
+        if line.startswith("227 "):
+            match = Session.PASV.search(line)
+            if match:
+                numbers = [int(n) for n in match.groups()]
+                port = self.dataListener(self.client_side, ("%d.%d.%d.%d" % tuple(numbers[:4]), numbers[4] * 256 + numbers[5]), True)
+                args = ",".join(self.client_side.split(".") + [str(port // 256), str(port % 256)])
+                return line[:match.start()] + args + line[match.end():]
+        elif line.startswith("229 "):
+            match = Session.EPSV.search(line)
+            if match:
+                port = self.dataListener(self.client_side, (self.proxy.host, int(match.group(1))), True)
+                return line[:match.start()] + "(|||%d|)" % port + line[match.end():]
+        return line
+    ###############################################################
+    # Command line from client: PORT/EPRT addresses of client are replaced by proxy listeners
+    def rewriteCommand(self, line):
+        command = line[:5].upper()
+        try:
+            if command == "PORT ":
+                numbers = [int(n) for n in line[5:].strip().split(",")]
+                port = self.dataListener(self.server_side, ("%d.%d.%d.%d" % tuple(numbers[:4]), numbers[4] * 256 + numbers[5]), False)
+                return "PORT " + ",".join(self.server_side.split(".") + [str(port // 256), str(port % 256)]) + CRLF
+            if command == "EPRT ":
+                version, ip, port = line[5:].strip().strip("|").split("|")
+                port = self.dataListener(self.server_side, (ip, int(port)), False)
+                return "EPRT |1|%s|%d|" % (self.server_side, port) + CRLF
+        except (ValueError, socket.error):
+            # Bad arguments are passed as they are, server replies with error
+            pass
+        return line
+###############################################################
+# WAN conditions simulator: accepts FTP clients on [listen_port] and forwards them to server [host]:[port]
+###############################################################
+class FtpProxy:
+    def __init__(self, listen_port, host, port, conditions=None):
+        self.host, self.port = host, int(port)
+        self.conditions = dict(DEFAULT_CONDITIONS)
+        self.conditions.update(conditions or {})
+        # Bandwidth is shared by all connections: upload and download direction
+        self.shapers = [Shaper(self.conditions["bandwidth"], self.conditions["burst"]) for i in range(2)]
+        self.stats = {"sessions" : 0, "data_connections" : 0}
+        # Active proxied connections
+        self.links = set()
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", int(listen_port)))
+        self.sock.listen(16)
+        # Real port (listen port 0 = any free port)
+        self.listen_port = self.sock.getsockname()[1]
+        self.running = False
+    ###############################################################
+    # Start accepting clients in background thread
+    def start(self):
+        self.running = True
+        th = threading.Thread(target=self.serve)
+        th.daemon = True
+        th.start()
+        return self
+    ###############################################################
+    def serve(self):
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                break
+            try:
+                Session(self, conn)
+                self.stats["sessions"] += 1
+            except socket.error as e:
+                print("ERROR: server is not available: " + str(e))
+                conn.close()
+    ###############################################################
+    # Stop accepting clients and drop active connections
+    def stop(self):
+        self.running = False
+        self.sock.close()
+        with self.lock:
+            links = list(self.links)
+        for link in links: link.abort(1)
+###############################################################
+# Main function
+def main():
+    # Receive command line arguments
+    args = sys.argv[1:]
+    if len(args) < 3:
+        print_usage()
+        return None
+    try:
+        proxy = FtpProxy(args[0], args[1], args[2], parse_conditions(args[3:]))
+    except (FtpProxyException, socket.error, ValueError) as e:
+        print("ERROR: " + str(e))
+        return None
+    print("Proxy 127.0.0.1:%d -> %s:%d, %s" % (proxy.listen_port, proxy.host, proxy.port,
+        ", ".join("%s=%s" % item for item in sorted(proxy.conditions.items()))))
+    proxy.start()
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        proxy.stop()
+###############################################################
+# if we use this not as module -> just run main function
+if __name__ == "__main__":
+    main()
+###############################################################
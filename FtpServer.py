@@ -5,7 +5,33 @@ import select     # Select ready socket
 import time       # Get current timestamp
 import datetime   # Get current datetime combined with timestamp (using both for gettimestamp() method)
 import threading  # Separate threads for each client
+import thread     # Session threads are started without threading.Thread objects (less memory per session)
 import stat, os   # List of files/dirs
+import collections # Ordered dict for LRU caches
+import posixpath  # Virtual paths always use "/" separator
+import errno      # Error codes for filesystem errors
+import io         # In-memory files
+import hashlib, hmac, binascii # Password hashing
+import signal, json # Worker processes control and metrics exchange
+import subprocess # Start new server process on restart
+import Queue, zlib # Worker pools, CRC32 digests
+import fnmatch    # SITE FIND patterns
+import struct     # Delta transfer records
+import tarfile    # SITE ARCHIVE streams
+try:
+    import fcntl  # Pass listen socket to the new server process (not available on Windows)
+except ImportError:
+    fcntl = None
+# sendfile(2) for binary transfers (Linux only, other systems have different signature)
+libc = None
+if sys.platform.startswith("linux"):
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+        libc.sendfile.restype = ctypes.c_ssize_t
+    except (ImportError, OSError, AttributeError):
+        libc = None
 
 lock = threading.Lock()
 serverStartEvent = threading.Event()
@@ -16,6 +42,34 @@ DEFAULT_PORT  = 21                # Default ftp server port
 CONFIG_FILE   = "ftpserverd.conf" # Server configuration file
 ACCOUNTS_FILE = "users.db"        # Default filename for file that store user logins/passwords
 ROOT_FOLDER   = "Public"          # Default server folder. (clients work with this folder as root folder)
+CHUNK_SIZE    = 65536             # Size of blocks used for file transfers
+HASH_INDEX_FILE = "hash.idx"      # File where computed file digests are kept between server restarts
+QUOTA_INDEX_FILE = "quota.idx"    # File where owners and sizes of uploaded files are kept (quota usage)
+DELTA_MAX_BLOCKS = 1 << 20        # Max number of block signatures client may send with SITE DELTA
+# Files of these types are already compressed: in MODE Z they are sent as stored deflate blocks (level 0)
+COMPRESSED_EXTENSIONS = frozenset([".gz", ".tgz", ".bz2", ".xz", ".zip", ".7z", ".rar", ".jpg", ".jpeg", ".png", ".gif",
+    ".mp3", ".mp4", ".avi", ".mkv", ".docx", ".xlsx", ".pptx", ".pdf"])
+# Replies that never change. Keep them encoded (with CRLF appended) once, so sending
+# one of them is a dict lookup instead of a string concatenation on every command
+FIXED_REPLIES = [
+    "220 Welcome message",
+    "221 Goodbye, closing seesion.",
+    "226 Transfer complete.",
+    "230 User logged in, proceed.",
+    "331 User name okay, need password.",
+    "150 Opening ASCII mode data connection.",
+    "150 Opening BINARY mode data connection.",
+    "200 PORT command successful.",
+    "200 EPRT command successful.",
+    "202 Not implemented",
+    "501 Syntax error in parameters or arguments.",
+    "503 Bad sequence of commands.",
+    "530 Authentification required.",
+    "530 Bad password.",
+    "530 Invalid user name.",
+    "530 Not logged in.",
+]
+ENCODED_REPLIES = dict((reply, reply + CRLF) for reply in FIXED_REPLIES)
 ###############################################################
 # Show usage format. If we run script without apropriate arguments then script will show up usage info
 def print_usage():
@@ -30,77 +84,1863 @@ class FtpServerException(Exception):
     # Overload __str__ method to convert FtpServerException objects to string, with allow us to use print function
     def __str__(self):
         return self.message
+###############################################################
+# Control channel reply writer. Replies are queued and written with one sendall() call,
+# so a batch of pipelined commands is answered with a single write. One writer per session (slots)
+###############################################################
+class ReplyWriter(object):
+    __slots__ = ("sock", "log", "name", "pending", "lock")
+    # Ctor accepted control socket, logger function and client name (used in log records)
+    def __init__(self, sock, loger, name):
+        self.sock = sock
+        self.log = loger
+        self.name = name
+        # Replies waiting for flush
+        self.pending = []
+        # Replies can be sent from different threads
+        self.lock = threading.Lock()
+    ###############################################################
+    # Queue reply. Preliminary replies (1xx) are flushed at once: client waits for them before data transfer
+    def write(self, reply):
+        with self.lock:
+            self.pending.append(reply)
+        if reply.startswith("1"): self.flush()
+    ###############################################################
+    # Write all queued replies to the socket
+    def flush(self):
+        with self.lock:
+            if not self.pending: return
+            replies, self.pending = self.pending, []
+            if self.sock == None: return
+            # Use precomputed reply when possible
+            data = "".join([ENCODED_REPLIES.get(r) or r + CRLF for r in replies])
+            # sendall() guarantees full write (send() may write only part of the buffer)
+            self.sock.sendall(data)
+        # One log record for the whole batch
+        self.log("Sent to " + self.name + ": " + ("\n" + "Sent to " + self.name + ": ").join(replies))
+    ###############################################################
+    # Drop socket reference (connection closed)
+    def close(self):
+        with self.lock:
+            self.sock = None
+            self.pending = []
+###############################################################
+# Deflate stream over data connection (MODE Z). Has sendall() like a socket, so transfer code
+# works with both. Data is compressed by blocks: memory used does not depend on transfer size
+###############################################################
+class DeflateStream:
+    def __init__(self, sock, level):
+        self.sock = sock
+        self.compressor = zlib.compressobj(level)
+        # Bytes before and after compression
+        self.bytes_in, self.bytes_out = 0, 0
+    ###############################################################
+    def sendall(self, data):
+        self.bytes_in += len(data)
+        # zlib does not accept memoryview (slices of cached content)
+        if isinstance(data, memoryview): data = data.tobytes()
+        self._send(self.compressor.compress(data))
+    ###############################################################
+    # Flush compressor and write end of deflate stream
+    def finish(self):
+        self._send(self.compressor.flush())
+    ###############################################################
+    def _send(self, data):
+        if not data: return
+        self.bytes_out += len(data)
+        self.sock.sendall(data)
+###############################################################
+# ASCII mode (TYPE A) stream. Converts line endings to CRLF (network form) by blocks:
+# existing CRLF pairs are kept, also when CR and LF come in different blocks
+###############################################################
+class AsciiStream:
+    def __init__(self, stream):
+        self.stream = stream
+        # Last block ended with CR
+        self.cr = False
+    ###############################################################
+    def sendall(self, data):
+        if isinstance(data, memoryview): data = data.tobytes()
+        if not data: return
+        # LF that completes CRLF started in previous block
+        prefix = ""
+        if self.cr and data[0] == "\n":
+            prefix, data = "\n", data[1:]
+        self.cr = data.endswith("\r")
+        self.stream.sendall(prefix + data.replace("\r\n", "\n").replace("\n", "\r\n"))
+###############################################################
+# Archive stream (SITE ARCHIVE). File object tarfile writes to: data goes to data connection
+# [stream] at once, progress is counted in [transfer]
+###############################################################
+class ArchiveWriter:
+    def __init__(self, stream, transfer):
+        self.stream = stream
+        self.transfer = transfer
+    ###############################################################
+    def write(self, data):
+        self.stream.sendall(data)
+        self.transfer.advance(len(data))
+###############################################################
+# Return True if file object [f] has OS level file descriptor (memory files do not have it)
+def hasRealFile(f):
+    try:
+        f.fileno()
+        return True
+    except (AttributeError, ValueError, IOError):
+        return False
+###############################################################
+# Wait until [sock] is readable (or writable if [writable]) at most [timeout] seconds (None = no limit).
+# Return True if socket is ready. poll() is used where available: select() fails for descriptors
+# above FD_SETSIZE (1024), which are reached with a thousand of sessions
+def wait_socket(sock, timeout, writable=False):
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT if writable else select.POLLIN | select.POLLPRI)
+        return len(poller.poll(None if timeout == None else int(timeout * 1000))) > 0
+    if writable: return len(select.select([], [sock], [], timeout)[1]) > 0
+    _in, _out, _exc = select.select([sock], [], [sock], timeout)
+    return len(_in) > 0
+###############################################################
+# Send [count] bytes of file [f] (from current position) to socket [sock] with sendfile(2),
+# data is copied by kernel. Return number of bytes sent: it is less than [count]
+# when sendfile can not be used for this file, rest should be sent usual way
+###############################################################
+def sendfile(sock, f, count):
+    if libc == None: return 0
+    sent = 0
+    while sent < count:
+        n = libc.sendfile(sock.fileno(), f.fileno(), None, min(count - sent, 1 << 30))
+        if n > 0:
+            sent += n
+            continue
+        # End of file (file truncated while sending)
+        if n == 0: break
+        err = ctypes.get_errno()
+        # Socket with timeout is non-blocking: wait until it can accept more data
+        if err in (errno.EAGAIN, errno.EINTR):
+            wait_socket(sock, sock.gettimeout(), True)
+            continue
+        # File or socket type not supported by sendfile
+        if sent == 0 and err in (errno.EINVAL, errno.ENOSYS): break
+        raise socket.error(err, os.strerror(err))
+    return sent
+###############################################################
+# Delta encoder (SITE DELTA, rsync algorithm). Client sends signatures of blocks of its copy
+# of the file (weak rolling checksum + MD5), encoder finds these blocks in the file and
+# produces records: "B" <first block> <count> (client copies blocks it has) or "L" <length> <data>
+# (literal data). Blocks are first checked at aligned positions (fast path, no per byte work
+# for unchanged parts), rolling checksum is moved byte by byte only through changed regions.
+# Region changed more than [search_limit] bytes is checked block by block only (rolling search
+# in Python is slow, completely different file should not take minutes)
+###############################################################
+class DeltaEncoder:
+    MOD = 65521
+    SIGNATURE = struct.Struct("!I16s")
+    LITERAL, BLOCKS = struct.Struct("!cI"), struct.Struct("!cII")
+    # Ctor accepted block size, signatures (packed records, one per block of client copy) and
+    # max length of rolling search after last matched block
+    def __init__(self, block_size, signatures, search_limit=1024 * 1024):
+        self.block_size = block_size
+        self.search_limit = search_limit
+        # weak checksum -> [(strong checksum, block number)], last block of client copy may be shorter
+        self.blocks = {}
+        n = len(signatures) // DeltaEncoder.SIGNATURE.size
+        for i in range(n):
+            weak, strong = DeltaEncoder.SIGNATURE.unpack_from(signatures, i * DeltaEncoder.SIGNATURE.size)
+            self.blocks.setdefault(weak, []).append((strong, i))
+        self.count = n
+        # Bytes sent as literal data / found in client copy
+        self.literal, self.matched = 0, 0
+    ###############################################################
+    # Return block number of client copy equal to [data] with weak checksum [weak] (None if not found)
+    def find(self, weak, data):
+        candidates = self.blocks.get(weak)
+        if candidates == None: return None
+        strong = hashlib.md5(data).digest()
+        for s, i in candidates:
+            if s == strong: return i
+        return None
+    ###############################################################
+    # Read file [f] and pass delta records to [emit] (called with strings, records are grouped)
+    def encode(self, f, emit):
+        bs, mod = self.block_size, DeltaEncoder.MOD
+        out, out_size = [], [0]
+        def put(record):
+            out.append(record)
+            out_size[0] += len(record)
+            if out_size[0] >= CHUNK_SIZE:
+                emit("".join(out))
+                del out[:]
+                out_size[0] = 0
+        # Pending run of matched blocks (first, count)
+        run = [None, 0]
+        def block(i):
+            if run[0] != None and run[0] + run[1] == i:
+                run[1] += 1
+                return
+            if run[0] != None: put(DeltaEncoder.BLOCKS.pack("B", run[0], run[1]))
+            run[0], run[1] = i, 1
+        def literal(data):
+            if not data: return
+            if run[0] != None: put(DeltaEncoder.BLOCKS.pack("B", run[0], run[1]))
+            run[0] = None
+            put(DeltaEncoder.LITERAL.pack("L", len(data)) + data)
+            self.literal += len(data)
+        buf, eof = "", False
+        # Position in buffer, start of pending literal data, rolling checksum parts (None -> not computed)
+        pos, start, a, b = 0, 0, None, None
+        # Bytes searched since last matched block
+        unmatched = 0
+        while True:
+            # Keep at least one block (plus one byte for rolling) ahead of position
+            if not eof and len(buf) - pos <= bs:
+                chunk = f.read(max(CHUNK_SIZE * 16, bs * 4))
+                if not chunk: eof = True
+                # Drop processed data (pending literal is kept)
+                buf = buf[start:] + chunk
+                pos, start = pos - start, 0
+                continue
+            if len(buf) - pos < bs: break
+            if a == None:
+                weak = zlib.adler32(buffer(buf, pos, bs)) & 0xffffffff
+                a, b = weak & 0xffff, weak >> 16
+            weak = (b << 16) | a
+            # Block data is sliced only when weak checksum is known
+            i = self.find(weak, buf[pos:pos + bs]) if weak in self.blocks else None
+            if i != None:
+                literal(buf[start:pos])
+                block(i)
+                self.matched += bs
+                pos += bs
+                start, a, unmatched = pos, None, 0
+                continue
+            # Long changed region: next block is checked without rolling search
+            if unmatched >= self.search_limit:
+                pos += bs
+                a = None
+            # Roll checksum one byte forward
+            elif pos + bs >= len(buf):
+                pos += 1
+                a = None
+            else:
+                old, new = ord(buf[pos]), ord(buf[pos + bs])
+                a = (a - old + new) % mod
+                b = (b - bs * old + a - 1) % mod
+                pos += 1
+                unmatched += 1
+            # Long literal is sent by parts
+            if pos - start >= CHUNK_SIZE:
+                literal(buf[start:pos])
+                start = pos
+        # Tail shorter than block may be the last block of client copy
+        tail = buf[pos:]
+        i = self.find(zlib.adler32(tail) & 0xffffffff, tail) if tail else None
+        if i != None:
+            literal(buf[start:pos])
+            block(i)
+            self.matched += len(tail)
+        else:
+            literal(buf[start:])
+        if run[0] != None: put(DeltaEncoder.BLOCKS.pack("B", run[0], run[1]))
+        if out: emit("".join(out))
+###############################################################
+# Socket options profile (service shared by all sessions). Presets: DEFAULT (options of OS),
+# LAN (no Nagle delay on control connection, corked data connections, keepalive) and WAN
+# (LAN plus big data buffers for links with high bandwidth-delay product).
+# Each option of preset can be changed in config
+###############################################################
+class SocketProfile:
+    PRESETS = {
+        "DEFAULT" : {"tcp_nodelay" : False, "tcp_keepalive" : False, "tcp_cork" : False, "data_sndbuf" : 0, "data_rcvbuf" : 0, "reuse_address" : False},
+        "LAN" : {"tcp_nodelay" : True, "tcp_keepalive" : True, "tcp_cork" : True, "data_sndbuf" : 0, "data_rcvbuf" : 0, "reuse_address" : True},
+        "WAN" : {"tcp_nodelay" : True, "tcp_keepalive" : True, "tcp_cork" : True, "data_sndbuf" : 4 * 1024 * 1024,
+            "data_rcvbuf" : 4 * 1024 * 1024, "reuse_address" : True}}
+    # Ctor accepted preset name, options overriding preset and keepalive idle time (seconds)
+    def __init__(self, name, options=None, keepalive_idle=60):
+        if name not in SocketProfile.PRESETS: raise ValueError(name)
+        self.name = name
+        self.options = dict(SocketProfile.PRESETS[name])
+        self.options.update(options or {})
+        self.keepalive_idle = keepalive_idle
+        # Options not supported by system are skipped
+        self.cork_option = getattr(socket, "TCP_CORK", None)
+    ###############################################################
+    # Control connection [sock]: replies are sent at once (no Nagle delay), dead peers are detected
+    def control(self, sock):
+        if self.options["tcp_nodelay"]: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.options["tcp_keepalive"]:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive_idle)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, self.keepalive_idle // 6))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 6)
+    ###############################################################
+    # Data socket [sock] (listen socket in passive mode, accepted sockets inherit buffers).
+    # Buffers are set before connect/listen, so TCP window scale is negotiated for them
+    def data(self, sock):
+        if self.options["data_sndbuf"]: sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.options["data_sndbuf"])
+        if self.options["data_rcvbuf"]: sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.options["data_rcvbuf"])
+    ###############################################################
+    # Cork ([on] = True) or uncork connected data socket [sock]. While socket is corked, small writes
+    # (headers, listing lines, archive headers) are sent together with following data in full segments
+    def cork(self, sock, on):
+        if not self.options["tcp_cork"] or self.cork_option == None: return
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, self.cork_option, 1 if on else 0)
+        except socket.error:
+            pass
+    ###############################################################
+    # Server listen socket [sock]
+    def listen(self, sock):
+        if self.options["reuse_address"]: sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+###############################################################
+# Content cache. Keeps content of small files in memory (LRU, bounded by total bytes).
+# Entries are validated by inode, size and modification time, so changed files are reloaded
+###############################################################
+class ContentCache:
+    # Ctor accepted max total size of cached data and max size of one cached file (bytes)
+    def __init__(self, max_bytes, max_file_size):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        # path -> ((inode, size, mtime), data). Last item is most recently used
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+    ###############################################################
+    # Return cached content of file [path] of filesystem [vfs] (with stat result [st])
+    # or None if file should not be cached
+    def get(self, vfs, path, st):
+        if st.st_size > self.max_file_size or st.st_size > self.max_bytes: return None
+        signature = (st.st_ino, st.st_size, st.st_mtime)
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry != None and entry[0] == signature:
+                # Move to the end (most recently used)
+                self.entries[path] = entry
+                self.hits += 1
+                return entry[1]
+            if entry != None: self.size -= len(entry[1])
+            self.misses += 1
+        # Read file outside of lock, so other sessions are not blocked by disk
+        with vfs.open_read(path) as f:
+            data = f.read()
+        # File changed while reading -> serve what we read but dont cache it
+        if len(data) != st.st_size: return data
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old != None: self.size -= len(old[1])
+            self.entries[path] = (signature, data)
+            self.size += len(data)
+            # Evict least recently used files
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return data
+###############################################################
+# Page cache hints for big files (posix_fadvise): kernel reads ahead while file is sent and
+# pages already sent are dropped, so big sequential transfers do not evict hot small files.
+# Optionally counts page cache residency (mincore) of small files read from disk
+###############################################################
+class PageCache:
+    FADV_SEQUENTIAL, FADV_WILLNEED, FADV_DONTNEED = 2, 3, 4
+    PROT_READ, MAP_SHARED = 1, 1
+    # Read ahead / drop behind step
+    WINDOW = 4 * 1024 * 1024
+    # Ctor accepted min size of file to advise and page cache statistics switch
+    def __init__(self, min_size, stats=False):
+        self.min_size = min_size
+        self.stats = stats
+        # Pages of small files found in page cache / read from disk
+        self.hits, self.misses = 0, 0
+        self.advised = 0
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.fadvise, self.mincore = None, None
+        if libc == None: return
+        try:
+            self.fadvise = libc.posix_fadvise64
+            self.fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+        except AttributeError:
+            self.fadvise = None
+        try:
+            libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int64]
+            libc.mmap.restype = ctypes.c_void_p
+            libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+            libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+            self.mincore = libc.mincore
+        except AttributeError:
+            self.mincore = None
+    ###############################################################
+    # File [f] of [size] bytes is going to be read sequentially. Return True if file is advised
+    # (then advance() should be called while file is read)
+    def open(self, f, size):
+        if self.fadvise == None or size < self.min_size: return False
+        fd = f.fileno()
+        self.fadvise(fd, 0, 0, PageCache.FADV_SEQUENTIAL)
+        self.fadvise(fd, 0, PageCache.WINDOW, PageCache.FADV_WILLNEED)
+        self.advised += 1
+        return True
+    ###############################################################
+    # Data of advised file [f] was sent up to [pos]: drop it from page cache, read next window
+    def advance(self, f, pos):
+        fd = f.fileno()
+        self.fadvise(fd, 0, pos, PageCache.FADV_DONTNEED)
+        self.fadvise(fd, pos, PageCache.WINDOW, PageCache.FADV_WILLNEED)
+    ###############################################################
+    # Count how many pages of small file [f] of [size] bytes are in page cache (before it is read)
+    def sample(self, f, size):
+        if not self.stats or self.mincore == None or size == 0 or size >= self.min_size: return
+        addr = libc.mmap(None, size, PageCache.PROT_READ, PageCache.MAP_SHARED, f.fileno(), 0)
+        if addr == None or addr == ctypes.c_void_p(-1).value: return
+        try:
+            pages = (size + self.page_size - 1) // self.page_size
+            vec = (ctypes.c_ubyte * pages)()
+            if self.mincore(addr, size, vec) != 0: return
+            resident = sum([b & 1 for b in vec])
+            self.hits += resident
+            self.misses += pages - resident
+        finally:
+            libc.munmap(addr, size)
+###############################################################
+# Shared reads of one file. Concurrent downloads of the same file (path, inode, size, mtime)
+# use one SharedReader: block needed by the fastest session is read from disk once and kept
+# in a bounded ring, other sessions take it from there at their own pace. Session that falls
+# behind the ring reads the rest of the file itself
+###############################################################
+class SharedReader:
+    # Ctor accepted filesystem backend, virtual path, block size, number of blocks in ring and page cache hints service
+    def __init__(self, vfs, vpath, size, block_size, ring_blocks, page_cache=None):
+        self.vfs = vfs
+        self.vpath = vpath
+        self.size = size
+        self.block_size = block_size
+        self.ring_blocks = ring_blocks
+        self.page_cache = page_cache
+        self.f = None
+        # Page cache hints are given for shared file, position where page cache was advised last time
+        self.advised, self.mark = False, 0
+        # block number -> data, first block still in ring, number of blocks read from disk
+        self.blocks = {}
+        self.base, self.next = 0, 0
+        self.eof = False
+        # Some session is reading next block (others wait for it)
+        self.reading = False
+        # Read error of the file (raised in every session that still needs next blocks)
+        self.error = None
+        self.cond = threading.Condition()
+        # Sessions using this reader
+        self.users = 0
+        self.disk_reads, self.ring_hits = 0, 0
+    ###############################################################
+    # Return block number [i] ("" at end of file) or None if block is no longer in ring.
+    # Read error of the file is raised so that transfer is not reported complete
+    def get(self, i):
+        with self.cond:
+            while True:
+                if i in self.blocks:
+                    self.ring_hits += 1
+                    return self.blocks[i]
+                if i < self.base: return None
+                if self.error != None: raise self.error
+                if self.eof: return ""
+                if not self.reading: break
+                self.cond.wait()
+            # This session reads next block for everybody
+            self.reading = True
+        data = ""
+        try:
+            if self.f == None:
+                self.f = self.vfs.open_read(self.vpath)
+                self.advised = self.page_cache != None and hasRealFile(self.f) and self.page_cache.open(self.f, self.size)
+            data = self.f.read(self.block_size)
+            # Ring keeps data, page cache copy is not needed
+            pos = (self.next + 1) * self.block_size
+            if self.advised and pos - self.mark >= PageCache.WINDOW:
+                self.page_cache.advance(self.f, pos)
+                self.mark = pos
+        except Exception as e:
+            # Waiting sessions get the same error instead of end of file
+            with self.cond: self.error = e
+            raise
+        finally:
+            with self.cond:
+                self.reading = False
+                if data:
+                    self.blocks[self.next] = data
+                    self.next += 1
+                    self.disk_reads += 1
+                    while self.next - self.base > self.ring_blocks:
+                        del self.blocks[self.base]
+                        self.base += 1
+                if len(data) < self.block_size and self.error == None: self.eof = True
+                self.cond.notify_all()
+        return data if i < self.next else ""
+    ###############################################################
+    def close(self):
+        if self.f != None: self.f.close()
+        self.blocks = {}
+###############################################################
+# Registry of shared readers (service shared by all sessions)
+###############################################################
+class SharedReads:
+    # Ctor accepted filesystem backend, block size, ring size (bytes), min file size and page cache hints service
+    def __init__(self, vfs, block_size, ring_bytes, min_size, page_cache=None):
+        self.vfs = vfs
+        self.block_size = block_size
+        self.ring_blocks = max(2, ring_bytes // block_size)
+        self.min_size = min_size
+        self.page_cache = page_cache
+        # (path, inode, size, mtime) -> list of readers
+        self.readers = {}
+        self.lock = threading.Lock()
+        # Counters of closed readers (open ones are added in stats())
+        self.disk_reads, self.ring_hits, self.fallbacks = 0, 0, 0
+    ###############################################################
+    # Return reader for file [vpath] with stat result [st] or None if file is too small.
+    # Session joins reader that still has the beginning of the file, otherwise new reader is created
+    def acquire(self, vpath, st):
+        if st.st_size < self.min_size: return None
+        key = (vpath, st.st_ino, st.st_size, st.st_mtime)
+        with self.lock:
+            readers = self.readers.setdefault(key, [])
+            reader = ([r for r in readers if r.base == 0] or [None])[0]
+            if reader == None:
+                reader = SharedReader(self.vfs, vpath, st.st_size, self.block_size, self.ring_blocks, self.page_cache)
+                readers.append(reader)
+            reader.users += 1
+            reader.key = key
+        return reader
+    ###############################################################
+    # Session finished with [reader]
+    def release(self, reader):
+        with self.lock:
+            reader.users -= 1
+            if reader.users > 0: return
+            readers = self.readers.get(reader.key, [])
+            if reader in readers: readers.remove(reader)
+            if not readers: self.readers.pop(reader.key, None)
+            self.disk_reads += reader.disk_reads
+            self.ring_hits += reader.ring_hits
+        reader.close()
+    ###############################################################
+    # Return metrics: blocks read from disk, blocks taken from ring by other sessions, fallbacks to own reads
+    def stats(self):
+        with self.lock:
+            active = [r for readers in self.readers.values() for r in readers]
+            return {"shared_read_disk_blocks" : self.disk_reads + sum([r.disk_reads for r in active]),
+                "shared_read_ring_hits" : self.ring_hits + sum([r.ring_hits for r in active]),
+                "shared_read_fallbacks" : self.fallbacks, "shared_readers" : len(active)}
+###############################################################
+# Virtual filesystem backends. Command handlers work with canonical virtual paths
+# ("/dir/file") and never touch real files directly. Every backend implements:
+#   list(vpath) -> list of names, stat(vpath) -> os.stat_result,
+#   open_read(vpath) / open_write(vpath, append) -> file object,
+#   rename(vsrc, vdst), delete(vpath)
+# Errors are reported with OSError/IOError (errno.ENOENT for missing files)
+###############################################################
+# Local disk backend. Serves files located under [root] folder
+###############################################################
+class LocalFilesystem:
+    # Ctor accepted absolute path to root folder, ttl (seconds) and max size of real path cache
+    def __init__(self, root, ttl=2, max_entries=4096):
+        self.root = os.path.realpath(root)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # virtual path -> (expire time, real path)
+        self.cache = {}
+    ###############################################################
+    # Return real path for virtual path [vpath]. Path is checked with realpath(),
+    # so neither ".." nor symlinks can leave root folder
+    def real(self, vpath):
+        now = time.time()
+        entry = self.cache.get(vpath)
+        if entry != None and entry[0] > now: return entry[1]
+        real = os.path.realpath(os.path.join(self.root, vpath.lstrip("/")))
+        # Jail check: resolved path must be root itself or located under root
+        if real != self.root and not real.startswith(self.root + os.sep):
+            raise OSError(errno.ENOENT, "No such file or directory", vpath)
+        if len(self.cache) >= self.max_entries: self.cache.clear()
+        self.cache[vpath] = (now + self.ttl, real)
+        return real
+    ###############################################################
+    def list(self, vpath):
+        return os.listdir(self.real(vpath))
+    ###############################################################
+    def stat(self, vpath):
+        return os.stat(self.real(vpath))
+    ###############################################################
+    def open_read(self, vpath):
+        return open(self.real(vpath), "rb")
+    ###############################################################
+    def open_write(self, vpath, append=False):
+        return open(self.real(vpath), "ab" if append else "wb")
+    ###############################################################
+    def rename(self, vsrc, vdst):
+        os.rename(self.real(vsrc), self.real(vdst))
+        self.cache.pop(vsrc, None)
+        self.cache.pop(vdst, None)
+    ###############################################################
+    def delete(self, vpath):
+        os.remove(self.real(vpath))
+        self.cache.pop(vpath, None)
+###############################################################
+# In-memory backend. File content is kept in a dict (useful for tests)
+###############################################################
+class MemoryFilesystem:
+    # Written file is stored on close
+    class WriteFile(io.BytesIO):
+        def __init__(self, fs, vpath, data):
+            io.BytesIO.__init__(self)
+            self.fs, self.vpath = fs, vpath
+            self.write(data)
+        def close(self):
+            if not self.closed: self.fs.add(self.vpath, self.getvalue())
+            io.BytesIO.close(self)
+    ###############################################################
+    def __init__(self):
+        # virtual path -> (inode, modification time, content). Content of directory is None
+        self.nodes = {"/" : (1, time.time(), None)}
+        self.next_inode = 2
+        self.lock = threading.Lock()
+    ###############################################################
+    # Create (or replace) file [vpath] with content [data]. Parent directories are created too
+    def add(self, vpath, data=None):
+        with self.lock:
+            parent = posixpath.dirname(vpath)
+            while parent not in self.nodes:
+                self.nodes[parent] = (self.next_inode, time.time(), None)
+                self.next_inode += 1
+                parent = posixpath.dirname(parent)
+            self.nodes[vpath] = (self.next_inode, time.time(), data)
+            self.next_inode += 1
+    ###############################################################
+    # Create directory [vpath]
+    def mkdir(self, vpath):
+        self.add(vpath, None)
+    ###############################################################
+    def _node(self, vpath):
+        node = self.nodes.get(vpath)
+        if node == None: raise OSError(errno.ENOENT, "No such file or directory", vpath)
+        return node
+    ###############################################################
+    def list(self, vpath):
+        with self.lock:
+            if self._node(vpath)[2] != None: raise OSError(errno.ENOTDIR, "Not a directory", vpath)
+            return [posixpath.basename(p) for p in self.nodes if p != "/" and posixpath.dirname(p) == vpath]
+    ###############################################################
+    def stat(self, vpath):
+        inode, mtime, data = self._node(vpath)
+        if data == None: mode, size = stat.S_IFDIR | 0755, 0
+        else: mode, size = stat.S_IFREG | 0644, len(data)
+        # (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime)
+        return os.stat_result((mode, inode, 0, 1, 0, 0, size, mtime, mtime, mtime))
+    ###############################################################
+    def open_read(self, vpath):
+        data = self._node(vpath)[2]
+        if data == None: raise IOError(errno.EISDIR, "Is a directory", vpath)
+        return io.BytesIO(data)
+    ###############################################################
+    def open_write(self, vpath, append=False):
+        data = ''
+        if append and vpath in self.nodes: data = self.nodes[vpath][2] or ''
+        if posixpath.dirname(vpath) not in self.nodes: raise IOError(errno.ENOENT, "No such file or directory", vpath)
+        return MemoryFilesystem.WriteFile(self, vpath, data)
+    ###############################################################
+    def rename(self, vsrc, vdst):
+        with self.lock:
+            node = self._node(vsrc)
+            # Move node and everything below it (directory rename)
+            for p in list(self.nodes):
+                if p == vsrc or p.startswith(vsrc.rstrip("/") + "/"):
+                    self.nodes[vdst + p[len(vsrc):]] = self.nodes.pop(p)
+    ###############################################################
+    def delete(self, vpath):
+        with self.lock:
+            if self._node(vpath)[2] == None: raise OSError(errno.EISDIR, "Is a directory", vpath)
+            del self.nodes[vpath]
+###############################################################
+# Stat cache shared by all sessions. Keeps stat() results of filesystem backend for
+# [ttl] seconds, so frequent freshness checks (SIZE, MDTM) of the same files are cheap
+###############################################################
+class StatCache:
+    # Ctor accepted filesystem backend, ttl (seconds) and max number of cached paths
+    def __init__(self, vfs, ttl=2, max_entries=65536):
+        self.vfs = vfs
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # virtual path -> (expire time, stat result or None)
+        self.entries = {}
+        self.hits, self.misses = 0, 0
+    ###############################################################
+    # Return stat result for [vpath] or None if file does not exist
+    def stat(self, vpath):
+        now = time.time()
+        entry = self.entries.get(vpath)
+        if entry != None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        try:
+            st = self.vfs.stat(vpath)
+        except (OSError, IOError):
+            st = None
+        if len(self.entries) >= self.max_entries: self.entries = {}
+        self.entries[vpath] = (now + self.ttl, st)
+        return st
+    ###############################################################
+    # Forget cached result for [vpath] (file changed by this server)
+    def invalidate(self, vpath):
+        self.entries.pop(vpath, None)
+###############################################################
+# Path resolver. Canonicalizes virtual client paths as strings (no filesystem access)
+# and caches stat() results of the filesystem backend for a short time
+###############################################################
+class PathResolver:
+    # Ctor accepted filesystem backend (or shared StatCache), cache ttl (seconds) and max number of cached paths
+    def __init__(self, vfs, ttl=2, max_entries=256):
+        self.vfs = vfs
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # virtual path -> (expire time, stat result or None)
+        self.cache = {}
+    ###############################################################
+    # Return canonical virtual path for [path] given relative to virtual directory [cur_dir]
+    def virtual(self, cur_dir, path):
+        path = path.replace("\\", "/")
+        if not path.startswith("/"): path = cur_dir + "/" + path
+        # normpath() resolves "." and ".." (and "/.." is "/"), so result never goes above "/"
+        return "/" + posixpath.normpath(path).lstrip("/")
+    ###############################################################
+    # Return stat result for canonical virtual path [vpath] or None if file does not exist
+    def stat(self, vpath):
+        now = time.time()
+        entry = self.cache.get(vpath)
+        if entry != None and entry[0] > now: return entry[1]
+        try:
+            st = self.vfs.stat(vpath)
+        except (OSError, IOError):
+            st = None
+        if len(self.cache) >= self.max_entries: self.cache.clear()
+        self.cache[vpath] = (now + self.ttl, st)
+        return st
+    ###############################################################
+    # Return True if [vpath] is existing directory
+    def isdir(self, vpath):
+        st = self.stat(vpath)
+        return st != None and stat.S_ISDIR(st.st_mode)
+    ###############################################################
+    # Return True if [vpath] is existing regular file
+    def isfile(self, vpath):
+        st = self.stat(vpath)
+        return st != None and stat.S_ISREG(st.st_mode)
+    ###############################################################
+    # Forget cached results (all of them or only for [vpath])
+    def invalidate(self, vpath=None):
+        if vpath == None: self.cache.clear()
+        else: self.cache.pop(vpath, None)
+###############################################################
+# User accounts store. Passwords are kept only as salted PBKDF2 hashes and compared in
+# constant time. Successful and failed checks are cached for a short time (keyed by HMAC
+# of login/password with a random per-process key), so repeated logins don't pay for
+# hashing again. Users file is reloaded when its modification time changes.
+# Users file lines: "<login> <password>" or "<login> pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>"
+###############################################################
+class CredentialStore:
+    # Ctor accepted users file name, number of PBKDF2 iterations for plaintext passwords,
+    # ttl (seconds) of cached check results and min interval (seconds) between users file checks
+    def __init__(self, filename, iterations=10000, ttl=60, check_interval=2, max_cached=4096):
+        self.filename = filename
+        self.iterations = iterations
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.max_cached = max_cached
+        # login -> (salt, iterations, hash)
+        self.records = {}
+        # HMAC(login, password) -> (expire time, check result)
+        self.cache = {}
+        self.secret = os.urandom(32)
+        # Used to equalize time of checks for unknown logins
+        self.dummy = (os.urandom(16), iterations, os.urandom(32))
+        self.mtime, self.checked = None, 0
+        self.lock = threading.Lock()
+        self.load()
+    ###############################################################
+    # Load users file. Records are replaced at once, so sessions never see partially loaded file
+    def load(self):
+        records = {}
+        try:
+            num_row = 1
+            mtime = os.stat(self.filename).st_mtime
+            with open(self.filename) as f_acc:
+                for rec in f_acc:
+                    login, password = rec.split()
+                    records[login.strip()] = self._record(password.strip())
+                    num_row += 1
+        except (IOError, OSError):
+            raise FtpServerException("Cannot open/read accounts file: %s" % (self.filename))
+        except ValueError:
+            raise FtpServerException("Accounts file bad format.\nExpected pairs: <login> <password>.\nError occured at line=%d" % (num_row))
+        with self.lock:
+            self.records = records
+            self.cache = {}
+            self.mtime, self.checked = mtime, time.time()
+    ###############################################################
+    # Convert password field of users file to (salt, iterations, hash)
+    def _record(self, password):
+        if password.startswith("pbkdf2_sha256$"):
+            _, iterations, salt, digest = password.split("$")
+            return (binascii.unhexlify(salt), int(iterations), binascii.unhexlify(digest))
+        salt = os.urandom(16)
+        return (salt, self.iterations, hashlib.pbkdf2_hmac("sha256", password, salt, self.iterations))
+    ###############################################################
+    # Reload users file if it was changed. Return True if file was reloaded
+    def refresh(self):
+        now = time.time()
+        if now - self.checked < self.check_interval: return False
+        self.checked = now
+        try:
+            if os.stat(self.filename).st_mtime == self.mtime: return False
+            self.load()
+        except (OSError, FtpServerException):
+            # Keep serving old records while file is missing or being edited
+            return False
+        return True
+    ###############################################################
+    # Return True if user [login] exists
+    def exists(self, login):
+        self.refresh()
+        return login in self.records
+    ###############################################################
+    # Check [password] of user [login]
+    def verify(self, login, password):
+        self.refresh()
+        key = hmac.new(self.secret, login + "\0" + password, hashlib.sha256).digest()
+        now = time.time()
+        entry = self.cache.get(key)
+        if entry != None and entry[0] > now: return entry[1]
+        salt, iterations, digest = self.records.get(login, self.dummy)
+        result = hmac.compare_digest(hashlib.pbkdf2_hmac("sha256", password, salt, iterations), digest) and login in self.records
+        with self.lock:
+            if len(self.cache) >= self.max_cached: self.cache = {}
+            self.cache[key] = (now + self.ttl, result)
+        return result
+    ###############################################################
+    # Number of loaded accounts
+    def __len__(self):
+        return len(self.records)
+###############################################################
+# Server-wide table of failed logins (brute-force protection).
+# Failures are counted in a sliding time window per remote ip, per username and per
+# (ip, username) pair. Table is split into stripes with own locks, and each stripe keeps
+# at most [max_entries] keys (stale keys are evicted first, then least recently updated)
+###############################################################
+class LoginGuard:
+    # Ctor accepted window size (seconds), max failures per (ip, username) pair, per ip and per username
+    def __init__(self, window=300, max_attempts=3, max_ip_failures=10, max_user_failures=30, stripes=16, max_entries=4096):
+        self.window = window
+        self.max_attempts = max_attempts
+        self.max_ip_failures = max_ip_failures
+        self.max_user_failures = max_user_failures
+        self.max_entries = max_entries
+        # Each stripe is (lock, key -> deque of failure timestamps). Last item is most recently updated
+        self.stripes = [(threading.Lock(), collections.OrderedDict()) for i in range(stripes)]
+    ###############################################################
+    def _stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+    ###############################################################
+    # Return number of failures for [key] within the window
+    def count(self, key):
+        lock, table = self._stripe(key)
+        with lock:
+            times = table.get(key)
+            if times == None: return 0
+            # Drop failures that left the window
+            limit = time.time() - self.window
+            while times and times[0] < limit: times.popleft()
+            if not times: del table[key]
+            return len(times)
+    ###############################################################
+    # Register failure for [key] and return number of failures within the window
+    def _fail(self, key, limit):
+        lock, table = self._stripe(key)
+        now = time.time()
+        with lock:
+            # Bounded deque: we never need to remember more than [limit] failures
+            times = table.pop(key, None) or collections.deque(maxlen=limit)
+            while times and times[0] < now - self.window: times.popleft()
+            times.append(now)
+            table[key] = times
+            if len(table) > self.max_entries: self._evict(table, now)
+            return len(times)
+    ###############################################################
+    # Evict keys without failures in the window, and if table still too big, least recently updated keys
+    def _evict(self, table, now):
+        for key in [k for k, times in table.iteritems() if times[-1] < now - self.window]:
+            del table[key]
+        while len(table) > self.max_entries:
+            table.popitem(last=False)
+    ###############################################################
+    # Register failed login of [login] from [ip]. Return True if session should be closed
+    def fail(self, ip, login):
+        pair = self._fail(("pair", ip, login), self.max_attempts)
+        self._fail(("ip", ip), self.max_ip_failures)
+        self._fail(("user", login), self.max_user_failures)
+        return pair >= self.max_attempts
+    ###############################################################
+    # Successful login clears failures of (ip, username) pair
+    def success(self, ip, login):
+        lock, table = self._stripe(("pair", ip, login))
+        with lock:
+            table.pop(("pair", ip, login), None)
+    ###############################################################
+    # Return True if connections from [ip] should be rejected
+    def ip_blocked(self, ip):
+        return self.count(("ip", ip)) >= self.max_ip_failures
+    ###############################################################
+    # Return True if logins of [login] should be rejected
+    def user_blocked(self, login):
+        return self.count(("user", login)) >= self.max_user_failures
+###############################################################
+# Server metrics. Counters are updated by sessions, gauges are collected on demand
+# from registered providers (functions returning dict name -> value)
+###############################################################
+class Metrics:
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.providers = []
+        self.lock = threading.Lock()
+    ###############################################################
+    # Increase counter [name] by [value]
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+    ###############################################################
+    # Register gauges provider
+    def register(self, provider):
+        self.providers.append(provider)
+    ###############################################################
+    # Return dict with current values of all counters and gauges
+    def snapshot(self):
+        with self.lock:
+            result = dict(self.counters)
+        for provider in self.providers:
+            result.update(provider())
+        return result
+###############################################################
+# Task submitted to worker pool. Owner waits for result with wait()
+###############################################################
+class Task:
+    def __init__(self, fn, args):
+        self.fn, self.args = fn, args
+        self.result, self.error = None, None
+        self.done = threading.Event()
+    ###############################################################
+    # Executed by pool thread
+    def run(self):
+        try:
+            self.result = self.fn(*self.args)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+    ###############################################################
+    # Wait until task finished. Return task result (or reraise its exception)
+    def wait(self):
+        self.done.wait()
+        if self.error != None: raise self.error
+        return self.result
+###############################################################
+# Fixed size pool of daemon threads executing submitted tasks.
+# Threads are started on first use (and started again in forked worker process)
+###############################################################
+class WorkerPool:
+    # Ctor accepted number of threads
+    def __init__(self, size):
+        self.size = size
+        self.queue = Queue.Queue()
+        self.pid = None
+        self.lock = threading.Lock()
+    ###############################################################
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid(): return
+            self.queue = Queue.Queue()
+            for i in range(self.size):
+                th = threading.Thread(target=self._work, args=(self.queue, ))
+                th.daemon = True
+                th.start()
+            self.pid = os.getpid()
+    ###############################################################
+    def _work(self, queue):
+        while True:
+            task = queue.get()
+            if task == None: return
+            task.run()
+    ###############################################################
+    # Run fn(*args) in pool thread. Return Task object
+    def submit(self, fn, *args):
+        if self.pid != os.getpid(): self._start()
+        task = Task(fn, args)
+        self.queue.put(task)
+        return task
+###############################################################
+# Data transfer (LIST, RETR, STOR, APPE) running in transfer pool. Control session
+# can query its progress (STAT) and abort it (ABOR)
+###############################################################
+class Transfer:
+    # Ctor accepted command name, virtual path and size (0 if not known)
+    def __init__(self, command, path, size):
+        self.command = command
+        self.path = path
+        self.size = size
+        # Bytes transferred so far
+        self.bytes = 0
+        self.running = False
+        # ABOR received (thread that finishes transfer answers it)
+        self.aborted = False
+        # Taken out of the pool queue before it started (pool thread skips it)
+        self.cancelled = False
+        # Data sockets used by transfer (shutdown on abort interrupts blocked send/recv/accept)
+        self.sockets = []
+        self.done = threading.Event()
+        # Abort and finish do not overlap: ABOR is answered exactly once
+        self.lock = threading.Lock()
+    ###############################################################
+    # Count [n] transferred bytes. Raise socket.error if transfer aborted
+    def advance(self, n):
+        self.bytes += n
+        if self.aborted: raise socket.error(errno.ECONNABORTED, "Transfer aborted")
+    ###############################################################
+    # Request abort of the transfer. Return False if it is already finished
+    def abort(self):
+        with self.lock:
+            if self.done.is_set(): return False
+            self.aborted = True
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        return True
+    ###############################################################
+    # Mark transfer finished. Return True if it was aborted (ABOR is still to be answered)
+    def finish(self):
+        with self.lock:
+            self.done.set()
+            return self.aborted
+    ###############################################################
+    # Return one line description of transfer state
+    def status(self):
+        state = "in progress" if self.running else "waiting"
+        if self.size: return "%s %s %s: %d of %d bytes" % (self.command, self.path, state, self.bytes, self.size)
+        return "%s %s %s: %d bytes" % (self.command, self.path, state, self.bytes)
+###############################################################
+# Threads that run data transfers of all sessions. Number of threads is limited; when all
+# of them are busy transfers wait in priority queue: listings first, then small files, then big ones
+###############################################################
+class TransferPool:
+    PRIORITY_LIST, PRIORITY_SMALL, PRIORITY_LARGE = 0, 1, 2
+    # Ctor accepted number of threads and max size of "small" file
+    def __init__(self, size, small_size):
+        self.size = size
+        self.small_size = small_size
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+        # Submitted transfers counter (keeps FIFO order within one priority)
+        self.seq = 0
+        # Running transfers, transfers submitted when all threads were busy
+        self.active, self.waits = 0, 0
+    ###############################################################
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid(): return
+            self.queue = Queue.PriorityQueue()
+            for i in range(self.size):
+                th = threading.Thread(target=self._work, args=(self.queue, ))
+                th.daemon = True
+                th.start()
+            self.pid = os.getpid()
+    ###############################################################
+    def _work(self, queue):
+        while True:
+            _, _, transfer, fn, args = queue.get()
+            with self.lock:
+                if transfer.cancelled: continue
+                self.active += 1
+                transfer.running = True
+            try:
+                fn(transfer, *args)
+            finally:
+                with self.lock:
+                    self.active -= 1
+    ###############################################################
+    # Run fn(transfer, *args) in pool thread
+    def submit(self, transfer, fn, *args):
+        if self.pid != os.getpid(): self._start()
+        if transfer.command == "LIST": priority = TransferPool.PRIORITY_LIST
+        # Archive of a tree is big even if its size is not known
+        elif transfer.command != "ARCHIVE" and transfer.size < self.small_size: priority = TransferPool.PRIORITY_SMALL
+        else: priority = TransferPool.PRIORITY_LARGE
+        with self.lock:
+            self.seq += 1
+            if self.active >= self.size: self.waits += 1
+            self.queue.put((priority, self.seq, transfer, fn, args))
+    ###############################################################
+    # Take waiting [transfer] out of the pool. Return False if pool thread already runs it
+    def cancel(self, transfer):
+        with self.lock:
+            if transfer.running: return False
+            transfer.cancelled = True
+            return True
+    ###############################################################
+    # Number of transfers waiting for thread
+    def queued(self):
+        return self.queue.qsize() if self.queue != None else 0
+###############################################################
+# Upload write-behind. Received blocks are queued and written to file by separate thread,
+# so session thread keeps reading the socket while disk is busy. Queue is bounded:
+# when it is full session thread waits (and stops reading the socket)
+###############################################################
+class WriteBehind:
+    # Ctor accepted open file [f] and UploadWriter [uploads] (queue size, durability policy)
+    def __init__(self, f, uploads):
+        self.f = f
+        self.uploads = uploads
+        self.queue = Queue.Queue(uploads.queue_blocks)
+        # First write error (reported to session thread)
+        self.error = None
+        # Bytes written since last fsync
+        self.unsynced = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    ###############################################################
+    # Queue block [data] for writing
+    def write(self, data):
+        if self.error != None: raise self.error
+        try:
+            self.queue.put_nowait(data)
+        except Queue.Full:
+            # Disk is slower than network: wait (backpressure)
+            self.uploads.metrics.incr("upload_queue_waits")
+            self.queue.put(data)
+    ###############################################################
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data == None: return
+            # After error queue is only drained, so writer never blocks
+            if self.error != None: continue
+            try:
+                self.f.write(data)
+                self.unsynced += len(data)
+                if self.uploads.sync_bytes > 0 and self.unsynced >= self.uploads.sync_bytes: self.sync()
+            except (IOError, OSError) as e:
+                self.error = e
+    ###############################################################
+    # Flush written data to disk
+    def sync(self):
+        self.f.flush()
+        if hasRealFile(self.f):
+            os.fsync(self.f.fileno())
+            self.uploads.metrics.incr("upload_fsyncs")
+        self.unsynced = 0
+    ###############################################################
+    # Wait until all queued blocks are written and close file. Raise write error if any
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            if self.error == None and self.uploads.sync_bytes != 0 and self.unsynced > 0: self.sync()
+        except (IOError, OSError) as e:
+            self.error = e
+        finally:
+            self.f.close()
+        if self.error != None: raise self.error
+###############################################################
+# Uploads settings shared by all sessions: write-behind queue size and durability policy
+###############################################################
+class UploadWriter:
+    # Fsync policy values of [sync_bytes]: no fsync, fsync when file is closed, otherwise fsync every [sync_bytes]
+    SYNC_NONE, SYNC_CLOSE = 0, -1
+    # Ctor accepted metrics, max bytes queued for write (per upload) and fsync policy
+    def __init__(self, metrics, queue_bytes, sync_bytes=SYNC_CLOSE):
+        self.metrics = metrics
+        self.queue_blocks = max(1, queue_bytes // CHUNK_SIZE)
+        self.sync_bytes = sync_bytes
+    ###############################################################
+    # Start write-behind for open file [f]
+    def open(self, f):
+        return WriteBehind(f, self)
+###############################################################
+# File digests (HASH, XCRC, XMD5, XSHA* commands). Digests are computed by worker pool
+# with large sequential reads and cached by path + inode + size + mtime. Cache is kept
+# in index file (json lines, appended), so server restart does not require rehashing
+###############################################################
+class DigestCache:
+    # Supported algorithms: name -> hash constructor (CRC32 is computed with zlib)
+    ALGORITHMS = collections.OrderedDict([("SHA-1", hashlib.sha1), ("SHA-256", hashlib.sha256),
+        ("SHA-512", hashlib.sha512), ("MD5", hashlib.md5), ("CRC32", None)])
+    # Ctor accepted filesystem backend, worker pool and index filename (None -> cache is not persistent)
+    def __init__(self, vfs, pool, index_file=None, block_size=1024 * 1024):
+        self.vfs = vfs
+        self.pool = pool
+        self.index_file = index_file
+        self.block_size = block_size
+        # (path, algorithm) -> (signature, hex digest)
+        self.entries = {}
+        # signature key -> running Task (concurrent requests for same file wait for one computation)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+        if index_file != None: self.load()
+    ###############################################################
+    # Load index file. Later records override earlier ones; file is compacted if it has many stale records
+    def load(self):
+        records = 0
+        try:
+            with open(self.index_file) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        self.entries[(rec["path"], rec["algo"])] = (tuple(rec["sig"]), rec["digest"])
+                        records += 1
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except IOError:
+            return
+        if records > 2 * len(self.entries) + 100:
+            with open(self.index_file + ".tmp", "w") as f:
+                for (path, algo), (sig, digest) in self.entries.items():
+                    f.write(json.dumps({"path" : path, "algo" : algo, "sig" : sig, "digest" : digest}) + "\n")
+            os.rename(self.index_file + ".tmp", self.index_file)
+    ###############################################################
+    # Return hex digest of file [vpath] using algorithm [algo]. Blocks until digest computed
+    def digest(self, vpath, algo):
+        st = self.vfs.stat(vpath)
+        sig = (st.st_ino, st.st_size, st.st_mtime)
+        with self.lock:
+            entry = self.entries.get((vpath, algo))
+            if entry != None and entry[0] == sig:
+                self.hits += 1
+                return entry[1]
+            task = self.pending.get((vpath, algo, sig))
+            if task == None:
+                self.misses += 1
+                task = self.pool.submit(self._compute, vpath, algo, sig)
+                self.pending[(vpath, algo, sig)] = task
+        return task.wait()
+    ###############################################################
+    # Return digest of file [vpath] with [size] and [mtime] if it is already computed (None otherwise)
+    def cached(self, vpath, algo, size, mtime):
+        entry = self.entries.get((vpath, algo))
+        if entry == None or tuple(entry[0][1:]) != (size, mtime): return None
+        return entry[1]
+    ###############################################################
+    # Executed by pool thread: read file by large blocks and compute digest
+    def _compute(self, vpath, algo, sig):
+        try:
+            constructor = DigestCache.ALGORITHMS[algo]
+            h, crc = constructor() if constructor != None else None, 0
+            with self.vfs.open_read(vpath) as f:
+                block = f.read(self.block_size)
+                while block:
+                    if h != None: h.update(block)
+                    else: crc = zlib.crc32(block, crc)
+                    block = f.read(self.block_size)
+            digest = h.hexdigest() if h != None else "%08X" % (crc & 0xffffffff)
+            with self.lock:
+                self.entries[(vpath, algo)] = (sig, digest)
+                if self.index_file != None:
+                    with open(self.index_file, "a") as f:
+                        f.write(json.dumps({"path" : vpath, "algo" : algo, "sig" : sig, "digest" : digest}) + "\n")
+            return digest
+        finally:
+            with self.lock:
+                self.pending.pop((vpath, algo, sig), None)
+###############################################################
+# Disk quota usage index. Keeps owner (login of uploader) and size of each uploaded file,
+# and total usage of each user, so quota check is a dict lookup. Index is changed when
+# uploads, deletes and renames complete and every change is appended to index file (json lines).
+# Index file is shared by worker processes: before each check and change records appended
+# by other workers are read (under file lock), so all workers enforce the same usage.
+# Background job loads index at start and then periodically reloads it and checks sizes
+# of indexed files on disk (fixes drift: files changed or removed not by this server)
+###############################################################
+class QuotaIndex:
+    # Ctor accepted filesystem backend, quotas (login -> bytes), quota of other users (0 -> no limit)
+    # and index filename (None -> index is not persistent)
+    def __init__(self, vfs, quotas, default=0, index_file=None):
+        self.vfs = vfs
+        self.quotas = quotas
+        self.default = default
+        self.index_file = index_file
+        # virtual path -> (owner, size)
+        self.entries = {}
+        # owner -> bytes used
+        self.usage = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        # Inode of index file, position up to which it is read and number of records in it
+        self.inode, self.offset, self.records = None, 0, 0
+        # Index loaded (checks wait for it)
+        self.ready = threading.Event()
+        # Number of index entries fixed by reconciliation
+        self.fixes = 0
+        self.pid = None
+    ###############################################################
+    # Start background job (once per process): load index, then reconcile it every [interval] seconds
+    def start(self, loger, interval=300):
+        if self.pid == os.getpid(): return
+        self.pid = os.getpid()
+        th = threading.Thread(target=self._run, args=(loger, interval))
+        th.daemon = True
+        th.start()
+    ###############################################################
+    def _run(self, loger, interval):
+        try:
+            self.load()
+        finally:
+            self.ready.set()
+        loger("Quota index loaded: %d files" % len(self.entries))
+        while True:
+            time.sleep(interval)
+            fixed = self.reconcile()
+            if fixed: loger("Quota index reconciled: %d entries fixed" % fixed)
+    ###############################################################
+    # (Re)load index file. Later records override earlier ones; file is compacted if it has many stale records
+    def load(self):
+        if self.index_file == None: return
+        with self.lock:
+            lock = self._lockFile(True)
+            try:
+                # Read whole file again
+                self.inode = None
+                if not self._catchUp(): return
+                if self.records > 2 * len(self.entries) + 100:
+                    with open(self.index_file + ".tmp", "w") as f:
+                        for path, (owner, size) in self.entries.items():
+                            f.write(json.dumps({"path" : path, "owner" : owner, "size" : size}) + "\n")
+                    os.rename(self.index_file + ".tmp", self.index_file)
+                    st = os.stat(self.index_file)
+                    self.inode, self.offset, self.records = st.st_ino, st.st_size, len(self.entries)
+            finally:
+                self._unlockFile(lock)
+    ###############################################################
+    # Lock index file against other worker processes ([exclusive] for changes). Lock is taken on separate
+    # file: index file itself is replaced by compaction. Return lock to be passed to _unlockFile()
+    def _lockFile(self, exclusive):
+        if self.index_file == None or fcntl == None: return None
+        lock = open(self.index_file + ".lock", "a")
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except:
+            lock.close()
+            raise
+        return lock
+    ###############################################################
+    def _unlockFile(self, lock):
+        if lock == None: return
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        lock.close()
+    ###############################################################
+    # Apply records appended to index file since last read (by this or other worker processes).
+    # File replaced by compaction is read from the beginning. Called with lock held.
+    # Return False if index file can not be read
+    def _catchUp(self):
+        if self.index_file == None: return True
+        try:
+            with open(self.index_file) as f:
+                st = os.fstat(f.fileno())
+                if st.st_ino != self.inode or st.st_size < self.offset:
+                    self.inode, self.offset, self.records = st.st_ino, 0, 0
+                    self.entries = {}
+                    self._recount()
+                if st.st_size == self.offset: return True
+                f.seek(self.offset)
+                while True:
+                    line = f.readline()
+                    # Record being written by other process (not possible under lock) is read next time
+                    if not line.endswith("\n"): break
+                    self.offset += len(line)
+                    try:
+                        rec = json.loads(line)
+                        self._apply(rec["path"], rec["owner"], rec["size"])
+                        self.records += 1
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except IOError:
+            return False
+        return True
+    ###############################################################
+    # Set index entry of [path] (owner None -> file removed) without writing it to index file
+    def _apply(self, path, owner, size):
+        old = self.entries.pop(path, None)
+        if old != None: self.usage[old[0]] -= old[1]
+        if owner == None: return
+        self.entries[path] = (owner, size)
+        self.usage[owner] += size
+    ###############################################################
+    # Compute usage of all users from index entries
+    def _recount(self):
+        self.usage = collections.defaultdict(int)
+        for owner, size in self.entries.values():
+            self.usage[owner] += size
+    ###############################################################
+    # Reload index and compare it with files on disk.
+    # Return number of fixed entries
+    def reconcile(self):
+        self.load()
+        with self.lock:
+            snapshot = self.entries.items()
+        fixed = 0
+        for path, entry in snapshot:
+            # Stat is done without lock, sessions are not blocked by disk
+            try:
+                st = self.vfs.stat(path)
+                size = st.st_size if stat.S_ISREG(st.st_mode) else None
+            except (OSError, IOError):
+                size = None
+            if size == entry[1]: continue
+            with self.lock:
+                lock = self._lockFile(True)
+                try:
+                    self._catchUp()
+                    # Entry changed by session meanwhile -> it is already correct
+                    if self.entries.get(path) != entry: continue
+                    if size == None: self._remove(path)
+                    else: self._set(path, entry[0], size)
+                    fixed += 1
+                finally:
+                    self._unlockFile(lock)
+        self.fixes += fixed
+        return fixed
+    ###############################################################
+    # Change entry and append it to index file. Called with lock and exclusive file lock held
+    def _set(self, path, owner, size):
+        self._apply(path, owner, size)
+        self._journal(path, owner, size)
+    ###############################################################
+    def _remove(self, path):
+        if path not in self.entries: return
+        self._apply(path, None, 0)
+        self._journal(path, None, 0)
+    ###############################################################
+    def _journal(self, path, owner, size):
+        if self.index_file == None: return
+        with open(self.index_file, "a") as f:
+            f.write(json.dumps({"path" : path, "owner" : owner, "size" : size}) + "\n")
+            # Nobody else appends under exclusive lock: own record need not be read back
+            if os.fstat(f.fileno()).st_ino == self.inode:
+                self.offset = f.tell()
+                self.records += 1
+    ###############################################################
+    # Return quota of user [login] in bytes or None if user has no quota
+    def limit(self, login):
+        return self.quotas.get(login, self.default) or None
+    ###############################################################
+    # Return bytes used by [login] (uploads of other worker processes included)
+    def used(self, login):
+        self.ready.wait(10)
+        with self.lock:
+            lock = self._lockFile(False)
+            try:
+                self._catchUp()
+            finally:
+                self._unlockFile(lock)
+            return self.usage.get(login, 0)
+    ###############################################################
+    # Return bytes [login] may still upload (None -> no limit)
+    def remaining(self, login):
+        limit = self.limit(login)
+        if limit == None: return None
+        return limit - self.used(login)
+    ###############################################################
+    # Return size of file [path] if it is charged to [login], otherwise 0
+    def owned(self, path, login):
+        entry = self.entries.get(path)
+        return entry[1] if entry != None and entry[0] == login else 0
+    ###############################################################
+    # Upload of [path] ([size] bytes now) by [login] completed. Appended file keeps its owner
+    def update(self, path, login, size, append=False):
+        with self.lock:
+            lock = self._lockFile(True)
+            try:
+                self._catchUp()
+                old = self.entries.get(path)
+                self._set(path, old[0] if append and old != None else login, size)
+            finally:
+                self._unlockFile(lock)
+    ###############################################################
+    # File [path] deleted
+    def remove(self, path):
+        with self.lock:
+            lock = self._lockFile(True)
+            try:
+                self._catchUp()
+                self._remove(path)
+            finally:
+                self._unlockFile(lock)
+    ###############################################################
+    # File or directory [src] renamed to [dst]
+    def rename(self, src, dst):
+        with self.lock:
+            lock = self._lockFile(True)
+            try:
+                self._catchUp()
+                # Replaced file
+                self._remove(dst)
+                for path in [p for p in self.entries if p == src or p.startswith(src + "/")]:
+                    owner, size = self.entries[path]
+                    self._remove(path)
+                    self._set(dst + path[len(src):], owner, size)
+            finally:
+                self._unlockFile(lock)
+###############################################################
+# In-memory index of the whole tree (service shared by all sessions). Recursive listings
+# (LIST -R, NLST -R, MLSD -R) and SITE FIND are served from it without touching disk.
+# Index is built by background thread and rebuilt every [interval] seconds, directories
+# changed by sessions (uploads, deletes, renames) are rescanned at once
+###############################################################
+class TreeIndex:
+    # Ctor accepted filesystem backend
+    def __init__(self, vfs):
+        self.vfs = vfs
+        # virtual directory path -> sorted list of entries (name, mode, size, mtime)
+        self.dirs = {}
+        self.lock = threading.Lock()
+        # Index built (queries before it are answered by scanning filesystem)
+        self.ready = threading.Event()
+        self.files, self.builds, self.build_time = 0, 0, 0.0
+        self.pid = None
+    ###############################################################
+    # Start background job (once per process): build index now and every [interval] seconds
+    def start(self, loger, interval=600):
+        if self.pid == os.getpid(): return
+        self.pid = os.getpid()
+        th = threading.Thread(target=self._run, args=(loger, interval))
+        th.daemon = True
+        th.start()
+    ###############################################################
+    def _run(self, loger, interval):
+        while True:
+            start = time.time()
+            dirs = self.scan("/")
+            with self.lock:
+                self.dirs = dirs
+                self.files = sum([len(entries) for entries in dirs.values()])
+            self.build_time = time.time() - start
+            self.builds += 1
+            self.ready.set()
+            loger("Tree index built: %d directories, %d entries in %.1f seconds" % (len(dirs), self.files, self.build_time))
+            time.sleep(interval)
+    ###############################################################
+    # Scan directory [vdir] and everything below it. Return dict virtual directory -> entries
+    def scan(self, vdir):
+        dirs, todo = {}, [vdir]
+        while todo:
+            vdir = todo.pop()
+            entries = self.listdir(vdir)
+            if entries == None: continue
+            dirs[vdir] = entries
+            todo.extend([posixpath.join(vdir, e[0]) for e in entries if stat.S_ISDIR(e[1])])
+        return dirs
+    ###############################################################
+    # Return sorted entries of directory [vdir] read from filesystem (None if directory can not be read)
+    def listdir(self, vdir):
+        try:
+            names = self.vfs.list(vdir)
+        except (OSError, IOError):
+            return None
+        entries = []
+        for name in names:
+            # Skip entries that cannot be served (broken links, links out of root folder)
+            try:
+                st = self.vfs.stat(posixpath.join(vdir, name))
+            except (OSError, IOError):
+                continue
+            entries.append((name, st.st_mode, st.st_size, st.st_mtime))
+        entries.sort()
+        return entries
+    ###############################################################
+    # Directory [vdir] changed: read it again. New subdirectories are scanned, removed ones are dropped
+    def refresh(self, vdir):
+        if not self.ready.is_set(): return
+        entries = self.listdir(vdir)
+        with self.lock:
+            old = self.dirs.get(vdir)
+        if old == None and entries == None: return
+        subdirs = set([posixpath.join(vdir, e[0]) for e in entries or [] if stat.S_ISDIR(e[1])])
+        added = {}
+        for sub in subdirs:
+            if sub not in self.dirs: added.update(self.scan(sub))
+        with self.lock:
+            gone = [e for e in old or [] if stat.S_ISDIR(e[1]) and posixpath.join(vdir, e[0]) not in subdirs]
+            for e in gone:
+                prefix = posixpath.join(vdir, e[0])
+                for path in [p for p in self.dirs if p == prefix or p.startswith(prefix + "/")]:
+                    self.files -= len(self.dirs.pop(path))
+            if entries == None:
+                self.files -= len(self.dirs.pop(vdir, []))
+            else:
+                self.files += len(entries) - len(self.dirs.get(vdir, []))
+                self.dirs[vdir] = entries
+            for path, sub in added.items():
+                self.files += len(sub) - len(self.dirs.get(path, []))
+                self.dirs[path] = sub
+    ###############################################################
+    # Iterate directory [vdir] and all its subdirectories (parents first, sorted by name).
+    # Yields pairs (virtual directory, entries)
+    def walk(self, vdir):
+        indexed = self.ready.is_set()
+        dirs = self.dirs if indexed else self.scan(vdir)
+        # Directories missing in index (created outside of the server since last build) are read from filesystem
+        scanned = {}
+        todo = [vdir]
+        while todo:
+            vdir = todo.pop()
+            entries = dirs.get(vdir, scanned.get(vdir))
+            if entries == None and indexed:
+                scanned.update(self.scan(vdir))
+                entries = scanned.get(vdir)
+            if entries == None: continue
+            yield vdir, entries
+            todo.extend(reversed([posixpath.join(vdir, e[0]) for e in entries if stat.S_ISDIR(e[1])]))
+    ###############################################################
+    # Return virtual paths of files and directories under [vdir] matching shell [pattern] (at most [limit]).
+    # Pattern with "/" is matched against path relative to [vdir], otherwise against name
+    def find(self, vdir, pattern, limit):
+        found = []
+        for path, entries in self.walk(vdir):
+            rel = path[len(vdir):].lstrip("/")
+            for e in entries:
+                name = posixpath.join(rel, e[0]) if "/" in pattern else e[0]
+                if not fnmatch.fnmatchcase(name, pattern): continue
+                found.append(posixpath.join(path, e[0]))
+                if len(found) >= limit: return found
+        return found
+###############################################################
+# Manifests of directory trees (SITE MANIFEST): one line "<size> <mtime> <digest> <path>" per file.
+# Manifest is assembled from per directory parts, part is rendered again only when entries
+# of its directory in tree index changed, so manifest of mostly unchanged tree is cheap
+###############################################################
+class ManifestCache:
+    # Ctor accepted tree index and digest cache (None -> manifest has no digests)
+    def __init__(self, tree, digests=None):
+        self.tree = tree
+        self.digests = digests
+        # (virtual directory, algorithm) -> (entries, rendered part)
+        self.parts = {}
+        self.lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+    ###############################################################
+    # Iterate manifest of tree [vdir] by parts (one directory each). Digests computed with [algo]
+    # are included if they are already known, "-" otherwise
+    def render(self, vdir, algo):
+        yield "# manifest %s %s\n" % (algo, vdir)
+        for path, entries in self.tree.walk(vdir):
+            with self.lock:
+                cached = self.parts.get((path, algo))
+            if cached != None and cached[0] == entries:
+                self.hits += 1
+                yield cached[1]
+                continue
+            self.misses += 1
+            lines = []
+            for name, mode, size, mtime in entries:
+                if not stat.S_ISREG(mode): continue
+                vpath = posixpath.join(path, name)
+                digest = self.digests.cached(vpath, algo, size, mtime) if self.digests != None else None
+                lines.append("%d %d %s %s\n" % (size, int(mtime), digest or "-", vpath))
+            part = "".join(lines)
+            with self.lock:
+                self.parts[(path, algo)] = (entries, part)
+                # Drop parts of removed directories
+                if len(self.parts) > 2 * len(self.tree.dirs) + 100:
+                    for key in [k for k in self.parts if k[0] not in self.tree.dirs]: del self.parts[key]
+            yield part
+###############################################################
+# Server-wide data shared by all sessions: config, services and values derived from config.
+# Computed once, so sessions dont keep own copies
+###############################################################
+class SessionSettings(object):
+    __slots__ = ("log", "accounts", "config", "services", "vfs", "guard", "metrics", "deflate_level", "find_limit")
+    # Ctor accepted logger function, accounts store, config dict and dict of shared services
+    def __init__(self, loger, accounts, config, services):
+        self.log = loger
+        self.accounts = accounts
+        self.config = config
+        self.services = services
+        self.vfs = services["vfs"]
+        # Brute-force protection (shared by all sessions)
+        self.guard = services["login_guard"]
+        self.metrics = services["metrics"]
+        # Default level of MODE Z, max number of paths in SITE FIND reply
+        self.deflate_level = int(config.get("deflate_level", 6))
+        self.find_limit = int(config.get("site_find_limit", 1000))
 ############################################################### 
-# Client as thread children
+# Client session. Every session is served by own thread (started with start()). State is kept in
+# slots (no per-session __dict__), server-wide data is shared through SessionSettings and
+# data channel state is allocated only when used
 ############################################################### 
-class Client(threading.Thread):
-    # Ctor accepted pair (client socket, remote address) that return accept method 
-    def __init__(self, (sock, addr), loger, accounts, config):
-        threading.Thread.__init__(self)
+class Client(object):
+    __slots__ = ("sock", "rbuf", "addr", "running", "shared", "loged", "user", "cur_dir", "_paths", "writer",
+                 "data_socket", "actv", "pasv", "hash_algo", "transfer_mode", "deflate_level", "transfer_type",
+                 "rename_from", "transfer", "deferred", "transferring", "draining", "done")
+    # Shared server-wide data (properties cost nothing per session)
+    log = property(lambda self: self.shared.log)
+    accounts = property(lambda self: self.shared.accounts)
+    config = property(lambda self: self.shared.config)
+    services = property(lambda self: self.shared.services)
+    vfs = property(lambda self: self.shared.vfs)
+    guard = property(lambda self: self.shared.guard)
+    metrics = property(lambda self: self.shared.metrics)
+    find_limit = property(lambda self: self.shared.find_limit)
+    # Client name "ip port" (kept once, by reply writer)
+    CLIENT_NAME = property(lambda self: self.writer.name)
+    # Ctor accepted client socket, remote address and server-wide data
+    def __init__(self, sock, addr, shared):
         # Client socket (control connection)
         self.sock = sock
+        # Control socket stays in blocking mode for the whole session (select() is used for wait with timeout)
+        self.sock.setblocking(1)
+        # Received but not yet processed data (pipelined commands)
+        self.rbuf = ''
         # Save ip,port pair where client come from
         self.addr = addr
         # Initialy server not running
         self.running = False
-        # Set logger function
-        self.log = loger
-        # Save account dict
-        self.accounts = accounts
-        # Save config dict
-        self.config = config
+        self.shared = shared
         # User not logged yet
         self.loged = False
         # User command is not specifed
         self.user = False
         # Current virtual path
         self.cur_dir = "/"
-        # Absolute path to "server folder"
-        self.ROOT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), ROOT_FOLDER)
-        # Client name pair ip:port
-        self.CLIENT_NAME = str.format("%s %d" % addr)
+        # Virtual to real path mapping (cached per session, created by first path command)
+        self._paths = None
+        # Replies to the client go through writer
+        self.writer = ReplyWriter(sock, shared.log, "%s %d" % addr)
+        # Data channel (listen socket, accepted socket, active mode address), created by PASV/EPSV/PORT/EPRT
         self.data_socket = None
         self.actv = None
         self.pasv = None
-        # Brute-force protection
-        self.brute_force = {"attempts" : 0, "username" : None}
-        # Max 3 wrong attempts before closing control connection
-        self.max_brute_attemps = 3
+        # Algorithm used by HASH command (can be changed with OPTS HASH)
+        self.hash_algo = "SHA-256"
+        # Transfer mode: S (stream) or Z (deflate), compression level used in MODE Z (can be changed with OPTS MODE Z LEVEL)
+        self.transfer_mode = "S"
+        self.deflate_level = shared.deflate_level
+        # Representation type: A (ASCII, default by RFC 959) or I (image, binary)
+        self.transfer_type = "A"
+        # Path given with RNFR (waits for RNTO)
+        self.rename_from = None
+        # Last data transfer (runs in transfer pool)
+        self.transfer = None
+        # Received commands waiting for processing (list created when commands arrive,
+        # only ABOR, STAT, NOOP are processed while transfer runs)
+        self.deferred = None
+        # Session busy with data transfer (LIST/RETR)
+        self.transferring = False
+        # Server is going down: close session as soon as it is idle
+        self.draining = False
+        # Locked while session thread runs
+        self.done = None
+    ###############################################################
+    # Path resolver of the session (created at first use)
+    @property
+    def paths(self):
+        if self._paths == None: self._paths = PathResolver(self.services["stat_cache"])
+        return self._paths
+    ###############################################################
+    # Start session thread
+    def start(self):
+        self.done = thread.allocate_lock()
+        self.done.acquire()
+        try:
+            thread.start_new_thread(self._main, ())
+        except:
+            self.done.release()
+            raise
+    ###############################################################
+    def _main(self):
+        try:
+            self.run()
+        finally:
+            self.done.release()
+    ###############################################################
+    # Return True while session thread runs
+    def is_alive(self):
+        return self.done != None and self.done.locked()
+    ###############################################################
+    # Wait until session thread ends
+    def join(self):
+        if self.done == None: return
+        self.done.acquire()
+        self.done.release()
     ############################################################### 
-    # Override base class "run" method
+    # Session thread: receive commands and send replies until connection is closed
     def run(self):
         # Initialy we toggle running mark 
         self.running = True
         # Send welcome message to client
         self.sendCommand("220 Welcome message")
+        self.writer.flush()
         # Main receive/response loop
         while self.running:
-            # Select socket that ready to read/write (last param -> timeout 1 sec)
-            _in, _out, _exc = select.select([self.sock,], [self.sock,], [self.sock,], 1)
-            for s in _in:
-                if s != self.sock: continue
-                try:
-                    # Set client socket to blocking mode
-                    self.sock.setblocking(1)
-                    # Read command from client
-                    data = self.readFrom(self.sock)
-                    # Remove blocking settings
-                    self.sock.setblocking(0)
-                    # Proceed client command
-                    if not data: self.close_connection()
-                    else: self.parseResponse(data)                       
-                # Handle socket errors
-                except socket.error, (errorCode, message):
-                    if errorCode != 10035:
-                        self.log("socket.error: " + str(errorCode))
-                    self.close_connection()
+            # Wait until socket is ready to read (timeout 1 sec).
+            # Waiting commands are checked often: they are processed as soon as transfer ends
+            timeout = 0.05 if self.transferring and (self.deferred or self.draining) else 1
+            sock = self.sock
+            # Session closed by server (stop, drain) from other thread
+            if sock == None: break
+            ready = wait_socket(sock, timeout)
+            try:
+                if ready:
+                    # Read all commands client sent so far
+                    commands = self.readCommands(sock)
+                    # Connection closed by client
+                    if commands == None:
+                        self.close_connection()
+                        break
+                    if self.deferred: self.deferred.extend(commands)
+                    else: self.deferred = commands
+                self.processCommands()
+                # Send replies for the whole batch at once
+                self.writer.flush()
+            # Handle socket errors
+            except socket.error, (errorCode, message):
+                if errorCode != 10035:
+                    self.log("socket.error: " + str(errorCode))
+                self.close_connection()
+    ###############################################################
+    # Proceed received client commands. While data transfer runs only ABOR, STAT and NOOP
+    # are answered, other commands wait until transfer ends
+    def processCommands(self):
+        while self.deferred and self.running:
+            if self.transferring:
+                for data in [d for d in self.deferred if d.strip().lower() in ("abor", "stat", "noop")]:
+                    self.deferred.remove(data)
+                    self.parseResponse(data)
+                break
+            self.parseResponse(self.deferred.pop(0))
+        # Server draining: transfer finished, so session can be closed now
+        if self.draining: self.drain()
     ###############################################################
     # Close control and data connections (will be called when thread stop)
     def close_connection(self):
         if self.running == False: return
         self.running = False
+        # Deliver last replies (goodbye, errors) before shutdown
+        try:
+            self.writer.flush()
+        except socket.error:
+            pass
+        self.writer.close()
+        # Shutdown fails if client already closed connection, socket must be closed anyway
         try:
             self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        try:
             self.sock.close()
             self.sock = None
             self.closeDataConnection()
@@ -108,7 +1948,23 @@ class Client(threading.Thread):
             self.log("Error occured while close connection for %s" % self.CLIENT_NAME)
         self.log("Disconnected: %s %d" % self.addr)
     ###############################################################
+    # Server is going down: close session now if it is idle, otherwise after current transfer
+    def drain(self):
+        self.draining = True
+        if self.transferring or not self.running: return
+        self.sendCommand("421 Service not available, closing control connection.")
+        self.close_connection()
+    ###############################################################
     def closeDataConnection(self):
+        # Shutdown before close: connection ends (client gets EOF) even when descriptor
+        # is still open in other process (new server process started by restart)
+        for sock in (self.data_socket, self.pasv):
+            # pasv is (ip, port) until data connection is accepted
+            if not isinstance(sock, socket.socket): continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
         # Try to close data socket
         try:
             if self.data_socket != None:
@@ -124,22 +1980,17 @@ class Client(threading.Thread):
         self.pasv = None
         self.actv = None
     ###############################################################
-    # Read data from socket [sock]
-    def readFrom(self, sock):
-        # Result buffer and current character
-        buffer, char = '', ' '
-        # Read from the [sock] socket while next char not empty and full data not end with CRLF
-        while char != '' and not buffer.endswith(CRLF):
-            # Next character
-            char = sock.recv(1)
-            # Append character to the result buffer
-            buffer += char
-        # Remove CRLF characters (at left/right positions) from the result buffer
-        return buffer.strip(CRLF)
-    ################################################################
-    # Convert virtual client path (PWD) to absolute path
-    def virtualToReal(self):
-        return os.path.normpath(self.ROOT_PATH + "/" + self.cur_dir)
+    # Read available data from control socket [sock] and split it into commands.
+    # Return list of complete commands (may be empty) or None if connection closed
+    def readCommands(self, sock):
+        chunk = sock.recv(4096)
+        if not chunk: return None
+        self.rbuf += chunk
+        # Last element is incomplete command (or empty string)
+        lines = self.rbuf.split("\n")
+        self.rbuf = lines.pop()
+        # Remove CRLF characters (at left/right positions) from each command
+        return [line.strip(CRLF) for line in lines]
     ################################################################
     # Proceed client command
     def parseResponse(self, data):
@@ -149,14 +2000,25 @@ class Client(threading.Thread):
         cmdLower = str.lower(data)
         # Make log record
         self.log("Received from %s %d: %s" % (self.addr + (data, )) )
+        self.metrics.incr("commands")
         # Proceed commands
         if cmdLower == "quit":
             self.sendCommand("221 Goodbye, closing seesion.")
             self.close_connection()
             return
+        if cmdLower == "feat":
+            message  = "211-Features:\r\n"
+            message += " HASH " + ";".join([a + ("*" if a == self.hash_algo else "") for a in DigestCache.ALGORITHMS]) + "\r\n"
+            message += " MDTM\r\n"
+            message += " MLST type*;size*;modify*;\r\n"
+            if self.config.get("mode_z", "YES") == "YES": message += " MODE Z\r\n"
+            message += " SIZE\r\n"
+            message += "211 End"
+            self.sendCommand(message)
+            return
         if cmdLower == "help":
             message  = "214-The following commads are recognized: \r\n"
-            message += "USER, PASS, CWD, CDUP, QUIT, PASV, EPSV, PORT, RETR, PWD, LIST, HELP"
+            message += "USER, PASS, CWD, CDUP, QUIT, PASV, EPSV, PORT, RETR, PWD, LIST, NLST, MLSD, HELP, FEAT, OPTS, HASH, XCRC, XMD5, XSHA1, XSHA256, XSHA512, SIZE, MDTM, MODE, TYPE, STOR, APPE, DELE, RNFR, RNTO, SITE, ABOR, STAT, NOOP\r\n"
             message += "214 End"
             self.sendCommand(message)
             return
@@ -170,12 +2032,10 @@ class Client(threading.Thread):
                 return
             # Parse username
             self.user = params[1].strip(CRLF)
-            # Brute-force protection
-            if self.brute_force["username"] == None: 
-                self.brute_force["username"] = self.user
-                self.brute_force["attempts"] = 0                
+            # Pick up changes of users file
+            if self.accounts.refresh(): self.log("Accounts file reloaded: %d account records loaded." % len(self.accounts))
             # Check if we have record for this user
-            if self.accounts.get(self.user) == None:
+            if not self.accounts.exists(self.user):
                 self.sendCommand("530 Invalid user name.")
                 self.user = False
                 return
@@ -196,11 +2056,17 @@ class Client(threading.Thread):
                 return
             # Parse user password
             password = params[1].strip(CRLF)
+            # Too many failed logins of this user (from any ip) -> dont even check password
+            if self.guard.user_blocked(self.user):
+                self.sendCommand("530 Too many failed logins, try again later.")
+                self.log("Login of blocked user %s from %s" % (self.user, self.CLIENT_NAME))
+                self.user = False
+                return
             # Compare passwords
-            if self.accounts[self.user] != password:
-                self.brute_force["attempts"] = self.brute_force["attempts"] + 1
+            if not self.accounts.verify(self.user, password):
+                self.metrics.incr("logins_failed")
                 # Brute-force detection
-                if self.brute_force["username"] == self.user and self.brute_force["attempts"] == self.max_brute_attemps:
+                if self.guard.fail(self.addr[0], self.user):
                     self.sendCommand("421 Service not available, closing control connection. (Brute-force detection)")                
                     self.log("Brute-force detected: %s" % self.CLIENT_NAME)
                     self.close_connection()
@@ -210,6 +2076,8 @@ class Client(threading.Thread):
                 self.user = False
                 return
             # Password accepted
+            self.guard.success(self.addr[0], self.user)
+            self.metrics.incr("logins")
             self.loged = True
             self.sendCommand("230 User logged in, proceed.")
             return
@@ -223,41 +2091,23 @@ class Client(threading.Thread):
             return
         # CDUP
         elif cmdLower == "cdup":
-            if not self.cur_dir == "/":
-                # Get absolute path
-                p = os.path.normpath(self.virtualToReal())
-                # Go dir UP
-                p = os.path.abspath(os.path.join(p, '..'))
-                # Prevent move up from root directory
-                pos = p.find(self.ROOT_PATH)
-                if pos == -1: # To far away -> lock into root dir
-                    self.cur_dir = "/"
-                else:
-                    # Cutoff last part
-                    self.cur_dir = p[pos + len(self.ROOT_PATH):]
-                    if self.cur_dir == "": self.cur_dir = "/"
+            # Parent of virtual root is root itself
+            self.cur_dir = self.paths.virtual(self.cur_dir, "..")
             self.sendCommand("250 Directory changed to \"" + self.cur_dir + "\"")
         # CWD
         elif cmdLower.startswith("cwd"):
             # Command require one argument
-            params = cmdLower.split()
+            params = data.split()
             if len(params) == 1:
                 self.sendCommand("501 Syntax error in parameters or arguments.")
                 return
             # Folder name can be with spaces so construct string back but cutoff first part (command="cwd")
             folder = ' '.join(params[1:])
-            abs_path = ''
-            if folder.startswith("/") or folder.startswith("\\"):
-                abs_path = os.path.normpath(self.ROOT_PATH + "/" + folder)
-                self.cur_dir = os.path.normpath(folder)
-            else:
-                abs_path = self.virtualToReal()
-                abs_path = os.path.normpath(abs_path + "/" + folder)
-                self.cur_dir = os.path.normpath(self.cur_dir + "/" + folder)
-            if not os.path.isdir(abs_path) or not os.path.exists(abs_path):
+            vpath = self.paths.virtual(self.cur_dir, folder)
+            if not self.paths.isdir(vpath):
                 self.sendCommand("550 " + folder + ": No such file or directory.")
-                return            
-            self.cur_dir = '/' + self.cur_dir.replace('\\', '/').lstrip('/')
+                return
+            self.cur_dir = vpath
             self.sendCommand("250 Directory changed to \"" + self.cur_dir + "\"")
         # LIST
         elif cmdLower.startswith("list"):
@@ -265,65 +2115,42 @@ class Client(threading.Thread):
             if self.actv == None and self.pasv == None:
                 self.sendCommand("426 Data connection not specified.  A PORT/EPRT or PASV/EPSV command must be issued before executing this operation.")
                 return
-            # List can be with params
-            args, params = '', cmdLower.split(' ')
+            # List can be with params (options like "-la" are ignored except "-R")
+            args, params = '', data.split(' ')
             if len(params) > 1:
                 # Get LIST arguments
-                args = ' '.join(params[1:])
-            # Send files list using active mode
-            if self.actv:
-                try:
-                    # Get saved params
-                    ip, port, ver = self.actv
-                    # If PORT or EPRT but version 1 -> using ipv4
-                    if ver == 1:
-                        self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        self.data_socket.settimeout(15)
-                        self.data_socket.connect((ip, port))
-                    else: # Otherwise ipv6
-                        self.data_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-                        self.data_socket.settimeout(15)
-                        self.data_socket.connect((ip, port))
-                    self.sendCommand("150 Opening ASCII mode data connection.")
-                    # Get files list
-                    m = self.getLIST(args)
-                    self.log("Sent via data connection to %s %d:\n%s" % (self.addr + (m, )) )
-                    # Send to client
-                    self.data_socket.send(m + CRLF)
-                    # Send post message
-                    self.sendCommand("226 Transfer complete.")
-                except socket.error as e:
-                    self.log("Active mode for %s %d.\nFailed with error: %s" % (self.addr + (str(e), ) ))
-                    self.sendCommand("421 Active mode failed")
-            # Send files list using passive mode
-            elif self.pasv:
-                try:
-                    self.sendCommand("150 Opening ASCII mode data connection.")
-                    # Accept remote connection
-                    (conn, addr) = self.data_socket.accept()
-                    self.pasv = conn
-                    self.log("For client %s %d, accepted data connection %s %d: " % (self.addr + addr))
-                    # Turn socket into blocking mode
-                    self.pasv.setblocking(1)
-                    # Get files list
-                    m = self.getLIST(args)
-                    self.log("Sent via data connection to %s %d:\n%s" % (self.addr + (m, )) )
-                    # Send list to the client
-                    self.pasv.send(m + CRLF)
-                    # Send post message
-                    self.sendCommand("226 Transfer complete.")
-                except socket.error as e:
-                    self.log("Pasive mode for %s %d.\nFailed with error: %s" % (self.addr + (str(e), ) ))
-                    self.sendCommand("421 Passive mode failed")
-            # Close data connection
-            self.closeDataConnection()
+                args = ' '.join([p for p in params[1:] if not p.startswith("-")])
+            recursive = len([p for p in params[1:] if p.startswith("-") and "R" in p]) > 0
+            # Directory should exist
+            vpath = self.paths.virtual(self.cur_dir, args)
+            if not self.paths.isdir(vpath):
+                self.sendCommand("550 " + args + ": No such file or directory.")
+                self.closeDataConnection()
+                return
+            # Files list is sent by transfer pool thread
+            if recursive: self.startTransfer("LIST", vpath, 0, self.sendTree, vpath, "LIST", True)
+            else: self.startTransfer("LIST", vpath, 0, self.sendList, args)
+        # NLST [-R], MLSD [-R] (recursive listings are served from tree index)
+        elif cmdLower.split(" ")[0] in ("nlst", "mlsd"):
+            if self.actv == None and self.pasv == None:
+                self.sendCommand("426 Data connection not specified.  A PORT/EPRT or PASV/EPSV command must be issued before executing this operation.")
+                return
+            params = data.split(' ')
+            args = ' '.join([p for p in params[1:] if not p.startswith("-")])
+            recursive = len([p for p in params[1:] if p.startswith("-") and "R" in p]) > 0
+            vpath = self.paths.virtual(self.cur_dir, args)
+            if not self.paths.isdir(vpath):
+                self.sendCommand("550 " + args + ": No such file or directory.")
+                self.closeDataConnection()
+                return
+            self.startTransfer(params[0].upper(), vpath, 0, self.sendTree, vpath, params[0].upper(), recursive)
         # RETR
         elif cmdLower.startswith("retr"):
             if self.actv == None and self.pasv == None:
                 self.sendCommand("426 Data connection not specified.  A PORT/EPRT or PASV/EPSV command must be issued before executing this operation.")
                 return
             # RETR command require argument
-            args, params = '', cmdLower.split(' ')
+            args, params = '', data.split(' ')
             if len(params) == 1:
                 self.sendCommand("501 Syntax error in parameters or arguments.")
                 # Cleanup data socket
@@ -331,79 +2158,197 @@ class Client(threading.Thread):
                 return
             # Grab command argument
             args = ' '.join(params[1:])
-            # Active mode
-            if self.actv:
-                try:
-                    # Get connection params
-                    ip, port, ver = self.actv
-                    # Create data socket and connect using ipv4 prot
-                    if ver == 1:
-                        self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        self.data_socket.settimeout(15)
-                        self.data_socket.connect((ip, port))
-                    else: # Otherwise use ipv6
-                        self.data_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-                        self.data_socket.settimeout(15)
-                        self.data_socket.connect((ip, port))
-                    # Send "prepare" message
-                    self.sendCommand("150 Opening ASCII mode data connection.")
-                    # Parse filename
-                    filename = args.strip(' \r\n.,')
-                    # Construct absolute path to file
-                    filepath = os.path.join(self.virtualToReal(), filename)
-                    # Check if file exists
-                    if not os.path.exists(filepath):
-                        # If no -> send to client bad news
-                        self.sendCommand("501 File Not found.")
-                        self.log("File not found to %s %d:\n%s" % (self.addr + (m, )))
-                    else: # Otherwise open file in binary mode, read and send via data connection
-                        f = open(filepath, "rb")
-                        data = f.read()
-                        f.close() 
-                        # Send file data
-                        self.data_socket.send(data)
-                        # Make log record
-                        self.log("Sent via data connection to %s %d:\n%s" % (self.addr + (filepath, )) )
-                        # Send post message
-                        self.sendCommand("226 Transfer complete.")
-                except socket.error as e:
-                    # Something wrong -> make log record and send to client bad news
-                    self.log("Active mode for %s %d.\nFailed with error: %s" % (self.addr + (str(e), ) ))
-                    self.sendCommand("421 Active mode failed")
-            # Passive mode
-            elif self.pasv:
-                try:
-                    self.sendCommand("150 Opening ASCII mode data connection.")
-                    # Accept remote data connection
-                    (conn, addr) = self.data_socket.accept()
-                    self.pasv = conn
-                    self.log("For client %s %d, accepted data connection %s %d: " % (self.addr + addr))
-                    # Turn socket into blocking mode
-                    self.pasv.setblocking(1)					
-                    self.sendCommand("150 Opening ASCII mode data connection.")
-                    # Parse filename
-                    filename = args.strip(' \r\n.,')
-                    # Construct absolute path to retrive file
-                    filepath = os.path.join(self.virtualToReal(), filename)
-                    # File should exists
-                    if not os.path.exists(filepath):
-                        self.sendCommand("501 File Not found.")
-                        self.log("File not found to %s %d:\n%s" % (self.addr + (m, )))
-                    else:
-                        # Open file in binary mode, read and send
-                        f = open(filepath, "rb")
-                        data = f.read()
-                        f.close()
-                        self.pasv.send(data)
-                        # Make log record
-                        self.log("Sent via data connection to %s %d:\n%s" % (self.addr + (filepath, )) )
-                        # Send post message
-                        self.sendCommand("226 Transfer complete.")
-                except socket.error as e:
-                    self.log("Pasive mode for %s %d.\nFailed with error: %s" % (self.addr + (str(e), ) ))
-                    self.sendCommand("421 Passive mode failed")
-            # Cleanup data socket
-            self.closeDataConnection()
+            # Parse filename
+            filename = args.strip(' \r\n')
+            # Construct virtual path to file, file should exists
+            filepath = self.paths.virtual(self.cur_dir, filename)
+            if not self.paths.isfile(filepath):
+                self.sendCommand("550 " + filename + ": No such file.")
+                self.log("File not found to %s %d:\n%s" % (self.addr + (filename, )))
+                self.closeDataConnection()
+                return
+            # File is sent by transfer pool thread
+            self.startTransfer("RETR", filepath, self.paths.stat(filepath).st_size, self.sendRetr)
+        # STOR, APPE
+        elif cmdLower.startswith("stor") or cmdLower.startswith("appe"):
+            if self.actv == None and self.pasv == None:
+                self.sendCommand("426 Data connection not specified.  A PORT/EPRT or PASV/EPSV command must be issued before executing this operation.")
+                return
+            if self.config.get("upload", "NO") != "YES":
+                self.sendCommand("550 Permission denied.")
+                self.closeDataConnection()
+                return
+            filename = data[5:].strip()
+            if not filename:
+                self.sendCommand("501 Syntax error in parameters or arguments.")
+                self.closeDataConnection()
+                return
+            # File is created in existing directory only, directory can not be overwritten
+            filepath = self.paths.virtual(self.cur_dir, filename)
+            if not self.paths.isdir(posixpath.dirname(filepath)) or self.paths.isdir(filepath):
+                self.sendCommand("553 " + filename + ": File name not allowed.")
+                self.closeDataConnection()
+                return
+            # Quota check: usage of the user is kept in index
+            append = cmdLower.startswith("appe")
+            quota = self.services.get("quota")
+            remaining = quota.remaining(self.user) if quota != None else None
+            # Overwritten file of the user is not counted
+            if remaining != None and not append: remaining += quota.owned(filepath, self.user)
+            if remaining != None and remaining <= 0:
+                self.metrics.incr("quota_rejects")
+                self.sendCommand("552 Requested file action aborted. Exceeded storage allocation.")
+                self.closeDataConnection()
+                return
+            try:
+                f = self.vfs.open_write(filepath, append)
+            except (OSError, IOError) as e:
+                self.sendCommand("550 " + filename + ": Unable to create file.")
+                self.log("Unable to create %s for %s: %s" % (filepath, self.CLIENT_NAME, str(e)))
+                self.closeDataConnection()
+                return
+            # File is received by transfer pool thread
+            self.startTransfer(data[:4].upper(), filepath, 0, self.receiveUpload, self.services["uploads"].open(f), append, remaining)
+        # ABOR
+        elif cmdLower == "abor":
+            transfer = self.transfer
+            if transfer == None or not transfer.abort():
+                self.sendCommand("225 No transfer to abort.")
+                return
+            if self.services["transfers"].cancel(transfer):
+                # Transfer still waits for pool thread: it never starts, session cleans up itself
+                self.sendCommand("426 Connection closed; transfer aborted.")
+                self.closeDataConnection()
+                self.transferring = False
+                transfer.finish()
+                self.metrics.incr("transfers_aborted")
+                self.sendCommand("226 Abort successful.")
+            # Otherwise pool thread replies 426 and 226 when transfer stops, session keeps answering commands
+        # STAT (without arguments: status of the session and current transfer)
+        elif cmdLower == "stat":
+            message  = "211-FTP server status:\r\n"
+            message += " Connected from " + self.addr[0] + "\r\n"
+            message += " Logged in as " + self.user + "\r\n"
+            message += " TYPE: %s, MODE: %s\r\n" % ("ASCII" if self.transfer_type == "A" else "BINARY", self.transfer_mode)
+            transfer = self.transfer
+            if transfer != None and not transfer.done.is_set(): message += " " + transfer.status() + "\r\n"
+            message += "211 End"
+            self.sendCommand(message)
+        # NOOP
+        elif cmdLower == "noop":
+            self.sendCommand("200 NOOP ok.")
+        # DELE, RNFR, RNTO
+        elif cmdLower.startswith("dele") or cmdLower.startswith("rnfr") or cmdLower.startswith("rnto"):
+            if self.config.get("upload", "NO") != "YES":
+                self.sendCommand("550 Permission denied.")
+                return
+            filename = data[5:].strip()
+            if not filename:
+                self.sendCommand("501 Syntax error in parameters or arguments.")
+                return
+            vpath = self.paths.virtual(self.cur_dir, filename)
+            quota = self.services.get("quota")
+            if cmdLower.startswith("rnfr"):
+                if vpath == "/" or self.paths.stat(vpath) == None:
+                    self.sendCommand("550 " + filename + ": No such file or directory.")
+                    return
+                self.rename_from = vpath
+                self.sendCommand("350 Ready for RNTO.")
+                return
+            try:
+                if cmdLower.startswith("dele"):
+                    if not self.paths.isfile(vpath):
+                        self.sendCommand("550 " + filename + ": No such file.")
+                        return
+                    self.vfs.delete(vpath)
+                    if quota != None: quota.remove(vpath)
+                    self.services["tree"].refresh(posixpath.dirname(vpath))
+                    self.sendCommand("250 File deleted.")
+                else:
+                    source, self.rename_from = self.rename_from, None
+                    if source == None:
+                        self.sendCommand("503 Bad sequence of commands.")
+                        return
+                    if not self.paths.isdir(posixpath.dirname(vpath)) or vpath == source or vpath.startswith(source + "/"):
+                        self.sendCommand("553 " + filename + ": File name not allowed.")
+                        return
+                    self.vfs.rename(source, vpath)
+                    if quota != None: quota.rename(source, vpath)
+                    self.services["tree"].refresh(posixpath.dirname(source))
+                    self.services["tree"].refresh(posixpath.dirname(vpath))
+                    self.services["stat_cache"].invalidate(source)
+                    self.paths.invalidate()
+                    self.sendCommand("250 Rename successful.")
+            except (OSError, IOError) as e:
+                self.log("%s of %s for %s failed: %s" % (data[:4].upper(), vpath, self.CLIENT_NAME, str(e)))
+                self.sendCommand("550 " + filename + ": Requested action not taken.")
+            self.services["stat_cache"].invalidate(vpath)
+            self.paths.invalidate(vpath)
+        # SITE QUOTA
+        elif cmdLower == "site quota":
+            quota = self.services.get("quota")
+            limit = quota.limit(self.user) if quota != None else None
+            if limit == None:
+                self.sendCommand("200 No quota.")
+            else:
+                self.sendCommand("200 Used %d of %d bytes." % (quota.used(self.user), limit))
+        # SITE MANIFEST [dir] (manifest of the tree is sent via data connection)
+        elif cmdLower.startswith("site manifest"):
+            if self.actv == None and self.pasv == None:
+                self.sendCommand("426 Data connection not specified.  A PORT/EPRT or PASV/EPSV command must be issued before executing this operation.")
+                return
+            args = data[13:].strip()
+            vpath = self.paths.virtual(self.cur_dir, args)
+            if not self.paths.isdir(vpath):
+                self.sendCommand("550 " + args + ": No such file or directory.")
+                self.closeDataConnection()
+                return
+            self.startTransfer("MANIFEST", vpath, 0, self.sendManifest, vpath)
+        # SITE DELTA <block size> <file> (client sends signatures of its copy, server replies with delta)
+        elif cmdLower.startswith("site delta"):
+            if self.actv == None and self.pasv == None:
+                self.sendCommand("426 Data connection not specified.  A PORT/EPRT or PASV/EPSV command must be issued before executing this operation.")
+                return
+            if self.config.get("delta", "YES") != "YES":
+                self.sendCommand("504 Command not implemented for that parameter")
+                self.closeDataConnection()
+                return
+            params = data.split(" ", 3)
+            if len(params) != 4 or not params[2].isdigit() or not 512 <= int(params[2]) <= 1024 * 1024:
+                self.sendCommand("501 Syntax error in parameters or arguments.")
+                self.closeDataConnection()
+                return
+            filename = params[3].strip()
+            filepath = self.paths.virtual(self.cur_dir, filename)
+            if not self.paths.isfile(filepath):
+                self.sendCommand("550 " + filename + ": No such file.")
+                self.closeDataConnection()
+                return
+            self.startTransfer("DELTA", filepath, self.paths.stat(filepath).st_size, self.sendDelta, filepath, int(params[2]))
+        # SITE ARCHIVE [dir] (tar of the tree is streamed via data connection)
+        elif cmdLower.startswith("site archive"):
+            if self.actv == None and self.pasv == None:
+                self.sendCommand("426 Data connection not specified.  A PORT/EPRT or PASV/EPSV command must be issued before executing this operation.")
+                return
+            args = data[12:].strip()
+            vpath = self.paths.virtual(self.cur_dir, args)
+            if not self.paths.isdir(vpath):
+                self.sendCommand("550 " + args + ": No such file or directory.")
+                self.closeDataConnection()
+                return
+            # Size of the tree is not known until it is walked in pool thread (archive is queued as big transfer)
+            self.startTransfer("ARCHIVE", vpath, 0, self.sendArchive, vpath)
+        # SITE FIND <pattern> (searched in tree index from current directory)
+        elif cmdLower.startswith("site find"):
+            pattern = data[9:].strip()
+            if not pattern:
+                self.sendCommand("501 Syntax error in parameters or arguments.")
+                return
+            found = self.services["tree"].find(self.cur_dir, pattern, self.find_limit)
+            message = "200-Found:\r\n" + "".join([" " + path + "\r\n" for path in found])
+            if len(found) >= self.find_limit: message += "200 %d matches (more not shown)." % len(found)
+            else: message += "200 %d matches." % len(found)
+            self.sendCommand(message)
         # PASV
         elif cmdLower.startswith("pasv"):
             # Check if the server support pasv_mode
@@ -416,6 +2361,7 @@ class Client(threading.Thread):
                 # Create listen socket for incoming connections
                 self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 #self.data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.services["sockets"].data(self.data_socket)
                 self.data_socket.settimeout(15)
                 ip = self.addr[0]
                 # Bind to the current ip and random free port
@@ -446,6 +2392,7 @@ class Client(threading.Thread):
                 # Create listen socket for incoming connections
                 self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 #self.data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.services["sockets"].data(self.data_socket)
                 self.data_socket.settimeout(15)
                 ip = self.addr[0]
                 # Bind to the current ip and random free port
@@ -527,36 +2474,531 @@ class Client(threading.Thread):
                 self.sendCommand("501 Syntax error in parameters or arguments.")
                 self.data_socket = None
                 self.actv = None
+        # TYPE A [N], TYPE I, TYPE L 8
+        elif cmdLower.startswith("type"):
+            params = cmdLower.split()
+            if len(params) == 1:
+                self.sendCommand("501 Syntax error in parameters or arguments.")
+            elif params[1:] in (["a"], ["a", "n"]):
+                self.transfer_type = "A"
+                self.sendCommand("200 Type set to A.")
+            elif params[1:] in (["i"], ["l", "8"]):
+                self.transfer_type = "I"
+                self.sendCommand("200 Type set to I.")
+            else:
+                self.sendCommand("504 Command not implemented for that parameter")
+        # MODE S, MODE Z
+        elif cmdLower.startswith("mode"):
+            params = cmdLower.split()
+            if len(params) != 2:
+                self.sendCommand("501 Syntax error in parameters or arguments.")
+            elif params[1] == "s" or (params[1] == "z" and self.config.get("mode_z", "YES") == "YES"):
+                self.transfer_mode = params[1].upper()
+                self.sendCommand("200 Mode set to " + self.transfer_mode + ".")
+            else:
+                self.sendCommand("504 Command not implemented for that parameter")
+        # OPTS MODE Z LEVEL <level>
+        elif cmdLower.startswith("opts mode z"):
+            params = cmdLower.split()
+            if len(params) != 5 or params[3] != "level" or not params[4].isdigit() or not 0 <= int(params[4]) <= 9:
+                self.sendCommand("501 Syntax error in parameters or arguments.")
+                return
+            self.deflate_level = int(params[4])
+            self.sendCommand("200 MODE Z LEVEL set to " + params[4] + ".")
+        # OPTS HASH [algorithm]
+        elif cmdLower.startswith("opts hash"):
+            params = data.split()
+            if len(params) > 2:
+                if params[2].upper() not in DigestCache.ALGORITHMS:
+                    self.sendCommand("501 Unknown algorithm, current selection not changed.")
+                    return
+                self.hash_algo = params[2].upper()
+            self.sendCommand("200 " + self.hash_algo)
+        # HASH, XCRC, XMD5, XSHA1, XSHA256, XSHA512
+        elif cmdLower.split(" ")[0] in ("hash", "xcrc", "xmd5", "xsha1", "xsha256", "xsha512"):
+            self.sendDigest(data)
+        # SIZE, MDTM (served from stat cache shared by all sessions)
+        elif cmdLower.startswith("size ") or cmdLower.startswith("mdtm "):
+            filename = data[5:].strip()
+            st = self.services["stat_cache"].stat(self.paths.virtual(self.cur_dir, filename))
+            if st == None or not stat.S_ISREG(st.st_mode):
+                self.sendCommand("550 " + filename + ": No such file.")
+            elif cmdLower.startswith("size"):
+                self.sendCommand("213 %d" % st.st_size)
+            else:
+                self.sendCommand("213 " + time.strftime("%Y%m%d%H%M%S", time.gmtime(st.st_mtime)))
         # Command not implemented
         else:
             self.sendCommand("202 Not implemented")                      
     ################################################################
     # Construct response string for LIST command
     def getLIST(self, args):
-        p = ''
-        if args:
-            p = os.path.normpath(self.ROOT_PATH + "/" + args)
-        else:
-            p = self.virtualToReal()
-        names = os.listdir(p)
+        p = self.paths.virtual(self.cur_dir, args)
+        names = self.vfs.list(p)
         message = ''
         for name in names:
-            message = message + self.permissions( os.path.join(p, name) ) + " " + name + "\r\n"
+            # Skip entries that cannot be served (broken links, links out of root folder)
+            try:
+                message = message + self.permissions( posixpath.join(p, name) ) + " " + name + "\r\n"
+            except (OSError, IOError):
+                continue
         return message
     ################################################################
+    # Reply on HASH and X* digest commands
+    def sendDigest(self, data):
+        params = data.split(" ")
+        command = params[0].lower()
+        filename = " ".join(params[1:]).strip()
+        if not filename:
+            self.sendCommand("501 Syntax error in parameters or arguments.")
+            return
+        vpath = self.paths.virtual(self.cur_dir, filename)
+        if not self.paths.isfile(vpath):
+            self.sendCommand("550 " + filename + ": No such file.")
+            return
+        algo = {"hash" : self.hash_algo, "xcrc" : "CRC32", "xmd5" : "MD5", "xsha1" : "SHA-1", "xsha256" : "SHA-256", "xsha512" : "SHA-512"}[command]
+        try:
+            digest = self.services["digests"].digest(vpath, algo)
+        except (OSError, IOError) as e:
+            self.sendCommand("450 " + filename + ": unable to read file.")
+            return
+        if command == "hash":
+            size = self.paths.stat(vpath).st_size
+            # draft-bryan-ftp-hash: 213 <algorithm> <start>-<end> <digest> <filename>
+            self.sendCommand("213 %s 0-%d %s %s" % (algo, size, digest, filename))
+        else:
+            self.sendCommand("250 " + digest)
+    ################################################################
+    # Return stream for sending data via data connection [sock] in current transfer mode.
+    # In MODE Z already compressed files ([filepath] by extension) are only wrapped in deflate format
+    # File data is converted to network line endings in ASCII mode (TYPE A)
+    def openDataStream(self, sock, filepath=None):
+        stream = sock
+        if self.transfer_mode == "Z":
+            level = self.deflate_level
+            if filepath != None and posixpath.splitext(filepath)[1].lower() in COMPRESSED_EXTENSIONS: level = 0
+            stream = DeflateStream(sock, level)
+        if filepath != None and self.transfer_type == "A": stream = AsciiStream(stream)
+        return stream
+    ################################################################
+    # Finish data stream [stream] opened with openDataStream
+    def closeDataStream(self, stream):
+        if isinstance(stream, AsciiStream): stream = stream.stream
+        if not isinstance(stream, DeflateStream): return
+        stream.finish()
+        self.metrics.incr("deflate_bytes_in", stream.bytes_in)
+        self.metrics.incr("deflate_bytes_out", stream.bytes_out)
+    ################################################################
+    # Send [data] (LIST output) via data connection [sock]
+    def sendData(self, sock, data):
+        stream = self.openDataStream(sock)
+        stream.sendall(data)
+        self.closeDataStream(stream)
+    ################################################################
+    # Send file [filepath] (virtual path) via data connection [sock].
+    # Small files are served from content cache, others are streamed by blocks
+    def sendFile(self, sock, filepath, transfer=None):
+        cache = self.services.get("content_cache")
+        data = None
+        if cache != None:
+            data = cache.get(self.vfs, filepath, self.vfs.stat(filepath))
+        self.metrics.incr("files_sent")
+        stream = self.openDataStream(sock, filepath)
+        if data != None:
+            # Send cached content without copying it
+            view = memoryview(data)
+            for pos in xrange(0, len(data), CHUNK_SIZE):
+                stream.sendall(view[pos:pos + CHUNK_SIZE])
+                if transfer != None: transfer.advance(len(view[pos:pos + CHUNK_SIZE]))
+            self.metrics.incr("bytes_sent", len(data))
+        else:
+            st = self.vfs.stat(filepath)
+            shared = self.services.get("shared_reads")
+            reader = shared.acquire(filepath, st) if shared != None else None
+            if reader != None:
+                # Big file: join other sessions downloading it
+                try:
+                    self.sendShared(stream, reader, stream is sock, transfer)
+                finally:
+                    shared.release(reader)
+            else:
+                # Streaming path: file is never loaded into memory as whole
+                with self.vfs.open_read(filepath) as f:
+                    self.streamFile(stream, f, st.st_size, stream is sock, transfer)
+        self.closeDataStream(stream)
+    ################################################################
+    # Send file of shared [reader] block by block. If this session falls behind the others
+    # (block is not in ring any more) the rest of the file is read by the session itself
+    def sendShared(self, stream, reader, raw, transfer=None):
+        i, pos = 0, 0
+        while True:
+            block = reader.get(i)
+            if block == None:
+                self.services["shared_reads"].fallbacks += 1
+                with self.vfs.open_read(reader.vpath) as f:
+                    f.seek(pos)
+                    self.streamFile(stream, f, reader.size, raw, transfer, pos)
+                return
+            if not block: return
+            stream.sendall(block)
+            pos += len(block)
+            i += 1
+            self.metrics.incr("bytes_sent", len(block))
+            if transfer != None: transfer.advance(len(block))
+    ################################################################
+    # Send [size] bytes of open file [f] to [stream] by blocks. Sendfile is used when [raw]
+    # (stream is data socket itself). Page cache hints are given for big files. Progress is counted in [transfer].
+    # File may be already read up to [start]
+    def streamFile(self, stream, f, size, raw, transfer=None, start=0):
+        real = hasRealFile(f)
+        page_cache = self.services.get("page_cache") if real else None
+        advised = page_cache != None and page_cache.open(f, size)
+        if page_cache != None: page_cache.sample(f, size)
+        # Binary stream mode: file goes to socket as is, let kernel copy it
+        use_sendfile = raw and real and self.config.get("sendfile", "YES") == "YES"
+        # Sent bytes, position where page cache was advised last time
+        pos, mark = start, start
+        while True:
+            if use_sendfile:
+                # Window by window: sent pages can be dropped from page cache, progress is visible in STAT
+                n = sendfile(stream, f, PageCache.WINDOW)
+                # Sendfile not supported (or end of file) -> rest is read usual way
+                if n == 0:
+                    use_sendfile = False
+                    continue
+            else:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk: break
+                stream.sendall(chunk)
+                n = len(chunk)
+            pos += n
+            self.metrics.incr("bytes_sent", n)
+            if transfer != None: transfer.advance(n)
+            if advised and pos - mark >= PageCache.WINDOW:
+                page_cache.advance(f, pos)
+                mark = pos
+        # Drop tail of the file too
+        if advised: page_cache.advance(f, pos)
+    ################################################################
+    # Hand data transfer [command] of [vpath] ([size] bytes, 0 if not known) over to transfer pool.
+    # body(transfer, *args) runs in pool thread, control session keeps answering ABOR, STAT, NOOP
+    def startTransfer(self, command, vpath, size, body, *args):
+        self.transfer = Transfer(command, vpath, size)
+        self.transferring = True
+        self.metrics.incr("transfers")
+        self.services["transfers"].submit(self.transfer, self.runTransfer, body, args)
+    ################################################################
+    # Executed by transfer pool thread
+    def runTransfer(self, transfer, body, args):
+        try:
+            # Aborted while waiting in queue
+            if transfer.aborted: raise socket.error(errno.ECONNABORTED, "Transfer aborted")
+            body(transfer, *args)
+        except socket.error as e:
+            if transfer.aborted:
+                self.sendCommand("426 Connection closed; transfer aborted.")
+            elif self.actv:
+                self.log("Active mode for %s %d.\nFailed with error: %s" % (self.addr + (str(e), ) ))
+                self.sendCommand("421 Active mode failed")
+            else:
+                self.log("Pasive mode for %s %d.\nFailed with error: %s" % (self.addr + (str(e), ) ))
+                self.sendCommand("421 Passive mode failed")
+        except Exception as e:
+            self.log("%s %s for %s failed with error: %s" % (transfer.command, transfer.path, self.CLIENT_NAME, str(e)))
+            self.sendCommand("451 Requested action aborted: local error in processing.")
+        finally:
+            # Cleanup data socket
+            self.closeDataConnection()
+            self.transferring = False
+            # ABOR is answered after reply of the transfer itself
+            if transfer.finish():
+                self.metrics.incr("transfers_aborted")
+                self.sendCommand("226 Abort successful.")
+            try:
+                self.writer.flush()
+            except socket.error:
+                pass
+    ################################################################
+    # Transfer body: send files list of directory [args]
+    def sendList(self, transfer, args):
+        sock = self.startData(transfer, "150 Opening ASCII mode data connection.")
+        # Get files list
+        m = self.getLIST(args)
+        self.log("Sent via data connection to %s %d:\n%s" % (self.addr + (m, )) )
+        # Send list to the client
+        self.sendData(sock, m + CRLF)
+        transfer.advance(len(m) + len(CRLF))
+        # Send post message
+        self.sendCommand("226 Transfer complete.")
+    ################################################################
+    # Transfer body: send listing of directory [vpath] in format of [command] (LIST, NLST, MLSD).
+    # Recursive listing covers the whole subtree (taken from tree index), names are relative to [vpath]
+    def sendTree(self, transfer, vpath, command, recursive):
+        sock = self.startData(transfer, "150 Opening ASCII mode data connection.")
+        tree = self.services["tree"]
+        if recursive: dirs = tree.walk(vpath)
+        else: dirs = [(vpath, tree.listdir(vpath) or [])]
+        stream = self.openDataStream(sock)
+        block, lines = [], 0
+        for path, entries in dirs:
+            rel = path[len(vpath):].lstrip("/")
+            # LIST -R: "ls -lR" format, every directory starts with its name
+            if command == "LIST":
+                block.append(("./" + rel if rel else ".") + ":" + CRLF)
+                block.extend([self.listLine(mode, size, mtime) + " " + name + CRLF for name, mode, size, mtime in entries])
+                block.append(CRLF)
+            elif command == "NLST":
+                block.extend([posixpath.join(rel, e[0]) + CRLF for e in entries])
+            else:
+                block.extend([self.factsLine(mode, size, mtime) + " " + posixpath.join(rel, name) + CRLF for name, mode, size, mtime in entries])
+            lines += len(entries)
+            # Listing is sent by blocks, whole listing of big tree is never kept in memory
+            if len(block) >= 1024:
+                data = "".join(block)
+                stream.sendall(data)
+                transfer.advance(len(data))
+                block = []
+        data = "".join(block)
+        stream.sendall(data)
+        transfer.advance(len(data))
+        self.closeDataStream(stream)
+        self.log("Sent via data connection to %s %d: %s of %s, %d entries" % (self.addr + (command + (" -R" if recursive else ""), vpath, lines)))
+        self.sendCommand("226 Transfer complete.")
+    ################################################################
+    # Transfer body: send manifest of tree [vpath]
+    def sendManifest(self, transfer, vpath):
+        sock = self.startData(transfer, "150 Opening ASCII mode data connection.")
+        stream = self.openDataStream(sock)
+        for part in self.services["manifests"].render(vpath, self.hash_algo):
+            stream.sendall(part)
+            transfer.advance(len(part))
+        self.closeDataStream(stream)
+        self.log("Sent via data connection to %s %d: manifest of %s" % (self.addr + (vpath, )))
+        self.sendCommand("226 Transfer complete.")
+    ################################################################
+    # Transfer body: read block signatures of client copy of [filepath] (until client shuts down
+    # its side of data connection), then send delta of the file against these blocks
+    def sendDelta(self, transfer, filepath, block_size):
+        sock = self.startData(transfer, "150 Opening BINARY mode data connection for delta.")
+        signatures, limit = [], DELTA_MAX_BLOCKS * DeltaEncoder.SIGNATURE.size
+        received = 0
+        chunk = sock.recv(CHUNK_SIZE)
+        while chunk:
+            received += len(chunk)
+            if received > limit: raise FtpServerException("Too many block signatures")
+            signatures.append(chunk)
+            chunk = sock.recv(CHUNK_SIZE)
+        encoder = DeltaEncoder(block_size, "".join(signatures))
+        stream = self.openDataStream(sock)
+        def emit(data):
+            stream.sendall(data)
+            transfer.advance(len(data))
+        with self.vfs.open_read(filepath) as f:
+            encoder.encode(f, emit)
+        self.closeDataStream(stream)
+        self.metrics.incr("delta_transfers")
+        self.metrics.incr("delta_bytes_literal", encoder.literal)
+        self.metrics.incr("delta_bytes_matched", encoder.matched)
+        self.log("Sent via data connection to %s %d: delta of %s, %d blocks of client copy, %d bytes literal, %d bytes matched" % (self.addr +
+            (filepath, encoder.count, encoder.literal, encoder.matched)))
+        self.sendCommand("226 Transfer complete.")
+    ################################################################
+    # Transfer body: send tree [vpath] as tar archive. Archive is written directly to data connection
+    # (no temporary file), small files are taken from content cache
+    def sendArchive(self, transfer, vpath):
+        sock = self.startData(transfer, "150 Opening BINARY mode data connection for archive.")
+        stream = self.openDataStream(sock)
+        cache = self.services.get("content_cache")
+        tar = tarfile.open(fileobj=ArchiveWriter(stream, transfer), mode="w|", bufsize=CHUNK_SIZE, format=tarfile.PAX_FORMAT)
+        files = 0
+        for path, entries in self.services["tree"].walk(vpath):
+            for name in [e[0] for e in entries]:
+                filepath = posixpath.join(path, name)
+                info = tarfile.TarInfo(filepath[len(vpath):].lstrip("/"))
+                # File removed since tree index was built
+                try:
+                    st = self.vfs.stat(filepath)
+                except (OSError, IOError):
+                    continue
+                info.mtime, info.mode = int(st.st_mtime), stat.S_IMODE(st.st_mode)
+                if stat.S_ISDIR(st.st_mode):
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                    continue
+                if not stat.S_ISREG(st.st_mode): continue
+                info.size = st.st_size
+                data = cache.get(self.vfs, filepath, st) if cache != None else None
+                # Cached content of file changed while it was read has other size
+                if data != None and len(data) == st.st_size:
+                    tar.addfile(info, io.BytesIO(data))
+                else:
+                    with self.vfs.open_read(filepath) as f:
+                        tar.addfile(info, f)
+                files += 1
+                self.metrics.incr("bytes_sent", st.st_size)
+        tar.close()
+        self.closeDataStream(stream)
+        self.metrics.incr("files_sent", files)
+        self.log("Sent via data connection to %s %d: archive of %s, %d files" % (self.addr + (vpath, files)))
+        self.sendCommand("226 Transfer complete.")
+    ################################################################
+    # Transfer body: send file (RETR)
+    def sendRetr(self, transfer):
+        # Passive mode client expects preliminary reply twice
+        sock = self.startData(transfer, self.openingReply(), True)
+        # Send file via data connection
+        self.sendFile(sock, transfer.path, transfer)
+        # Make log record
+        self.log("Sent via data connection to %s %d:\n%s" % (self.addr + (transfer.path, )) )
+        # Send post message
+        self.sendCommand("226 Transfer complete.")
+    ################################################################
+    # Transfer body: receive file (STOR, APPE) with upload writer [writer], at most [remaining] bytes
+    def receiveUpload(self, transfer, writer, append, remaining):
+        filepath = transfer.path
+        try:
+            sock = self.startData(transfer, self.openingReply())
+            self.receiveFile(sock, writer, remaining, transfer)
+        except socket.error as e:
+            if not transfer.aborted: self.log("Data connection for %s %d.\nFailed with error: %s" % (self.addr + (str(e), ) ))
+            self.sendCommand("426 Connection closed; transfer aborted.")
+            self.closeUpload(writer, filepath, append)
+            return
+        except (OSError, IOError) as e:
+            self.log("Write of %s for %s failed: %s" % (filepath, self.CLIENT_NAME, str(e)))
+            if e.errno == errno.EDQUOT:
+                self.metrics.incr("quota_rejects")
+                self.sendCommand("552 Requested file action aborted. Exceeded storage allocation.")
+            else:
+                self.sendCommand("451 Requested action aborted: local error in processing.")
+            self.closeUpload(writer, filepath, append)
+            return
+        # Wait until all data is on disk, then report result
+        if self.closeUpload(writer, filepath, append):
+            self.log("Received via data connection from %s %d:\n%s" % (self.addr + (filepath, )) )
+            self.sendCommand("226 Transfer complete.")
+        else:
+            self.sendCommand("451 Requested action aborted: local error in processing.")
+    ################################################################
+    # Open data connection for [transfer] and send preliminary [reply]: after connect in active mode,
+    # before accept in passive mode (and after it too if [twice])
+    def startData(self, transfer, reply, twice=False):
+        if self.actv:
+            sock = self.openDataConnection(transfer)
+            self.sendCommand(reply)
+            return sock
+        self.sendCommand(reply)
+        sock = self.openDataConnection(transfer)
+        if twice: self.sendCommand(reply)
+        return sock
+    ################################################################
+    # Open data connection (connect to client in active mode, accept connection in passive mode).
+    # Sockets are registered in [transfer], so it can be aborted
+    def openDataConnection(self, transfer):
+        if self.actv:
+            ip, port, ver = self.actv
+            self.data_socket = socket.socket(socket.AF_INET if ver == 1 else socket.AF_INET6, socket.SOCK_STREAM)
+            self.services["sockets"].data(self.data_socket)
+            self.data_socket.settimeout(15)
+            transfer.sockets.append(self.data_socket)
+            transfer.advance(0)
+            self.data_socket.connect((ip, port))
+            self.services["sockets"].cork(self.data_socket, True)
+            return self.data_socket
+        transfer.sockets.append(self.data_socket)
+        transfer.advance(0)
+        (conn, addr) = self.data_socket.accept()
+        self.pasv = conn
+        transfer.sockets.append(conn)
+        self.log("For client %s %d, accepted data connection %s %d: " % (self.addr + addr))
+        # Turn socket into blocking mode
+        self.pasv.setblocking(1)
+        # Rest of corked data is sent when socket is closed
+        self.services["sockets"].cork(self.pasv, True)
+        transfer.advance(0)
+        return self.pasv
+    ################################################################
+    # Receive file data from data connection [sock] and pass it to upload writer [writer].
+    # Data is decompressed in MODE Z and line endings are converted to local ones in TYPE A
+    # Raise IOError (EDQUOT) when more than [limit] bytes received (None -> no limit)
+    def receiveFile(self, sock, writer, limit=None, transfer=None):
+        inflater = zlib.decompressobj() if self.transfer_mode == "Z" else None
+        # Last block ended with CR (TYPE A)
+        cr = False
+        chunk = sock.recv(CHUNK_SIZE)
+        while chunk:
+            self.metrics.incr("bytes_received", len(chunk))
+            if transfer != None: transfer.advance(len(chunk))
+            blocks = [chunk]
+            if inflater != None:
+                blocks = []
+                # Output of each call is limited, so compressed stream can not blow up memory
+                while chunk:
+                    blocks.append(inflater.decompress(chunk, CHUNK_SIZE * 4))
+                    chunk = inflater.unconsumed_tail
+            for block in blocks:
+                if self.transfer_type == "A" and os.linesep != CRLF and block:
+                    # CRLF started in previous block
+                    if cr: block = "\r" + block
+                    cr = block.endswith("\r")
+                    if cr: block = block[:-1]
+                    block = block.replace(CRLF, os.linesep)
+                if not block: continue
+                if limit != None:
+                    limit -= len(block)
+                    if limit < 0: raise IOError(errno.EDQUOT, "Disk quota exceeded")
+                writer.write(block)
+            chunk = sock.recv(CHUNK_SIZE)
+        # Aborted transfer looks like end of data (socket was shut down)
+        if transfer != None: transfer.advance(0)
+        tail = inflater.flush() if inflater != None else ""
+        if self.transfer_type == "A" and os.linesep != CRLF:
+            # Rest of inflated data is converted like other blocks (CR of last block may start CRLF)
+            if cr: tail = "\r" + tail
+            tail = tail.replace(CRLF, os.linesep)
+        if tail and limit != None and limit < len(tail): raise IOError(errno.EDQUOT, "Disk quota exceeded")
+        if tail: writer.write(tail)
+    ################################################################
+    # Finish upload [writer] of file [filepath] (appended if [append]). Return True if all data was written
+    def closeUpload(self, writer, filepath, append=False):
+        ok = True
+        try:
+            writer.close()
+            self.metrics.incr("files_received")
+        except (OSError, IOError) as e:
+            self.log("Write of %s for %s failed: %s" % (filepath, self.CLIENT_NAME, str(e)))
+            ok = False
+        # File changed: cached stat results are not valid any more
+        self.services["stat_cache"].invalidate(filepath)
+        self.paths.invalidate(filepath)
+        self.services["tree"].refresh(posixpath.dirname(filepath))
+        # Charge current size of the file (written even partialy) to the user
+        quota = self.services.get("quota")
+        if quota != None:
+            try:
+                quota.update(filepath, self.user, self.vfs.stat(filepath).st_size, append)
+            except (OSError, IOError):
+                quota.remove(filepath)
+        return ok
+    ################################################################
+    # Preliminary reply sent before file transfer (shows current type)
+    def openingReply(self):
+        return "150 Opening %s mode data connection." % ("ASCII" if self.transfer_type == "A" else "BINARY")
+    ################################################################
     # Send command to the remote client
     def sendCommand(self, cmd):
         if self.sock == None: return
-        self.sock.setblocking(1)
-        self.sock.send(cmd + CRLF)
-        self.log("Sent to " + self.CLIENT_NAME + ": " + cmd)
-        self.sock.setblocking(0)
+        # Reply is queued and sent when the current batch of commands is processed
+        self.writer.write(cmd)
     ################################################################
 	# Return file permissions, owner username, group, last modification, filesize
     # This method is helper for "getLIST"
     def permissions(self, filename):
-        st = os.stat( filename )
-        mode = st.st_mode
+        st = self.vfs.stat( filename )
+        return self.listLine(st.st_mode, st.st_size, st.st_mtime)
+    ################################################################
+    # Construct LIST line (without name) of entry with [mode], [size] and [mtime]
+    def listLine(self, mode, size, mtime):
         isDir = stat.S_ISDIR(mode)
         res = ''
         res += 'd' if isDir else '-'
@@ -576,9 +3018,14 @@ class Client(threading.Thread):
             group = grp.getpwuid(gid)[0]
         except:
             pass
-        d = time.strftime('%b %d %Y', time.gmtime(os.path.getmtime(filename)) )
+        d = time.strftime('%b %d %Y', time.gmtime(mtime) )
         
-        return str.format("%s   1 %-10s %-10s %10lu %s" % (res, user, group, st.st_size, d))        
+        return str.format("%s   1 %-10s %-10s %10lu %s" % (res, user, group, size, d))        
+    ################################################################
+    # Construct MLSD facts (rfc 3659) of entry with [mode], [size] and [mtime]
+    def factsLine(self, mode, size, mtime):
+        kind = "dir" if stat.S_ISDIR(mode) else "file"
+        return "type=%s;size=%d;modify=%s;" % (kind, size, time.strftime("%Y%m%d%H%M%S", time.gmtime(mtime)))
 ########################################################################################################
 # FTP server class. With allow us to handle client connections to the server, send and receive messages
 ########################################################################################################
@@ -593,7 +3040,11 @@ class FtpServer:
         self.port = server_port
         self.log_file_name = log_file_name
         self.config = {}
-        self.accounts = {}
+        self.accounts = None
+        # Services shared by all clients
+        self.services = {}
+        self.services["metrics"] = Metrics()
+        self.services["vfs"] = LocalFilesystem(os.path.join(os.path.dirname(os.path.realpath(__file__)), ROOT_FOLDER))
         # Create root folder for incoming clients
         if not os.path.isdir(ROOT_FOLDER) or not os.path.exists(ROOT_FOLDER):
             os.makedirs(ROOT_FOLDER)
@@ -631,23 +3082,153 @@ class FtpServer:
         if not os.path.isdir(self.config["logdirectory"]) or not os.path.exists(self.config["logdirectory"]): raise FtpServerException("Directory for logs does not exists !")
         # We must have access to logdirectory
         if not self._write_read_able(self.config["logdirectory"]): raise FtpServerException("Logs directory is not writeable/readable")
+        # Directory of index files kept between restarts (logs directory by default)
+        if "state_directory" not in self.config: self.config["state_directory"] = self.config["logdirectory"]
+        if not os.path.isdir(self.config["state_directory"]) or not self._write_read_able(self.config["state_directory"]):
+            raise FtpServerException("Config error. \"state_directory\" should be a writeable directory")
         # Check if we can found file with user accounts
         if not os.path.isfile(self.config["usernamefile"]) or not os.path.exists(self.config["usernamefile"]): raise FtpServerException("Username file does not exists !")
+        # Stack size of threads started from now on (session threads, pools). Idle session keeps its stack
+        # reserved, so big default stack (8M on Linux) is mostly wasted; 0 = system default
+        stack_size = self._config_size("thread_stack_size", 512 * 1024)
+        try:
+            if stack_size: threading.stack_size(stack_size)
+        except ValueError:
+            raise FtpServerException("Config error. \"thread_stack_size\" should be 0 or at least 32K")
+        # Filesystem backend (files served from ROOT_FOLDER by default)
+        if self.config.get("filesystem", "LOCAL") == "MEMORY":
+            self.services["vfs"] = MemoryFilesystem()
+        elif self.config.get("filesystem", "LOCAL") != "LOCAL":
+            raise FtpServerException("Config error. \"filesystem\" should be LOCAL or MEMORY")
+        # Content cache for small files
+        if self.config.get("content_cache", "NO") == "YES":
+            cache = ContentCache(self._config_size("content_cache_size", 64 * 1024 * 1024), self._config_size("content_cache_max_file", 1024 * 1024))
+            self.services["content_cache"] = cache
+            self.services["metrics"].register(lambda: {"content_cache_hits" : cache.hits, "content_cache_misses" : cache.misses,
+                "content_cache_bytes" : cache.size, "content_cache_files" : len(cache.entries)})
+        # Compression level used in MODE Z transfers
+        try:
+            if not 0 <= int(self.config.get("deflate_level", 6)) <= 9: raise ValueError
+        except ValueError:
+            raise FtpServerException("Config error. \"deflate_level\" should be an integer from 0 to 9")
+        # Page cache hints for big files
+        if self.config.get("fadvise", "YES") == "YES":
+            page_cache = PageCache(self._config_size("fadvise_min_size", 8 * 1024 * 1024), self.config.get("page_cache_stats", "NO") == "YES")
+            self.services["page_cache"] = page_cache
+            self.services["metrics"].register(lambda: {"page_cache_hits" : page_cache.hits, "page_cache_misses" : page_cache.misses,
+                "files_advised" : page_cache.advised})
+        # Uploads: write-behind queue size and fsync policy (NONE, CLOSE or size of data between fsyncs)
+        sync = self.config.get("upload_sync", "CLOSE")
+        if sync == "NONE": sync = UploadWriter.SYNC_NONE
+        elif sync == "CLOSE": sync = UploadWriter.SYNC_CLOSE
+        elif self._config_size("upload_sync", 0) > 0: sync = self._config_size("upload_sync", 0)
+        else: raise FtpServerException("Config error. \"upload_sync\" should be NONE, CLOSE or size (like 16M)")
+        self.services["uploads"] = UploadWriter(self.services["metrics"], self._config_size("upload_queue_size", 4 * 1024 * 1024), sync)
+        # Concurrent downloads of the same big file share reads
+        if self.config.get("shared_reads", "YES") == "YES":
+            shared = SharedReads(self.services["vfs"], 4 * CHUNK_SIZE, self._config_size("shared_read_buffer", 32 * 1024 * 1024),
+                self._config_size("shared_read_min_size", 64 * 1024 * 1024), self.services.get("page_cache"))
+            self.services["shared_reads"] = shared
+            self.services["metrics"].register(shared.stats)
+        # Socket options: preset "socket_profile", its options can be changed one by one
+        options = {}
+        for key in ("tcp_nodelay", "tcp_keepalive", "tcp_cork", "reuse_address"):
+            if self.config.get(key) != None: options[key] = self.config[key] == "YES"
+        for key in ("data_sndbuf", "data_rcvbuf"):
+            if self.config.get(key) != None: options[key] = self._config_size(key, 0)
+        try:
+            self.services["sockets"] = SocketProfile(self.config.get("socket_profile", "LAN"), options, int(self.config.get("tcp_keepalive_idle", 60)))
+        except ValueError:
+            raise FtpServerException("Config error. \"socket_profile\" should be DEFAULT, LAN or WAN and \"tcp_keepalive_idle\" an integer")
+        # Index of the whole tree for recursive listings and SITE FIND
+        try:
+            self.tree_interval = int(self.config.get("tree_index_interval", 600))
+            int(self.config.get("site_find_limit", 1000))
+        except ValueError:
+            raise FtpServerException("Config error. \"tree_index_interval\" and \"site_find_limit\" should be integers")
+        tree = TreeIndex(self.services["vfs"])
+        self.services["tree"] = tree
+        self.services["metrics"].register(lambda: {"tree_index_dirs" : len(tree.dirs), "tree_index_entries" : tree.files,
+            "tree_index_builds" : tree.builds, "tree_index_build_ms" : int(tree.build_time * 1000)})
+        # Threads running data transfers of all sessions
+        try:
+            transfers = TransferPool(int(self.config.get("transfer_workers", 16)), self._config_size("transfer_small_size", 1024 * 1024))
+            if transfers.size < 1: raise ValueError
+        except ValueError:
+            raise FtpServerException("Config error. \"transfer_workers\" should be a positive integer")
+        self.services["transfers"] = transfers
+        self.services["metrics"].register(lambda: {"transfers_active" : transfers.active, "transfers_queued" : transfers.queued(),
+            "transfer_queue_waits" : transfers.waits})
+        # Disk quota: "quota" for all users, "quota_<login>" for one user (0 -> no limit)
+        if self.config.get("quota") != None or [k for k in self.config if k.startswith("quota_")]:
+            quotas = dict((k[6:], self._config_size(k, 0)) for k in self.config if k.startswith("quota_") and k != "quota_reconcile_interval")
+            try:
+                self.quota_interval = int(self.config.get("quota_reconcile_interval", 300))
+            except ValueError:
+                raise FtpServerException("Config error. \"quota_reconcile_interval\" should be an integer")
+            quota = QuotaIndex(self.services["vfs"], quotas, self._config_size("quota", 0), os.path.join(self.config["state_directory"], QUOTA_INDEX_FILE) if self.config.get("filesystem", "LOCAL") == "LOCAL" else None)
+            self.services["quota"] = quota
+            self.services["metrics"].register(lambda: {"quota_files" : len(quota.entries), "quota_fixes" : quota.fixes})
+        # Number of worker processes (1 -> all clients are served by threads of this process)
+        try:
+            self.workers = int(self.config.get("workers", 1))
+            if self.workers < 1: raise ValueError
+        except ValueError:
+            raise FtpServerException("Config error. \"workers\" should be a positive integer")
+        # Workers share quota usage through index file, usage kept only in memory would be enforced by each worker alone
+        quota = self.services.get("quota")
+        if self.workers > 1 and quota != None and quota.index_file == None and (quota.default or any(quota.quotas.values())):
+            raise FtpServerException("Config error. \"quota\" with \"workers\" > 1 needs local filesystem (usage index file)")
+        # Worker number (None in supervisor or single process mode), worker pid -> (number, metrics pipe)
+        self.worker, self.worker_procs = None, {}
+        # Last metrics received from each worker
+        self.worker_metrics = {}
+        self.workers_stopped = threading.Event()
+        self.stopping_timeout = 0
+        # Seconds given to running transfers when server drained (stop with "drain" or "restart")
+        try:
+            self.drain_timeout = int(self.config.get("drain_timeout", 30))
+        except ValueError:
+            raise FtpServerException("Config error. \"drain_timeout\" should be an integer")
+        # Wakeup pipe: lets accept loop notice stop request at once (without waiting select timeout)
+        self.wakeup_r, self.wakeup_w = os.pipe()
         # Load user accounts info (pairs login->password)
         try:
-            num_row = 1
-            with open(self.config["usernamefile"]) as f_acc:
-                for rec in f_acc:
-                    login, password = rec.split()
-                    self.accounts[login.strip()] = password.strip()
-                    num_row += 1
-        except(IOError):
-            raise FtpServerException("Cannot open/read accounts file: %s" % (self.config["usernamefile"]))
-        except(ValueError):
-            raise FtpServerException("Accounts file bad format.\nExpected pairs: <login> <password>.\nError occured at line=%d" % (num_row))
+            iterations, ttl = int(self.config.get("password_iterations", 10000)), int(self.config.get("auth_cache_ttl", 60))
+        except ValueError:
+            raise FtpServerException("Config error. \"password_iterations\" and \"auth_cache_ttl\" should be integers")
+        self.accounts = CredentialStore(self.config["usernamefile"], iterations, ttl)
+        # Stat results shared by all sessions
+        try:
+            stat_cache = StatCache(self.services["vfs"], float(self.config.get("stat_cache_ttl", 2)))
+        except ValueError:
+            raise FtpServerException("Config error. \"stat_cache_ttl\" should be a number")
+        self.services["stat_cache"] = stat_cache
+        self.services["metrics"].register(lambda: {"stat_cache_hits" : stat_cache.hits, "stat_cache_misses" : stat_cache.misses})
+        # File digests computed by pool threads and cached in index file
+        try:
+            hash_workers = int(self.config.get("hash_workers", 2))
+        except ValueError:
+            raise FtpServerException("Config error. \"hash_workers\" should be an integer")
+        digests = DigestCache(self.services["vfs"], WorkerPool(hash_workers), os.path.join(self.config["state_directory"], HASH_INDEX_FILE) if self.config.get("filesystem", "LOCAL") == "LOCAL" else None)
+        self.services["digests"] = digests
+        self.services["metrics"].register(lambda: {"digest_cache_hits" : digests.hits, "digest_cache_misses" : digests.misses})
+        # Manifests of trees (SITE MANIFEST), known digests are included
+        manifests = ManifestCache(self.services["tree"], digests if self.config.get("manifest_digests", "YES") == "YES" else None)
+        self.services["manifests"] = manifests
+        self.services["metrics"].register(lambda: {"manifest_parts_cached" : manifests.hits, "manifest_parts_rendered" : manifests.misses})
+        # Failed logins table (brute-force protection)
+        try:
+            self.services["login_guard"] = LoginGuard(int(self.config.get("login_window", 300)), int(self.config.get("max_login_attempts", 3)),
+                int(self.config.get("max_ip_failures", 10)), int(self.config.get("max_user_failures", 30)))
+        except ValueError:
+            raise FtpServerException("Config error. Brute-force protection settings should be integers")
+        # Server-wide data of sessions
+        self.session_settings = SessionSettings(self.log, self.accounts, self.config, self.services)
         # List of connected clients
         self.clients = []
         self.running = False
+        self.services["metrics"].register(lambda: {"clients" : len([c for c in self.clients if c.running])})
         # Validate argumens
         # log_file_name should be valid filename, 
         # port should be a positive integer
@@ -734,6 +3315,18 @@ class FtpServer:
         # Write num of accounts loaded
         self.log("%d account records loaded." % len(self.accounts))
     ###############################################################
+    # Return config value [key] as size in bytes. Value may have K, M or G suffix (64K, 10M, ...)
+    def _config_size(self, key, default):
+        value = self.config.get(key)
+        if value == None: return default
+        multipliers = {"K" : 1024, "M" : 1024 ** 2, "G" : 1024 ** 3}
+        try:
+            if value[-1:] in multipliers:
+                return int(value[:-1]) * multipliers[value[-1]]
+            return int(value)
+        except ValueError:
+            raise FtpServerException("Config error. \"%s\" should be a size (bytes, or number with K/M/G suffix)" % key)
+    ###############################################################
     # Check if directory readable/writeable
     def _write_read_able(self, dir):
         # Try to create empty temp file
@@ -779,10 +3372,44 @@ class FtpServer:
     def startServer(self):
         if self.running: return
         self.log("Starting server on port %d...." % self.port)
+        # Pre-fork mode: workers accept clients, this process only supervises them
+        if self.workers > 1:
+            self.startWorkers()
+            return
+        if not self.openListenSocket(): return
+        self.running = True
+        self.startJobs()
+        self.log("Server start OK.")
+        self.log("Server running on port %d. Waiting for clients..." % self.port)
+        serverStartEvent.set()
+        self.notifyReady()
+        self.acceptLoop()
+        # If we reach this line then server should be onStop event
+        # Stop listen socket
+        self.serv_sock.close()        
+        self.stopServer()
+    ###############################################################
+    # Start background jobs of shared services (in each process that serves clients)
+    def startJobs(self):
+        if "quota" in self.services: self.services["quota"].start(self.log, self.quota_interval)
+        if self.config.get("tree_index", "YES") == "YES": self.services["tree"].start(self.log, self.tree_interval)
+    ###############################################################
+    # Create listen socket. Return False (and set stop event) if socket can't be created
+    def openListenSocket(self, reuse_port=False):
+        # Restarted server: continue with listen socket of previous process (no refused connections)
+        listen_fd = os.environ.pop("FTP_LISTEN_FD", None)
+        if listen_fd != None and not reuse_port:
+            self.serv_sock = socket.fromfd(int(listen_fd), socket.AF_INET, socket.SOCK_STREAM)
+            os.close(int(listen_fd))
+            self.log("Listen socket received from previous server process")
+            return True
         try:
             # Listn socket to accept incoming clients
             self.serv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            #self.serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Restarted server can bind port at once (connections of old process may be in TIME_WAIT)
+            self.services["sockets"].listen(self.serv_sock)
+            # Every worker binds own socket to the same port, kernel balances connections between them
+            if reuse_port: self.serv_sock.setsockopt(socket.SOL_SOCKET, getattr(socket, "SO_REUSEPORT", 15), 1)
             self.serv_sock.setblocking(0)
             self.serv_sock.settimeout(2)
             # Bind to all interfaces but on specifed port
@@ -791,45 +3418,233 @@ class FtpServer:
             self.serv_sock.listen(0)
         except socket.error, (errorCode, message):
             self.running = False
-            if errorCode == 10048: self.log("Server start FAIL: \"address already in use\"")
+            if errorCode == 10048 or errorCode == errno.EADDRINUSE: self.log("Server start FAIL: \"address already in use\"")
             else: self.log("Server start FAIL: %s" %(message))
             serverStartEvent.set()
             serverStopEvent.set()
-            return
-        self.running = True
-        self.log("Server start OK.")
-        self.log("Server running on port %d. Waiting for clients..." % self.port)
-        serverStartEvent.set()
+            return False
+        return True
+    ###############################################################
+    # Accept clients while server is running
+    def acceptLoop(self):
         try:
             # Accept loop 
             while self.running:
-                _in, out, _exc = select.select([self.serv_sock,], [], [], 1)
+                try:
+                    _in, out, _exc = select.select([self.serv_sock, self.wakeup_r], [], [], 1)
+                except select.error, (errorCode, message):
+                    # Interrupted by signal (worker stop request)
+                    if errorCode == errno.EINTR: continue
+                    raise
                 for s in _in:
                     if s != self.serv_sock: continue
-                    client = Client(self.serv_sock.accept(), self.log, self.accounts, self.config)
+                    (conn, addr) = self.serv_sock.accept()
+                    # Reject hosts with too many failed logins before creating client thread
+                    if self.services["login_guard"].ip_blocked(addr[0]):
+                        self.rejectClient(conn, addr)
+                        continue
+                    self.services["sockets"].control(conn)
+                    client = Client(conn, addr, self.session_settings)
                     self.log( "Client from %s %d" % client.addr + " accepted" )
-                    # Add new client to list
+                    self.services["metrics"].incr("connections")
+                    # Add new client to list (and forget finished clients from time to time)
+                    if len(self.clients) % 64 == 0: self.clients = [c for c in self.clients if c.is_alive()]
                     self.clients.append(client)
                     # Handle client
                     client.start()
         except Exception as e:
             self.log("Error while acception loop: " + str(e))
-        # If we reach this line then server should be onStop event
-        # Stop listen socket
-        self.serv_sock.close()        
-        self.stopServer()
     ###############################################################
-	# Stop sever, close all client connections, cleanup sockets
-    def stopServer(self):
-        if not self.running: return
-        self.log("Stopping server...")
-        # Mark running status to false
+    # Supervisor: start worker processes and wait until server stopped
+    def startWorkers(self):
+        self.running = True
+        for num in range(self.workers):
+            self.forkWorker(num)
+        self.log("Server start OK. %d workers running on port %d. Waiting for clients..." % (self.workers, self.port))
+        serverStartEvent.set()
+        # Collect metrics sent by workers (and restart workers that died)
+        while self.running:
+            pipes = dict((pipe, pid) for pid, (num, pipe) in self.worker_procs.items())
+            try:
+                _in, _out, _exc = select.select(pipes.keys() + [self.wakeup_r], [], [], 1)
+            except select.error:
+                continue
+            for pipe in _in:
+                if pipe in pipes: self.readWorkerMetrics(pipes[pipe], pipe)
+            # Every worker reported (so it is accepting clients)
+            if len(self.worker_metrics) == self.workers: self.notifyReady()
+        # Server stopped: ask workers to stop and wait for them
+        self.stopWorkers(self.stopping_timeout)
+        self.workers_stopped.set()
+    ###############################################################
+    # Fork worker process number [num]
+    def forkWorker(self, num):
+        pipe_r, pipe_w = os.pipe()
+        # Dont let child inherit unflushed log records, hold log lock so child gets it unlocked
+        lock.acquire()
+        self.f.flush()
+        pid = os.fork()
+        lock.release()
+        if pid == 0:
+            os.close(pipe_r)
+            for other_num, other_pipe in self.worker_procs.values(): os.close(other_pipe)
+            self.worker_procs = {}
+            code = 1
+            try:
+                self.runWorker(num, pipe_w)
+                code = 0
+            finally:
+                os._exit(code)
+        os.close(pipe_w)
+        self.worker_procs[pid] = (num, pipe_r)
+        self.log("Worker %d started (pid %d)" % (num, pid))
+    ###############################################################
+    # Worker process: accept and serve clients until SIGTERM received
+    def runWorker(self, num, pipe_w):
+        self.worker = num
+        # Stop (SIGTERM) and drain (SIGUSR1) requests from supervisor
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.requestStop(0))
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.requestStop(self.drain_timeout))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if not self.openListenSocket(reuse_port=True): return
+        self.running = True
+        self.startJobs()
+        # Report metrics to supervisor every second
+        reporter = threading.Thread(target=self.reportMetrics, args=(pipe_w, ))
+        reporter.daemon = True
+        reporter.start()
+        self.acceptLoop()
+        self.serv_sock.close()
+        self.closeClients(self.stopping_timeout)
+        self.log("Worker %d stopped." % num)
+        self.f.close()
+    ###############################################################
+    # Worker: write metrics snapshot (one json line) to supervisor pipe every second
+    def reportMetrics(self, pipe_w):
+        try:
+            while self.running:
+                os.write(pipe_w, json.dumps(self.services["metrics"].snapshot()) + "\n")
+                time.sleep(1)
+        except OSError:
+            pass
+    ###############################################################
+    # Supervisor: read metrics from worker [pid] pipe. Worker is restarted if it exited while server running
+    def readWorkerMetrics(self, pid, pipe):
+        data = os.read(pipe, 65536)
+        if data:
+            lines = data.split("\n")
+            # Keep only the latest complete snapshot
+            if len(lines) > 1 and lines[-2]: self.worker_metrics[pid] = json.loads(lines[-2])
+            return
+        # Pipe closed -> worker exited
+        num, pipe = self.worker_procs.pop(pid)
+        os.close(pipe)
+        os.waitpid(pid, 0)
+        self.worker_metrics.pop(pid, None)
+        if self.running:
+            self.log("Worker %d (pid %d) exited unexpectedly, restarting" % (num, pid))
+            self.forkWorker(num)
+    ###############################################################
+    # Return metrics of the server (summed over all workers in pre-fork mode)
+    def getMetrics(self):
+        if self.workers == 1: return self.services["metrics"].snapshot()
+        result = collections.defaultdict(int)
+        for snapshot in self.worker_metrics.values():
+            for name, value in snapshot.items(): result[name] += value
+        result["workers"] = len(self.worker_procs)
+        return dict(result)
+    ###############################################################
+    # Send "service not available" to the client [conn] and close connection
+    def rejectClient(self, conn, addr):
+        self.log("Client from %s %d rejected (too many failed logins)" % addr)
+        # Accept loop never waits for rejected client: reply goes to empty socket buffer
+        # at once, if it does not it is dropped
+        try:
+            conn.setblocking(0)
+            conn.send("421 Service not available, too many failed logins." + CRLF)
+        except socket.error:
+            pass
+        conn.close()
+    ###############################################################
+    # Mark server as stopping and wake up accept loop. Sessions get [timeout] seconds to finish transfers
+    def requestStop(self, timeout):
+        self.stopping_timeout = timeout
         self.running = False
+        os.write(self.wakeup_w, "x")
+    ###############################################################
+    # Restarted server: tell previous server process that we accept clients now
+    def notifyReady(self):
+        ready_fd = os.environ.pop("FTP_READY_FD", None)
+        if ready_fd == None: return
+        try:
+            os.write(int(ready_fd), "ready")
+            os.close(int(ready_fd))
+        except OSError:
+            pass
+    ###############################################################
+    # Zero-downtime restart: start new server process, pass listen socket to it,
+    # wait until it accepts clients and drain this server. Return False if new server failed to start
+    def restartServer(self):
+        if not self.running: return False
+        self.log("Restarting server...")
+        env = dict(os.environ)
+        ready_r, ready_w = os.pipe()
+        env["FTP_READY_FD"] = str(ready_w)
+        # In pre-fork mode new workers bind own SO_REUSEPORT sockets, otherwise listen socket is inherited
+        keep = [ready_w]
+        if self.workers == 1 and fcntl != None:
+            fd = self.serv_sock.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+            env["FTP_LISTEN_FD"] = str(fd)
+            keep.append(fd)
+        # New process gets only listen socket and ready pipe (client connections, data sockets and
+        # files stay in this process, so they are closed when this process closes them)
+        if fcntl != None: self._closeOnExec(keep)
+        script = os.path.splitext(os.path.realpath(__file__))[0] + ".py"
+        try:
+            proc = subprocess.Popen([sys.executable, script, self.log_file_name, str(self.port)], env=env, close_fds=False)
+        except OSError as e:
+            self.log("Restart FAIL: " + str(e))
+            return False
+        finally:
+            os.close(ready_w)
+        # Wait until new server is ready
+        _in, _out, _exc = select.select([ready_r], [], [], 15)
+        ready = _in and os.read(ready_r, 16) == "ready"
+        os.close(ready_r)
+        if not ready:
+            self.log("Restart FAIL: new server process %d is not ready" % proc.pid)
+            return False
+        self.log("New server process %d is ready." % proc.pid)
+        self.stopServer(self.drain_timeout)
+        return True
+    ###############################################################
+    # Set close-on-exec flag on all open descriptors (except standard streams and descriptors in [keep])
+    def _closeOnExec(self, keep):
+        try:
+            fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+        except OSError:
+            fds = range(3, os.sysconf("SC_OPEN_MAX"))
+        for fd in fds:
+            if fd < 3 or fd in keep: continue
+            try:
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            except (IOError, OSError):
+                pass
+    ###############################################################
+	# Stop sever, close all client connections, cleanup sockets.
+    # Drain mode ([drain_timeout] > 0): stop accepting clients, let running transfers finish (up to deadline)
+    def stopServer(self, drain_timeout=0):
+        if not self.running: return
+        if drain_timeout: self.log("Draining server (%d sec for running transfers)..." % drain_timeout)
+        else: self.log("Stopping server...")
+        # Mark running status to false, accept loop stops at once
+        self.requestStop(drain_timeout)
+        # Pre-fork mode: supervisor thread stops workers, wait for it
+        if self.workers > 1 and self.worker == None: self.workers_stopped.wait(drain_timeout + 15)
         try:
             # Close client connections
-            for c in self.clients:
-                c.close_connection()        
-                c.join()
+            self.closeClients(drain_timeout)
             # Close file
             self.f.close()
             self.log("All clients disconnected. Server succefuly stoped.")
@@ -837,6 +3652,36 @@ class FtpServer:
             pass
         serverStopEvent.set()
     ###############################################################
+    # Close connections of all clients and wait their threads.
+    # Idle sessions are closed at once, sessions busy with transfer get [timeout] seconds to finish it
+    def closeClients(self, timeout=0):
+        clients = [c for c in self.clients if c.is_alive()]
+        for c in clients: c.drain()
+        deadline = time.time() + timeout
+        while time.time() < deadline and any(c.is_alive() for c in clients):
+            time.sleep(0.1)
+        # Deadline reached: close all remaining sessions first, then wait for them
+        for c in clients:
+            c.close_connection()        
+        for c in clients:
+            c.join()
+    ###############################################################
+    # Supervisor: send SIGTERM (stop) or SIGUSR1 (drain) to all workers, wait them
+    # (kill workers that dont stop in 10 sec after drain timeout)
+    def stopWorkers(self, drain_timeout=0):
+        for pid in self.worker_procs: os.kill(pid, signal.SIGUSR1 if drain_timeout else signal.SIGTERM)
+        deadline = time.time() + drain_timeout + 10
+        for pid, (num, pipe) in self.worker_procs.items():
+            while os.waitpid(pid, os.WNOHANG)[0] == 0:
+                if time.time() >= deadline:
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    break
+                time.sleep(0.1)
+            os.close(pipe)
+            self.log("Worker %d stopped." % num)
+        self.worker_procs = {}
+    ###############################################################
     # Return string of current time stamp
     def get_timestamp(self):
         # Get current date/time and convert to string using specified format
@@ -852,6 +3697,8 @@ class FtpServer:
         print( ts + " " + message )
         # Append to lof file
         self.f.write(ts + " " + message + "\n")
+        # Workers share log file, so records are written at once
+        if self.worker != None: self.f.flush()
         # Release block
         lock.release()        
 ###############################################################
@@ -874,13 +3721,22 @@ def main():
         th.start()
         # Wait while serverStartEvent will be maked
         serverStartEvent.wait()
-        # Commands to server (only one -> stop)
+        # Commands to server: stop, drain (wait for transfers), restart (new server process takes over), stats
+        drain = False
         while not serverStopEvent.wait(0):
             cmd = raw_input(">")
             if str.lower(cmd) == "stop": break
+            if str.lower(cmd) == "drain":
+                drain = True
+                break
+            if str.lower(cmd) == "restart":
+                if ftp.restartServer(): break
+            # Show server metrics (summed over all workers)
+            if str.lower(cmd) == "stats":
+                for name, value in sorted(ftp.getMetrics().items()): print("%s: %s" % (name, value))
             # We can add commands like to live interact with server (add/edit user, or maybe list all clients, disconnect, etc, up 2 u)
+        ftp.stopServer(ftp.drain_timeout if drain else 0)
         serverStopEvent.set()
-        ftp.stopServer()
         th.join()
         print("Server thread stop.")
     except FtpServerException as e: